@@ -0,0 +1,218 @@
+import argparse
+import os
+import random
+import shutil
+import stringutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from build import types_imply_private
+from config import get_topics, get_types
+from problem import Problem, TEXT_FIELDS, Version
+
+# Usage
+# python benchmark.py strip -s 4
+# python benchmark.py parse -v 40
+# python benchmark.py vocabulary -v 20000
+# python benchmark.py startup
+#
+# Times the hot spots of building large documents. Each benchmark checks its
+# own output, so a fast but wrong implementation doesn't look like a win.
+
+def timed(function, *args):
+  start = time.time()
+  result = function(*args)
+  return time.time() - start, result
+
+def benchmark_strip(settings):
+  """Strips the comments from a document of settings.size megabytes"""
+  chunk = stringutil.test1in + "\n"
+  expected = stringutil.strip_latex_comments(chunk)
+  copies = settings.size * (1 << 20) / len(chunk) + 1
+  document = chunk * copies
+
+  elapsed, stripped = timed(stringutil.strip_latex_comments, document)
+  assert stripped == expected * copies, "strip_latex_comments output changed"
+  print "Stripped {:.1f} MB in {:.3f}s ({:.1f} MB/s)".format(
+      len(document) / float(1 << 20), elapsed,
+      len(document) / float(1 << 20) / elapsed)
+
+  elapsed, _ = timed(lambda: [stringutil.strip_latex_comments(chunk)
+      for i in xrange(settings.repeat)])
+  print "Stripped {} small documents in {:.3f}s ({:.2f}ms each)".format(
+      settings.repeat, elapsed, 1000 * elapsed / settings.repeat)
+
+def problem_file(versions, size):
+  """A problem file with the given number of versions, each with fields of size bytes"""
+  text = ("Some $\\LaTeX$ with an \\emph{equation} and a \\% sign. " * 
+      (size / 50 + 1))[:size]
+  version = """  <version id="{}">
+    <authors>a b</authors><year>2017</year>
+    <topics>counting sets</topics><types>proof</types>
+    <body>{}</body>
+    <solution>{}</solution>
+    <rubric>{}</rubric>
+  </version>
+"""
+  return "<problem>\n" + "".join(version.format(vid, text, text, text)
+      for vid in range(versions)) + "</problem>\n"
+
+def benchmark_parse(settings):
+  """Parses a problem file with many large versions for its metadata"""
+  directory = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(directory, "problem.xml")
+    with open(filename, "w") as f:
+      f.write(problem_file(settings.versions, settings.size))
+    def metadata(parse):
+      problem = Problem(filename)
+      parse(problem)
+      newest = problem.newest_version()
+      return newest.vid, newest.topics, newest.has_text('body')
+    def parse_tree(problem):
+      problem.parse_tree(ET.parse(filename), validate_versions=False)
+    def parse_file(problem):
+      problem.parse_file(validate_versions=False)
+
+    expected = metadata(parse_tree)
+    for name, parse in (("parse_tree", parse_tree), ("parse_file", parse_file)):
+      elapsed, results = timed(lambda: [metadata(parse) 
+          for i in xrange(settings.repeat)])
+      assert results == [expected] * settings.repeat, name + " output changed"
+      print "{}: {} versions of {} KB in {:.2f}ms".format(name, 
+          settings.versions, 3 * settings.size / 1024, 
+          1000 * elapsed / settings.repeat)
+  finally:
+    shutil.rmtree(directory)
+
+def deep_size(value, seen):
+  """The bytes taken by value and everything it refers to that isn't in seen"""
+  if id(value) in seen or value is None or isinstance(value, (bool, type)):
+    return 0
+  seen.add(id(value))
+  size = sys.getsizeof(value)
+  if isinstance(value, dict):
+    size += sum(deep_size(key, seen) + deep_size(item, seen) 
+        for key, item in value.iteritems())
+  elif isinstance(value, (list, tuple, set, frozenset)):
+    size += sum(deep_size(item, seen) for item in value)
+  elif not isinstance(value, (basestring, int, long, float)):
+    if hasattr(value, '__dict__'):
+      size += deep_size(value.__dict__, seen)
+    for cls in type(value).__mro__:
+      for name in cls.__dict__.get('__slots__', ()):
+        if name not in TEXT_FIELDS and hasattr(value, name):
+          size += deep_size(getattr(value, name), seen)
+  return size
+
+def benchmark_memory(settings):
+  """Measures the memory each version takes once its metadata has been parsed"""
+  directory = tempfile.mkdtemp()
+  try:
+    filename = os.path.join(directory, "problem.xml")
+    with open(filename, "w") as f:
+      f.write(problem_file(settings.versions, 0))
+    problems = []
+    for i in xrange(settings.repeat):
+      problem = Problem(filename)
+      problem.parse_file(validate_versions=False)
+      problems.append(problem)
+    # Strings shared between versions (like interned topics) count only once
+    seen = set()
+    total = sum(deep_size(version, seen) 
+        for problem in problems for version in problem.versions.itervalues())
+    print "{} bytes per version, over {} versions".format(
+        total / (settings.versions * settings.repeat), 
+        settings.versions * settings.repeat)
+  finally:
+    shutil.rmtree(directory)
+
+def benchmark_vocabulary(settings):
+  """Validates a synthetic corpus and checks which versions have private types"""
+  generator = random.Random(22)
+  topics = get_topics()
+  types = get_types()
+  versions = []
+  for vid in xrange(settings.versions):
+    version = Version("problem{}.xml".format(vid / 10), vid % 10)
+    version.authors = ["author{}".format(vid % 7)]
+    version.year = str(2010 + vid % 8)
+    version.topics = sorted(generator.sample(topics, 3), key=topics.index)
+    version.types = sorted(generator.sample(types, 2), key=types.index)
+    version.body = version.solution = version.rubric = "text"
+    versions.append(version)
+
+  def check():
+    private = 0
+    for version in versions:
+      version.validate()
+      private += types_imply_private(version.types)
+    return private
+  elapsed, private = timed(check)
+  print "Validated {} versions ({} private) in {:.1f}ms ({:.2f}us each)".format(
+      settings.versions, private, 1000 * elapsed, 
+      1000000 * elapsed / settings.versions)
+
+def benchmark_startup(settings):
+  """Times starting a fresh interpreter which imports each of the tools"""
+  for module in ["build", "edit"]:
+    times = []
+    for i in xrange(settings.repeat):
+      start = time.time()
+      subprocess.check_call([sys.executable, "-c", "import " + module])
+      times.append(time.time() - start)
+    print "import {}: {:.1f}ms (fastest of {})".format(module, 
+        1000 * min(times), settings.repeat)
+
+def build_args():
+  parser = argparse.ArgumentParser(description='Times the slowest parts of building')
+  subparsers = parser.add_subparsers(help='The benchmark to run')
+
+  subparser = subparsers.add_parser('strip',
+      help='Times stripping the comments from a large document')
+  subparser.add_argument('-s', dest='size', type=int, default=4,
+      help='The size of the document, in megabytes')
+  subparser.add_argument('-r', dest='repeat', type=int, default=200,
+      help='The number of small documents to strip')
+  subparser.set_defaults(func=benchmark_strip)
+
+  subparser = subparsers.add_parser('parse',
+      help='Times reading the metadata of a problem file with many versions')
+  subparser.add_argument('-v', dest='versions', type=int, default=40,
+      help='The number of versions in the problem file')
+  subparser.add_argument('-s', dest='size', type=int, default=20000,
+      help='The size of each version\'s body, solution and rubric, in bytes')
+  subparser.add_argument('-r', dest='repeat', type=int, default=20,
+      help='The number of times to parse the file')
+  subparser.set_defaults(func=benchmark_parse)
+
+  subparser = subparsers.add_parser('memory',
+      help='Measures the memory taken by the metadata of many versions')
+  subparser.add_argument('-v', dest='versions', type=int, default=100,
+      help='The number of versions in each problem file')
+  subparser.add_argument('-r', dest='repeat', type=int, default=50,
+      help='The number of times to parse the file')
+  subparser.set_defaults(func=benchmark_memory)
+
+  subparser = subparsers.add_parser('vocabulary',
+      help='Times validating the topics and types of a synthetic corpus')
+  subparser.add_argument('-v', dest='versions', type=int, default=20000,
+      help='The number of versions in the corpus')
+  subparser.set_defaults(func=benchmark_vocabulary)
+
+  subparser = subparsers.add_parser('startup',
+      help='Times importing the build and edit tools in a new process')
+  subparser.add_argument('-r', dest='repeat', type=int, default=10,
+      help='The number of times to start each tool')
+  subparser.set_defaults(func=benchmark_startup)
+
+  return parser.parse_args()
+
+def main():
+  settings = build_args()
+  settings.func(settings)
+
+if __name__ == '__main__':
+  main()
@@ -1,21 +1,26 @@
 import argparse
 import os
-import errno
+import scratch
+from corpus import Corpus, members
+from index import ProblemIndex, OK, INVALID, UNPARSEABLE, UNREADABLE
 from parseable import ImproperXmlException
-from problem import Problem, Document
-from subprocess import call
-from random import randint
-from config import get_problem_root, get_private_types
+from problem import SPLIT_KEY, Problem, Document, SourceMap, SplitDocument
+from multiprocessing.pool import ThreadPool
+from config import get_problem_root, get_private_type_set
 import xml.etree.ElementTree as ET
 from color import *
-from pdfbuilder import build, temp_file_remove
+from copy import copy
+
+# The (solutions, rubrics, metadata) flags of each variant build doc can make
+VARIANTS = {
+  "student": (False, False, False),
+  "solutions": (True, False, False),
+  "rubrics": (True, True, False),
+  "metadata": (False, False, True)
+}
 
 def types_imply_private(types):
-  if types:
-    for private in get_private_types():
-      if private in types:
-        return True
-  return False
+  return bool(types) and not get_private_type_set().isdisjoint(types)
 
 def satisfies(version, settings, used_ins):
   if (settings.allowed_topics and 
@@ -66,7 +71,49 @@ def satisfies(version, settings, used_ins):
     return False
   return True
 
-def build_wrapper(document, filename, settings):
+def may_satisfy(candidates, version):
+  """Whether the text index allows version to satisfy the --grep/--todo predicates"""
+  return candidates is None or (version.filename, version.vid) in candidates
+
+def select(corpus, settings, candidates):
+  """The bitset of versions within corpus which satisfy every predicate"""
+  selected = corpus.select(settings)
+  if settings.todo or settings.grep:
+    for position in members(selected):
+      version = corpus.versions[position]
+      if not (may_satisfy(candidates, version) and 
+          satisfies(version, settings, corpus.used_ins[position])):
+        selected = selected & ~(1 << position)
+  return selected
+
+def report_unusable(filename, status, settings, invalid_label):
+  """Explains (if verbose) why an indexed problem file could not be used"""
+  if not settings.verbose:
+    return
+  if status == INVALID:
+    print color("Error ({}): ".format(invalid_label), color_code(YELLOW)), filename
+  elif status == UNPARSEABLE:
+    print color("Error (XML Parsing): ", color_code(RED, bold=True)), filename
+  elif status == UNREADABLE:
+    print color("Error (Permissions): ", color_code(MAGENTA)), filename
+
+def document_resources(document):
+  resources = set()
+  for version in document.versions:
+    for resource in version.resources:
+      resources.add(resource)
+  return resources
+
+def build_wrapper(document, filename, settings, flags=None, staged=None):
+  """
+  Builds document into filename. flags are the (solutions, rubrics, metadata)
+  to build with, defaulting to the -s, -r and -m flags; staged is passed on 
+  to pdfbuilder.build.
+  """
+  from pdfbuilder import build, build_stitched
+  if flags is None:
+    flags = (settings.solutions, settings.rubrics, settings.metadata)
+  solutions, rubrics, metadata = flags
   filename = os.path.basename(filename)
   if document.versions:
     if filename.endswith(".pdf"):
@@ -74,43 +121,179 @@ def build_wrapper(document, filename, settings):
       assert filename
     else:
       print_warning("Output will be named '{}.pdf'".format(filename))
-      
-    resources = set()
-    for version in document.versions:
-      for resource in version.resources:
-        resources.add(resource)
-    build(document.build(settings.solutions, 
-            settings.rubrics, settings.metadata),
-        resources,
+
+    if settings.fragments:
+      result = build_stitched(document.build_header(stripped=True), 
+          document.parts(solutions, rubrics, metadata, stripped=True), 
+          document_resources(document), filename, settings.keep, 
+          settings.cache, strip=False)
+      if result is not None:
+        return result
+      print_warning("Could not stitch the problems together, building the whole document")
+    source_map = SourceMap()
+    return build(lambda stream: document.write_to(stream, solutions, rubrics,
+            metadata, stripped=True, source_map=source_map),
+        document_resources(document),
         filename,
-        settings.keep)
+        settings.keep,
+        settings.cache,
+        strip=False,
+        staged=staged,
+        source_map=source_map)
   else:
     print_error("No problems were added to the build successfully.")
+    return False
+
+def with_versions(document, versions):
+  """A copy of document with only the given versions"""
+  part = copy(document)
+  part.versions = versions
+  return part
+
+def failing_versions(document, settings, staged):
+  """
+  The versions which stop document from compiling, found by compiling both 
+  halves of every group of versions still suspected at once and narrowing 
+  down to the halves which fail. A group neither of whose halves fails alone
+  is failing as a whole. Returns None if the document fails without any of 
+  its problems.
+  """
+  from pdfbuilder import can_build
+  flags = (settings.solutions, settings.rubrics, settings.metadata)
+  def compiles(versions):
+    part = with_versions(document, versions)
+    return can_build(part.build(*flags, stripped=True), 
+        document_resources(part), staged)
+  pool = ThreadPool(max(2, settings.jobs))
+  try:
+    if not compiles([]):
+      return None
+    failing = []
+    suspects = [document.versions]
+    while suspects:
+      halves = []
+      for versions in suspects:
+        if len(versions) == 1:
+          failing.extend(versions)
+        else:
+          middle = len(versions) // 2
+          halves.append((versions[:middle], versions[middle:]))
+      results = pool.map(compiles, [half for pair in halves for half in pair])
+      suspects = []
+      for i, (first, second) in enumerate(halves):
+        failed = [half for half, succeeded 
+            in zip((first, second), results[2 * i:2 * i + 2]) if not succeeded]
+        if failed:
+          suspects.extend(failed)
+        else:
+          failing.extend(first + second)
+  finally:
+    pool.close()
+    pool.join()
+  return [version for version in document.versions if version in failing]
+
+def bisect_build(document, settings):
+  """
+  After document has failed to build, finds the versions responsible (see 
+  failing_versions) and builds the document without them
+  """
+  from pdfbuilder import stage_resources
+  print_warning("Looking for the problems which stop the document compiling")
+  staged = stage_resources(document_resources(document))
+  if staged is None:
+    return False
+  try:
+    failing = failing_versions(document, settings, staged)
+    if failing is None:
+      print_error("The document does not compile even without its problems")
+      return False
+    if not failing:
+      print_warning("Every part of the document compiles on its own")
+      return False
+    print_error("Left out {} problem(s) which could not be built:".format(
+        len(failing)))
+    for version in failing:
+      print "\t{} (version {})".format(version.filename, version.vid)
+    rest = [version for version in document.versions if version not in failing]
+    return build_wrapper(with_versions(document, rest), settings.filename, 
+        settings, staged=staged)
+  finally:
+    scratch.release(staged)
 
 def build_doc(settings):
   document = Document(settings.document)
   try:
     tree = ET.parse(settings.document)
     document.parse_tree(tree)
-    build_wrapper(document, settings.filename, settings)
+    if settings.variants:
+      build_variants(document, settings)
+    else:
+      build_wrapper(document, settings.filename, settings)
   except (ImproperXmlException, ET.ParseError):
     print_error("Could not parse {}".format(settings.document))
+
+def build_variants(document, settings):
+  """
+  Builds each of settings.variants of an already parsed document at once, 
+  into the output filename suffixed with the variant's name
+  """
+  from pdfbuilder import stage_resources
+  if not document.versions:
+    print_error("No problems were added to the build successfully.")
+    return
+  base = os.path.basename(settings.filename)
+  if base.endswith(".pdf"):
+    base = base[:-4]
+  staged = stage_resources(document_resources(document))
+  if staged is None:
+    return
+  pool = ThreadPool(len(settings.variants))
+  try:
+    results = pool.map(lambda variant: build_wrapper(document, 
+        base + "-" + variant + ".pdf", settings, VARIANTS[variant], staged),
+        settings.variants)
+  finally:
+    pool.close()
+    pool.join()
+    scratch.release(staged)
+  for variant, succeeded in zip(settings.variants, results):
+    if not succeeded:
+      print_error("The {} variant could not be built".format(variant))
     
 def build_each(settings):
+  from pdfbuilder import build_split
   document = Document(settings.document)
   try:
     tree = ET.parse(settings.document)
     document.parse_tree(tree)
 
-    for i,v in enumerate(document.versions):
-      problem_document = Document()
-      problem_document.name = document.name + " Problem " + str(i+1)
-      problem_document.year = "1901"
-      problem_document.due = "Grading"
-      problem_document.blurb = ""
-      problem_document.versions.append(v)
+    filenames = [settings.document[:-4] + "-" + str(i+1) 
+        for i in range(len(document.versions))]
+    if settings.split and document.versions:
+      split = SplitDocument(document)
+      if build_split(lambda stream: split.write_to(stream, settings.solutions,
+              settings.rubrics, settings.metadata, stripped=True),
+          document_resources(document), 
+          os.path.basename(settings.document[:-4]), 
+          map(os.path.basename, filenames), SPLIT_KEY, settings.keep, 
+          settings.cache, strip=False):
+        return
+      print_warning("Could not build the problems together, building them one at a time")
+
+    builds = [(document.problem_document(i), filenames[i] + ".pdf") 
+        for i in range(len(document.versions))]
       
-      build_wrapper(problem_document, settings.document[:-4] + "-" + str(i+1) + ".pdf", settings)
+    # Each build gets its own scratch directory, so they can run side by side
+    pool = ThreadPool(max(1, settings.jobs))
+    try:
+      results = pool.map(lambda (doc, filename): build_wrapper(doc, filename, settings), builds)
+    finally:
+      pool.close()
+      pool.join()
+    for i, succeeded in enumerate(results):
+      if not succeeded:
+        print_error("Problem {} ({}) could not be built".format(i+1, 
+            document.versions[i].filename))
   except (ImproperXmlException, ET.ParseError):
     print_error("Could not parse {}".format(settings.document))
     
@@ -123,96 +306,132 @@ def build_if(settings):
   document.blurb = ""
   
   if os.path.isdir(settings.directory):
-    for dirpath, dirnames, filenames in os.walk(settings.directory):
-      for filename in filenames:
-        if filename.endswith(".xml"):
-          filename = os.path.join(dirpath, filename)
+    index = ProblemIndex(settings.directory)
+    index.refresh(jobs=settings.jobs)
+    candidates = index.text_candidates(settings.todo, settings.grep)
+    corpus = Corpus()
+    problems = []
+    for filename, status, problem in index.problems():
+      versions = []
+      problems.append((filename, status, versions))
+      if status != OK:
+        continue
+      try:
+        currentVersions = []
+        if settings.all:
+          everyVersion = problem.get_versions()
+          currentVersions = [everyVersion[0]] + [v for v in everyVersion[1:] if v.standalone]
+        else:
+          currentVersions = [problem.newest_version()]
+          
+        for version in currentVersions:
           try:
-            tree = ET.parse(filename)
-            problem = Problem(filename)
-            problem.parse_tree(tree, validate_versions=False)
-            
-            currentVersions = []
-            if settings.all:
-              everyVersion = problem.get_versions()
-              currentVersions = [everyVersion[0]] + [v for v in everyVersion[1:] if v.standalone]
-            else:
-              currentVersions = [problem.newest_version()]
-              
-            firstInProblem = settings.all # only use separators if including multiple versions per problem, 
-            for version in currentVersions:
-              try:
-                version.validate()
-                if satisfies(version, settings, problem.used_in):
-                  version.separateFromPrevious = firstInProblem
-                  firstInProblem = False
-                  document.versions.append(version)
-                  if settings.verbose:
-                    print color("Added: ", color_code(GREEN)), filename, "Version {}".format(version.vid)
-                elif settings.verbose:
-                  print color("Skipped (Predicate): ", color_code(CYAN)), filename, "Version {}".format(version.vid)
-              except ImproperXmlException:
-                if settings.verbose:
-                  print color("Error (Validation): ", color_code(YELLOW)), filename, "Version {}".format(version.vid)     
+            version.validate()
+            versions.append((version, corpus.add(version, problem.used_in)))
           except ImproperXmlException:
-            if settings.verbose:
-              print color("Error (Problem Validation): ", color_code(YELLOW)), filename     
-          except ET.ParseError:
-            if settings.verbose:
-              print color("Error (XML Parsing): ", color_code(RED, bold=True)), filename
-          except IOError as e:
-            # Permission errors can be safely skipped
-            if e.errno != errno.EACCES: 
-              print color("Error (IO): ", color_code(RED)), filename
-              raise # TODO
-            elif settings.verbose:
-              print color("Error (Permissions): ", color_code(MAGENTA)), filename
-          except Exception:
-            print_error(filename)
-            raise
-    build_wrapper(document, settings.filename, settings)
+            versions.append((version, None))
+      except Exception:
+        print_error(filename)
+        raise
+        
+    selected = select(corpus, settings, candidates)
+    for filename, status, versions in problems:
+      if status != OK:
+        report_unusable(filename, status, settings, "Problem Validation")
+        continue
+      firstInProblem = settings.all # only use separators if including multiple versions per problem, 
+      for version, position in versions:
+        if position is None:
+          if settings.verbose:
+            print color("Error (Validation): ", color_code(YELLOW)), filename, "Version {}".format(version.vid)     
+        elif selected >> position & 1:
+          version.separateFromPrevious = firstInProblem
+          firstInProblem = False
+          document.versions.append(version)
+          if settings.verbose:
+            print color("Added: ", color_code(GREEN)), filename, "Version {}".format(version.vid)
+        elif settings.verbose:
+          print color("Skipped (Predicate): ", color_code(CYAN)), filename, "Version {}".format(version.vid)
+    if (not build_wrapper(document, settings.filename, settings) and 
+        settings.bisect and document.versions):
+      bisect_build(document, settings)
   else:
     print_error("The directory '{}' does not exist".format(settings.directory))
  
 def build_list(settings):
   if os.path.isdir(get_problem_root()):
-    for dirpath, dirnames, filenames in os.walk(get_problem_root()):
-      for filename in filenames:
-        if filename.endswith(".xml"):
-          filename = os.path.join(dirpath, filename)
-          try:
-            tree = ET.parse(filename)
-            problem = Problem(filename)
-            problem.parse_tree(tree, validate_versions=False)
-            version = problem.newest_version()
-            version.validate()
-            
-            if satisfies(version, settings, problem.used_in):
-              if settings.verbose:
-                print color("Added: ", color_code(GREEN)), filename
-              else:
-                print filename
-            elif settings.verbose:
-              print color("Skipped (Predicate): ", color_code(CYAN)), filename
-          except ImproperXmlException:
-            if settings.verbose:
-              print color("Error (Validation): ", color_code(YELLOW)), filename
-          except ET.ParseError:
-            if settings.verbose:
-              print color("Error (XML Parsing): ", color_code(RED, bold=True)), filename
-          except IOError as e:
-            # Permission errors can be safely skipped
-            if e.errno != errno.EACCES: 
-              print color("Error (IO): ", color_code(RED)), filename
-              raise # TODO
-            elif settings.verbose:
-              print color("Error (Permissions): ", color_code(MAGENTA)), filename
-          except Exception:
-            print_error(filename)
-            raise
+    index = ProblemIndex(get_problem_root())
+    index.refresh(jobs=settings.jobs)
+    candidates = index.text_candidates(settings.todo, settings.grep)
+    corpus = Corpus()
+    problems = []
+    for filename, status, problem in index.problems():
+      position = None
+      if status == OK:
+        try:
+          version = problem.newest_version()
+          version.validate()
+          position = corpus.add(version, problem.used_in)
+        except ImproperXmlException:
+          status = INVALID
+        except Exception:
+          print_error(filename)
+          raise
+      problems.append((filename, status, position))
+      
+    selected = select(corpus, settings, candidates)
+    for filename, status, position in problems:
+      if status != OK:
+        report_unusable(filename, status, settings, "Validation")
+      elif selected >> position & 1:
+        if settings.verbose:
+          print color("Added: ", color_code(GREEN)), filename
+        else:
+          print filename
+      elif settings.verbose:
+        print color("Skipped (Predicate): ", color_code(CYAN)), filename
   else:
     print_error("The directory '{}' does not exist".format(get_problem_root()))
     
+def reindex(settings):
+  if os.path.isdir(settings.directory):
+    index = ProblemIndex(settings.directory)
+    scanned = index.rebuild(jobs=settings.jobs)
+    print "Indexed {} problem files in '{}'".format(scanned, settings.directory)
+  else:
+    print_error("The directory '{}' does not exist".format(settings.directory))
+    
+def server(settings):
+  import compileserver
+  if settings.action == 'start':
+    idle = compileserver.DEFAULT_IDLE_TIMEOUT
+    if settings.idle is not None:
+      idle = settings.idle * 60
+    engines = compileserver.DEFAULT_ENGINES
+    if settings.engines is not None:
+      engines = settings.engines
+    if compileserver.start(idle, engines):
+      print "Started the compile server"
+    else:
+      print_warning("The compile server is already running")
+  elif settings.action == 'stop':
+    if compileserver.stop():
+      print "Stopped the compile server"
+    else:
+      print_warning("The compile server is not running")
+  else:
+    status = compileserver.status()
+    if status is None:
+      print "The compile server is not running"
+    else:
+      print "The compile server (pid {}) has been running for {} seconds".format(
+          status["pid"], status["uptime"])
+      print "\t{} jobs, {} of them on a warm engine".format(
+          status["jobs"], status["warm_jobs"])
+      print "\t{} engines waiting".format(status["engines"])
+      print "\tIdle for {} of {} seconds before shutting down".format(
+          status["idle"], status["timeout"])
+    
 def build_single(settings):
   document = Document("")
   document.name = "".join(settings.title)
@@ -229,11 +448,11 @@ def build_single(settings):
     exit(1)
   
   try:
-    tree = ET.parse(settings.problem)
     problem = Problem(settings.problem)
-    problem.parse_tree(tree, validate_versions=False)
+    problem.parse_file(validate_versions=False)
     version = problem.newest_version()
     version.validate()
+    version.load()
     
     document.versions.append(version)
     
@@ -252,15 +471,15 @@ def build_specific(settings):
   
   for filename in settings.problems:
     try:
-      tree = ET.parse(filename)
       problem = Problem(filename)
-      problem.parse_tree(tree, validate_versions=False)
+      problem.parse_file(validate_versions=False)
       version = problem.newest_version()
       version.validate()
+      version.load()
       
       document.versions.append(version)
     except (ImproperXmlException, ET.ParseError):
-      print_warning("Could not parse {}".format(settings.filename))
+      print_warning("Could not parse {}".format(filename))
       
   build_wrapper(document, settings.filename, settings)
     
@@ -273,15 +492,38 @@ def add_common_flags(subparser, title=True):
       default=False, help='Builds the problems with rubrics')
   subparser.add_argument('-s', dest='solutions', action='store_true', 
       default=False, help='Builds the problems with solutions')
+  subparser.add_argument('--no-cache', dest='cache', action='store_false', 
+      default=True, help='Always runs pdflatex, even if an identical document was built before')
+  subparser.add_argument('--fragments', action='store_true', default=False, 
+      help='Renders the title and each problem (starting on a new page) separately and stitches them together, so that only changed problems are rendered again')
   if title:
     subparser.add_argument('--title', nargs=1, required=False, 
         default="Problem", help='Sets the title of the problem build')
 
+def add_bisect_flag(subparser):
+  subparser.add_argument('--bisect', action='store_true', default=False, 
+      help='If the document fails to compile, finds the problems responsible by compiling halves of it at once, and builds the rest without them')
+
 def add_verbose_flag(subparser):
   subparser.add_argument('--verbose', '-v', action='store_true',
       dest='verbose', default=False,
       help='Prints a verbose description of the files being considered')
     
+def add_jobs_flag(subparser):
+  subparser.add_argument('-j', dest='jobs', type=int, default=1,
+      help='The number of processes used to read problem files')
+    
+def variant_list(text):
+  """Parses a comma separated list of VARIANTS, for --variants"""
+  variants = []
+  for variant in text.split(","):
+    if variant not in VARIANTS:
+      raise argparse.ArgumentTypeError("unknown variant '{}' (choose from {})"
+          .format(variant, ", ".join(sorted(VARIANTS))))
+    if variant not in variants:
+      variants.append(variant)
+  return variants
+
 def add_doc_parser(parser):
   subparser = parser.add_parser('doc', 
       help='Builds a particular assignment XML file into a pdf')
@@ -290,6 +532,8 @@ def add_doc_parser(parser):
       help='The assignment XML file to build')
   subparser.add_argument('filename', metavar='O', 
       help='The destination of the rendered PDF')
+  subparser.add_argument('--variants', type=variant_list, default=None, 
+      help='Builds each of a comma separated list of variants (student, solutions, rubrics and metadata) at once, into O-variant.pdf, instead of using -s, -r and -m')
   add_common_flags(subparser, title=False)
     
 def add_predicate_flags(subparser):
@@ -324,6 +568,10 @@ def add_each_parser(parser):
   subparser.set_defaults(func=build_each)
   subparser.add_argument('document', metavar='D', 
       help='The assignment XML file where each problem is stored')
+  subparser.add_argument('-j', dest='jobs', type=int, default=1,
+      help='The number of problems to build at once')
+  subparser.add_argument('--split', action='store_true', default=False, 
+      help='Builds the whole assignment with one pdflatex run and splits the result, building the problems one at a time only if that fails')
   add_common_flags(subparser)
   
 def add_from_parser(parser):
@@ -335,7 +583,9 @@ def add_from_parser(parser):
   subparser.add_argument('filename', metavar='O', 
       help='The destination of the rendered PDF')
   add_common_flags(subparser)
+  add_jobs_flag(subparser)
   add_predicate_flags(subparser)
+  add_bisect_flag(subparser)
   add_verbose_flag(subparser)
   
 def add_all_parser(parser):
@@ -345,13 +595,16 @@ def add_all_parser(parser):
   subparser.add_argument('filename', metavar='O', 
       help='The destination of the output PDF')
   add_common_flags(subparser)
+  add_jobs_flag(subparser)
   add_predicate_flags(subparser)
+  add_bisect_flag(subparser)
   add_verbose_flag(subparser)
 
 def add_list_parser(parser):
   subparser = parser.add_parser('list', 
       help='Lists all problems that satisfy the given predicates within the problem root directory')
   subparser.set_defaults(func=build_list)
+  add_jobs_flag(subparser)
   add_predicate_flags(subparser)
   add_verbose_flag(subparser)
   
@@ -365,6 +618,26 @@ def add_problem_parser(parser):
       help='The locations of the problems to build')
   add_common_flags(subparser)
 
+def add_reindex_parser(parser):
+  subparser = parser.add_parser('reindex', 
+      help='Rebuilds the index of problems used by all, from and list from scratch')
+  subparser.set_defaults(func=reindex)
+  subparser.add_argument('directory', nargs='?', default=get_problem_root(), 
+      help='The directory to reindex (defaults to the problem root directory)')
+  add_jobs_flag(subparser)
+
+def add_server_parser(parser):
+  subparser = parser.add_parser('server', 
+      help='Starts, stops or checks on a compile server which keeps pdflatex ready for builds')
+  subparser.set_defaults(func=server)
+  subparser.add_argument('action', choices=['start', 'status', 'stop'], 
+      help='What to do with the compile server')
+  # No defaults here, so that compileserver is only imported by server
+  subparser.add_argument('--idle', type=int, 
+      help='The number of minutes without a build before the server stops itself')
+  subparser.add_argument('--engines', type=int, 
+      help='The number of warm pdflatex processes kept ready for each preamble')
+
 def add_single_parser(parser):
   subparser = parser.add_parser('single', 
       help='Builds a single problem XML file into a pdf of the same name')
@@ -386,6 +659,8 @@ def build_args():
   add_from_parser(subparsers)
   add_list_parser(subparsers)
   add_problem_parser(subparsers)
+  add_reindex_parser(subparsers)
+  add_server_parser(subparsers)
   add_single_parser(subparsers)
   
   return parser.parse_args()
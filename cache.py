@@ -0,0 +1,119 @@
+import errno
+import hashlib
+import os
+from config import get_cache_root, get_cache_size
+from shutil import copyfile
+
+# The file in each cache directory which holds the number of bytes stored in
+# it since it was last evicted. It is kept in the directory rather than in
+# memory because most processes only ever store a few files.
+UNEVICTED = "unevicted"
+
+def should_evict(directory, stored):
+  """
+  Whether to evict a cache directory after storing another file in it. Many
+  small files are often stored at once, so this only happens once a 
+  sixteenth of the cache size has been stored since the last time (by any
+  process: concurrent stores may miss each other's bytes, which only delays
+  eviction a little).
+  """
+  path = os.path.join(directory, UNEVICTED)
+  try:
+    with open(path) as f:
+      total = int(f.read()) + stored
+  except (IOError, ValueError):
+    total = stored
+  evict = total >= get_cache_size() / 16
+  if evict:
+    total = 0
+  temporary = path + ".{}.tmp".format(os.getpid())
+  try:
+    with open(temporary, "w") as f:
+      f.write(str(total))
+    os.rename(temporary, path)
+  except (IOError, OSError):
+    # Without a count, evicting every time is the only way to stay bounded
+    return True
+  return evict
+
+def hasher():
+  """The hash used to name everything stored in a Cache"""
+  return hashlib.sha1()
+
+class Cache:
+  """
+  A directory of files, each named by a hash of everything that went into
+  producing it. Whenever something is stored, the least recently used files
+  are discarded until the cache fits within get_cache_size() bytes.
+
+  Caching is only ever an optimization, so a cache which cannot be read or
+  written behaves as if it were empty.
+  """
+  def __init__(self, name, extension):
+    self.directory = os.path.join(get_cache_root(), name)
+    self.extension = extension
+
+  def path(self, key):
+    return os.path.join(self.directory, key + self.extension)
+
+  def lookup(self, key):
+    """The path of the file stored under key, or None if there isn't one"""
+    path = self.path(key)
+    try:
+      # Marks the file as recently used
+      os.utime(path, None)
+    except OSError:
+      return None
+    return path
+
+  def __temporary(self, key):
+    try:
+      os.makedirs(self.directory)
+    except OSError as e:
+      if e.errno != errno.EEXIST: raise
+    return self.path(key) + ".{}.tmp".format(os.getpid())
+
+  def store(self, key, filename):
+    """Copies filename into the cache under key"""
+    try:
+      temporary = self.__temporary(key)
+      copyfile(filename, temporary)
+      os.rename(temporary, self.path(key))
+      if should_evict(self.directory, os.path.getsize(self.path(key))):
+        self.evict()
+    except (IOError, OSError):
+      return False
+    return True
+
+  def store_contents(self, key, contents):
+    """Stores a (byte) string in the cache under key"""
+    try:
+      temporary = self.__temporary(key)
+      with open(temporary, "wb") as f:
+        f.write(contents)
+      os.rename(temporary, self.path(key))
+      if should_evict(self.directory, len(contents)):
+        self.evict()
+    except (IOError, OSError):
+      return False
+    return True
+
+  def evict(self):
+    """Discards the least recently used files until the cache is small enough"""
+    entries = []
+    total = 0
+    for name in os.listdir(self.directory):
+      if not name.endswith(self.extension):
+        continue
+      path = os.path.join(self.directory, name)
+      try: stat_info = os.stat(path)
+      except OSError: continue
+      entries.append((stat_info.st_mtime, stat_info.st_size, path))
+      total = total + stat_info.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+      if total <= get_cache_size():
+        break
+      try: os.remove(path)
+      except OSError: continue
+      total = total - size
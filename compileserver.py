@@ -0,0 +1,283 @@
+import errno
+import json
+import os
+import re
+import socket
+import SocketServer
+import time
+from config import get_cache_root
+from os.path import exists, isabs, isdir, join
+from shutil import copy, move, rmtree
+from subprocess import PIPE, STDOUT, Popen
+from tempfile import mkdtemp
+from threading import Lock, Thread
+
+# How long the server waits without a job before shutting itself down
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+# How many warm engines are kept waiting for each kind of compile
+DEFAULT_ENGINES = 2
+# The only flags pdfbuilder.pdflatex_command gives, so the only ones run
+FORMAT_FLAG = re.compile(r"^-fmt=[\w-]+\Z")
+
+def socket_path():
+  return join(get_cache_root(), "compileserver.sock")
+
+def request(message, timeout=None):
+  """
+  Sends a message to the running compile server and returns its reply, or
+  None if no server is running.
+  """
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    connection.settimeout(timeout)
+    try:
+      connection.connect(socket_path())
+    except socket.error:
+      return None
+    connection.sendall(json.dumps(message) + "\n")
+    reply = connection.makefile('r').readline()
+    if not reply:
+      return None
+    return json.loads(reply)
+  finally:
+    connection.close()
+
+def submit(command, dir):
+  """
+  Asks the compile server to run command (a pdflatex command line whose last
+  argument is a file in dir) in dir. Returns (returncode, output), or None if
+  no server is running and the caller should run the command itself.
+  """
+  try:
+    reply = request({"command": "compile", "args": command, "dir": dir})
+  except (socket.error, ValueError):
+    return None
+  if reply is None or "returncode" not in reply:
+    return None
+  return reply["returncode"], reply["output"].encode('UTF-8')
+
+def status():
+  try:
+    return request({"command": "status"}, timeout=5)
+  except (socket.error, ValueError):
+    return None
+
+def stop():
+  try:
+    return request({"command": "stop"}, timeout=5) is not None
+  except (socket.error, ValueError):
+    return False
+
+def format_name(command):
+  """The name of the format a pdflatex command line loads, or None"""
+  for argument in command:
+    if argument.startswith("-fmt="):
+      return argument[len("-fmt="):]
+  return None
+
+def allowed(command, dir):
+  """
+  Whether command is a pdflatex command line pdfbuilder.pdflatex_command could
+  have made, to be run in the existing directory dir; nothing else is run
+  """
+  if not isinstance(command, list) or len(command) not in (3, 4):
+    return False
+  if not all(isinstance(argument, basestring) for argument in command):
+    return False
+  if command[:2] != ["pdflatex", "-halt-on-error"]:
+    return False
+  if command[-1] != "render.tex":
+    return False
+  if len(command) == 4 and not FORMAT_FLAG.match(command[2]):
+    return False
+  return isinstance(dir, basestring) and isabs(dir) and isdir(dir)
+
+class Engine:
+  """
+  A pdflatex process which has already started (and loaded its format) in its
+  own directory, waiting at the ** prompt for the name of a file to compile
+  """
+  def __init__(self, prefix, formats):
+    self.dir = mkdtemp(prefix="engine.", dir=formats)
+    format = format_name(prefix)
+    if format is not None:
+      copy(join(formats, format + ".fmt"), self.dir)
+    self.process = Popen(list(prefix), stdin=PIPE, stdout=PIPE, stderr=STDOUT,
+        cwd=self.dir)
+
+  def run(self, filename, dir):
+    """
+    Compiles dir/filename by moving the contents of dir into the engine's
+    directory and back again afterwards
+    """
+    moved = [name for name in os.listdir(dir)
+        if not exists(join(self.dir, name))]
+    for name in moved:
+      move(join(dir, name), self.dir)
+    try:
+      output, _ = self.process.communicate(filename + "\n")
+    finally:
+      for name in os.listdir(self.dir):
+        if name in moved or not exists(join(dir, name)):
+          move(join(self.dir, name), dir)
+      self.close()
+    return self.process.returncode, output
+
+  def close(self):
+    if self.process.poll() is None:
+      self.process.kill()
+      self.process.wait()
+    rmtree(self.dir, ignore_errors=True)
+
+class CompileServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """
+  Runs pdflatex jobs for pdfbuilder, keeping engines for every command line it
+  has seen warm so that the next job with the same command skips start up and
+  format loading. Shuts down after idle_timeout seconds without a job.
+  """
+  daemon_threads = True
+
+  def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, engines=DEFAULT_ENGINES):
+    self.idle_timeout = idle_timeout
+    self.engines = engines
+    self.started = time.time()
+    self.last_job = time.time()
+    self.jobs = 0
+    self.warm_jobs = 0
+    self.lock = Lock()
+    self.warm = dict()
+    self.formats = mkdtemp(prefix="compileserver.", dir=get_cache_root())
+    # Never let the socket exist, even briefly, with wider permissions
+    umask = os.umask(0077)
+    try:
+      SocketServer.UnixStreamServer.__init__(self, socket_path(), CompileHandler)
+    finally:
+      os.umask(umask)
+    os.chmod(socket_path(), 0600)
+
+  def __take(self, prefix):
+    with self.lock:
+      self.jobs = self.jobs + 1
+      self.last_job = time.time()
+      engines = self.warm.get(prefix)
+      if engines:
+        self.warm_jobs = self.warm_jobs + 1
+        return engines.pop(0)
+    return None
+
+  def __warm_up(self, prefix, dir):
+    """Starts engines until there are enough waiting for prefix"""
+    format = format_name(prefix)
+    if format is not None and not exists(join(self.formats, format + ".fmt")):
+      if not exists(join(dir, format + ".fmt")):
+        return
+      copy(join(dir, format + ".fmt"), self.formats)
+    while True:
+      with self.lock:
+        engines = self.warm.setdefault(prefix, [])
+        if len(engines) >= self.engines:
+          return
+      try:
+        engine = Engine(prefix, self.formats)
+      except (IOError, OSError):
+        return
+      with self.lock:
+        engines.append(engine)
+
+  def compile(self, command, dir):
+    if not allowed(command, dir):
+      return {"error": "refusing to run {}".format(command)}
+    prefix = tuple(command[:-1])
+    engine = self.__take(prefix)
+    if engine is not None:
+      result = engine.run(command[-1], dir)
+    else:
+      try:
+        process = Popen(command, stdout=PIPE, stderr=STDOUT, cwd=dir)
+        output = process.communicate()[0]
+      except OSError as e:
+        return {"error": str(e)}
+      result = process.returncode, output
+    self.__warm_up(prefix, dir)
+    returncode, output = result
+    return {"returncode": returncode, "output": output.decode('UTF-8', 'replace')}
+
+  def status(self):
+    with self.lock:
+      return {
+        "pid": os.getpid(),
+        "uptime": int(time.time() - self.started),
+        "idle": int(time.time() - self.last_job),
+        "timeout": self.idle_timeout,
+        "jobs": self.jobs,
+        "warm_jobs": self.warm_jobs,
+        "engines": sum(len(engines) for engines in self.warm.itervalues())
+      }
+
+  def watch_idle(self):
+    while time.time() - self.last_job < self.idle_timeout:
+      time.sleep(min(5, self.idle_timeout))
+    self.shutdown()
+
+  def serve(self):
+    watcher = Thread(target=self.watch_idle)
+    watcher.daemon = True
+    watcher.start()
+    try:
+      self.serve_forever()
+    finally:
+      self.server_close()
+      for engines in self.warm.itervalues():
+        for engine in engines:
+          engine.close()
+      rmtree(self.formats, ignore_errors=True)
+      try: os.remove(socket_path())
+      except OSError: pass
+
+class CompileHandler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    try:
+      message = json.loads(self.rfile.readline())
+    except ValueError:
+      return
+    if message.get("command") == "compile":
+      reply = self.server.compile(message.get("args"), message.get("dir"))
+    elif message.get("command") == "status":
+      reply = self.server.status()
+    elif message.get("command") == "stop":
+      reply = {"stopping": True}
+      Thread(target=self.server.shutdown).start()
+    else:
+      reply = {"error": "unknown command"}
+    self.wfile.write(json.dumps(reply) + "\n")
+
+def start(idle_timeout=DEFAULT_IDLE_TIMEOUT, engines=DEFAULT_ENGINES):
+  """
+  Starts a compile server in the background, returning False if one is
+  already running
+  """
+  if status() is not None:
+    return False
+  try:
+    os.makedirs(get_cache_root())
+  except OSError as e:
+    if e.errno != errno.EEXIST: raise
+  # A server which did not shut down cleanly leaves its socket behind
+  try: os.remove(socket_path())
+  except OSError: pass
+  if os.fork() != 0:
+    for _ in range(50):
+      if exists(socket_path()):
+        break
+      time.sleep(0.1)
+    return True
+  os.setsid()
+  if os.fork() != 0:
+    os._exit(0)
+  with open(os.devnull, 'r+') as null:
+    for stream in (0, 1, 2):
+      os.dup2(null.fileno(), stream)
+  try:
+    CompileServer(idle_timeout, engines).serve()
+  finally:
+    os._exit(0)
@@ -1,5 +1,9 @@
 import xml.etree.ElementTree as ET
-from os import getenv, getlogin
+import marshal
+import os
+from os import W_OK, access, getenv, getlogin, getuid
+from os.path import abspath, expanduser, isdir, join, split
+from tempfile import gettempdir
 from parseable import XmlParseable, ImproperXmlException
 import string
 from copy import copy
@@ -11,15 +15,20 @@ class BuildConfiguration(XmlParseable):
   def __init__(self, filename=None):
     self.filename = filename
     self.author = None
+    self.cache = None
+    self.cachesize = None
     self.topics = []
     self.types = []
     self.private_types = []
     self.blurb = None
     self.classname = None
     self.include = []
+    # The file_signature of each include, from before it was read
+    self.included = []
     self.problemroot = None
     self.professor = None
     self.resourceroot = None
+    self.scratch = None
     self.shortname = None
     
   def __parse_author(self, attributes, body):
@@ -32,6 +41,20 @@ class BuildConfiguration(XmlParseable):
     self.xml_assert(self.blurb is None, "duplicate blurb tag")
     self.blurb = body
     
+  def __parse_cache(self, attributes, body):
+    self.xml_assert(not attributes, "cache tag should have no attributes")
+    self.xml_assert(body, "cache tag must have a body")
+    self.xml_assert(self.cache is None, "duplicate cache tag")
+    self.cache = string.strip(body)
+    
+  def __parse_cachesize(self, attributes, body):
+    self.xml_assert(not attributes, "cachesize tag should have no attributes")
+    self.xml_assert(body, "cachesize tag must have a body")
+    self.xml_assert(self.cachesize is None, "duplicate cachesize tag")
+    try: self.cachesize = int(body)
+    except ValueError:
+      self.xml_assert(False, "cachesize must be a number of megabytes")
+    
   def __parse_classname(self, attributes, body):
     self.xml_assert(not attributes, "classname tag should have no attributes")
     self.xml_assert(body, "classname tag must have a body")
@@ -42,9 +65,10 @@ class BuildConfiguration(XmlParseable):
     self.xml_assert(not attributes, "include tag should have no attributes")
     self.xml_assert(body, "include tag must have a body")
     try:
+      self.included.append(file_signature(string.strip(body)))
       with open(string.strip(body)) as f:
         self.include.append(''.join(f.readlines()))
-    except IOError:
+    except (IOError, OSError):
       raise ConfigurationError("Could not include {}".format(body))
       
   def __parse_private_types(self, attributes, body):
@@ -71,6 +95,12 @@ class BuildConfiguration(XmlParseable):
     self.xml_assert(self.resourceroot is None, "duplicate resourceroot tag")
     self.resourceroot = string.strip(body)
     
+  def __parse_scratch(self, attributes, body):
+    self.xml_assert(not attributes, "scratch tag should have no attributes")
+    self.xml_assert(body, "scratch tag must have a body")
+    self.xml_assert(self.scratch is None, "duplicate scratch tag")
+    self.scratch = string.strip(body)
+    
   def __parse_shortname(self, attributes, body):
     self.xml_assert(not attributes, "shortname tag should have no attributes")
     self.xml_assert(body, "shortname tag must have a body")
@@ -90,12 +120,15 @@ class BuildConfiguration(XmlParseable):
   __parsers = {
     'author':__parse_author,
     'blurb':__parse_blurb,
+    'cache':__parse_cache,
+    'cachesize':__parse_cachesize,
     'classname':__parse_classname,
     'include':__parse_include,
     'private_types':__parse_private_types,
     'problemroot':__parse_problemroot,
     'professor':__parse_professor,
     'resourceroot':__parse_resourceroot,
+    'scratch':__parse_scratch,
     'shortname':__parse_shortname,
     'topics':__parse_topics,
     'types':__parse_types}
@@ -119,31 +152,133 @@ class BuildConfiguration(XmlParseable):
     self.xml_assert(self.blurb is not None, "No blurb")
     self.xml_assert(self.problemroot is not None, "No problemroot")
     
+def file_signature(path):
+  """Identifies the contents of the file at path, until it is changed or moved"""
+  stat_info = os.stat(path)
+  return (path, abspath(path), stat_info.st_size, stat_info.st_mtime)
+
+# Parsing the configuration (and reading the files it includes) is a large 
+# part of every short command, so each configuration is kept parsed in a 
+# cache file beside it, which is used for as long as neither the 
+# configuration nor any of its includes change. It is written with marshal,
+# which (unlike pickle) can't run code from a file someone else can write.
+
+# Changed whenever the fields of BuildConfiguration do, so that old caches
+# aren't used
+CACHE_VERSION = 1
+
+def cache_path(filename):
+  """Where the parsed configuration in filename is cached"""
+  directory, name = split(abspath(filename))
+  return join(directory, "." + name + ".cache")
+
+def cached_configuration(filename):
+  """The cached BuildConfiguration in filename, or None if it is out of date"""
+  try:
+    with open(cache_path(filename), "rb") as f:
+      version, signature, fields = marshal.load(f)
+    if (version != CACHE_VERSION or 
+        signature != file_signature(filename) or
+        [file_signature(included[0]) for included in fields["included"]] != 
+          fields["included"]):
+      return None
+  except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+    return None
+  configuration = BuildConfiguration(filename)
+  for name, value in fields.iteritems():
+    setattr(configuration, name, value)
+  return configuration
+
+def parse_configuration(filename):
+  """Parses and validates the BuildConfiguration in filename, caching it"""
+  try: signature = file_signature(filename)
+  except OSError:
+    raise ConfigurationError("No such configuration file {}".format(filename))
+  configuration = BuildConfiguration(filename)
+  try: config_tree = ET.parse(filename)
+  except IOError: 
+    raise ConfigurationError("No such configuration file {}".format(filename))
+  except ET.ParseError as p:
+    raise ImproperXmlException("Could not parse XML: {}".format(p.strerror))
+    
+  configuration.parse_tree(config_tree)
+  configuration.validate()
+
+  fields = dict((name, value) for name, value in vars(configuration).iteritems()
+      if name != 'filename')
+  # Written to a temporary file first, so that no process reads half of it
+  path = cache_path(filename)
+  temporary = path + ".{}.tmp".format(os.getpid())
+  try:
+    with open(temporary, "wb") as f:
+      marshal.dump((CACHE_VERSION, signature, fields), f)
+    os.rename(temporary, path)
+  except (IOError, OSError, ValueError):
+    try: os.remove(temporary)
+    except OSError: pass
+  return configuration
+
 __configuration = None
 
 def __build_configuration():
   global __configuration
   
-  if getenv('LATEXML_CONFIG') is None:
+  filename = getenv('LATEXML_CONFIG')
+  if filename is None:
     raise ConfigurationError("No configuration file found in environment variable LATEXML_CONFIG")
-  __configuration = BuildConfiguration(getenv('LATEXML_CONFIG'))
-  try: config_tree = ET.parse(__configuration.filename)
-  except IOError: 
-    raise ConfigurationError("No such configuration file {}".format(getenv('LATEXML_CONFIG')))
-  except ET.ParseError as p:
-    raise ImproperXmlException("Could not parse XML: {}".format(p.strerror))
-    
-  __configuration.parse_tree(config_tree)
-  __configuration.validate()
+  configuration = cached_configuration(filename)
+  if configuration is None:
+    configuration = parse_configuration(filename)
+  __configuration = configuration
 
 def get_configuration():
   if __configuration is None:
     __build_configuration()
   return __configuration
+
+# Frozen sets of the configured topics, types and private types, along with
+# the lists they were made from, so that they are only made again once the
+# configuration is reloaded (or one of those lists is replaced)
+__vocabulary = None
+
+def __frozen_vocabulary():
+  global __vocabulary
+  configuration = get_configuration()
+  lists = (configuration.topics, configuration.types, 
+      configuration.private_types)
+  if (__vocabulary is None or __vocabulary[0] is not lists[0] or
+      __vocabulary[1] is not lists[1] or __vocabulary[2] is not lists[2]):
+    __vocabulary = lists + tuple(frozenset(words) for words in lists)
+  return __vocabulary
+
+def get_topic_set():
+  """The configured topics, as a frozenset which must not be changed"""
+  return __frozen_vocabulary()[3]
+
+def get_type_set():
+  """The configured types, as a frozenset which must not be changed"""
+  return __frozen_vocabulary()[4]
+
+def get_private_type_set():
+  """The configured private types, as a frozenset which must not be changed"""
+  return __frozen_vocabulary()[5]
   
 def get_blurb():
   return get_configuration().blurb
   
+def get_cache_root():
+  cache = get_configuration().cache
+  if cache is None:
+    return expanduser("~/.22cache")
+  return expanduser(cache)
+  
+def get_cache_size():
+  """The maximum size of each cache, in bytes"""
+  cachesize = get_configuration().cachesize
+  if cachesize is None:
+    return 256 * 1024 * 1024
+  return cachesize * 1024 * 1024
+  
 def get_classname():
   classname = get_configuration().classname
   if classname is None:
@@ -174,6 +309,18 @@ def get_professor():
 def get_resource_root():
   return get_configuration().resourceroot
   
+def get_scratch_root():
+  """
+  Where pdflatex is run: in memory (in /dev/shm) if possible, unless a 
+  scratch directory is configured
+  """
+  scratch = get_configuration().scratch
+  if scratch is not None:
+    return expanduser(scratch)
+  if isdir("/dev/shm") and access("/dev/shm", W_OK):
+    return join("/dev/shm", "22scratch-" + str(getuid()))
+  return join(gettempdir(), "22scratch-" + str(getuid()))
+  
 def get_shortname():
   shortname = get_configuration().shortname
   if shortname is None:
@@ -0,0 +1,91 @@
+from config import get_private_type_set
+
+def members(mask):
+  """Yields the position of every set bit in mask, in increasing order"""
+  while mask:
+    lowest = mask & -mask
+    yield lowest.bit_length() - 1
+    mask = mask ^ lowest
+
+class Corpus:
+  """
+  A column-oriented view of many Versions, used to evaluate the build
+  predicates over all of them at once. Each Version is given a position, and
+  every topic, type, author, year written and year used maps to a bitset (a
+  python long) with the bit at that position set if the Version has it.
+  """
+  def __init__(self):
+    self.versions = []
+    self.used_ins = []
+    self.topics = dict()
+    self.types = dict()
+    self.authors = dict()
+    self.written = dict()
+    self.used = dict()
+    self.used_publicly = dict()
+    self.unused = 0
+
+  def __set(self, column, key, bit):
+    column[key] = column.get(key, 0) | bit
+
+  def add(self, version, used_ins):
+    """Adds a Version (used in used_ins) to the corpus, returning its position"""
+    position = len(self.versions)
+    bit = 1 << position
+    self.versions.append(version)
+    self.used_ins.append(used_ins)
+    for topic in version.topics:
+      self.__set(self.topics, topic, bit)
+    for type in version.types:
+      self.__set(self.types, type, bit)
+    for author in version.authors:
+      self.__set(self.authors, author, bit)
+    self.__set(self.written, version.year, bit)
+    for usedin in used_ins:
+      self.__set(self.used, usedin.year, bit)
+      if not usedin.private:
+        self.__set(self.used_publicly, usedin.year, bit)
+    if not used_ins:
+      self.unused = self.unused | bit
+    return position
+
+  def everything(self):
+    return (1 << len(self.versions)) - 1
+
+  def __any(self, column, keys):
+    mask = 0
+    for key in keys:
+      mask = mask | column.get(key, 0)
+    return mask
+
+  def select(self, settings):
+    """
+    The bitset of every Version which satisfies the topic, type, year, usedin
+    and author predicates in settings (but not --todo or --grep, which need
+    the text of each Version).
+    """
+    selected = self.everything()
+    if settings.allowed_topics:
+      selected = selected & ~self.__any(self.topics,
+          [topic for topic in self.topics if topic not in settings.allowed_topics])
+    if settings.required_topics:
+      selected = selected & self.__any(self.topics, settings.required_topics)
+    if settings.required_types:
+      selected = selected & self.__any(self.types, settings.required_types)
+    if settings.written:
+      selected = selected & self.__any(self.written, settings.written)
+    if settings.used_in:
+      used = self.__any(self.used, settings.used_in)
+      if "none" in settings.used_in:
+        used = used | self.unused
+      selected = selected & used
+    if settings.not_used_in:
+      # Private types (like private usedins) don't count as having been used
+      private = self.__any(self.types, get_private_type_set())
+      used = self.__any(self.used_publicly, settings.not_used_in) & ~private
+      if "none" in settings.not_used_in:
+        used = used | self.unused
+      selected = selected & ~used
+    if settings.authors:
+      selected = selected & self.__any(self.authors, settings.authors)
+    return selected
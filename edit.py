@@ -2,18 +2,17 @@ import argparse
 import errno
 import os
 import re
+import resources
 import stat
 import string
 import xml.etree.ElementTree as ET
+from index import ProblemIndex, OK
 from problem import Problem, Version, UsedIn, Document
 from parseable import ImproperXmlException
 from config import get_default_author, get_problem_root, get_resource_root, get_topics, get_types
-from copy import deepcopy
+from copy import copy, deepcopy
 from datetime import date
 from color import *
-from subprocess import call
-from random import randint
-from pdfbuilder import can_build
 from grp import getgrgid
 from sys import platform
 
@@ -234,10 +233,8 @@ def edit(settings):
     exit(1)
     
   if settings.remove_todo:
-    if "todo" in version.topics:
-      version.topics.remove("todo")
-    if "todo" in version.types:
-      version.types.remove("todo")
+    version.topics = [t for t in version.topics if t != "todo"]
+    version.types = [t for t in version.types if t != "todo"]
     
   print color_code(CYAN), "SELECT TYPES\n-------------", CLEAR_COLOR
   version.topics = interactive_select(get_topics(), version.topics)
@@ -258,7 +255,41 @@ class ValidationResult:
     self.code_quality = 3
     self.render = 3
     
-def validate_version(version, failed):
+def check_renders(versions):
+  """
+  Checks whether the body, solution and rubric of each version compile when
+  rendered as the body of a document, returning a (body, solution, rubric) 
+  triple of results for each version. Versions which share a header and 
+  resources are checked in one batch.
+  """
+  from pdfbuilder import can_build_fragments
+  batches = dict()
+  for i, version in enumerate(versions):
+    test_document = Document("Validation Render")
+    test_document.name = "Temp"
+    test_document.year = "1900"
+    test_document.due = "Never"
+    test_document.blurb = ""
+    for field in [version.body, version.solution, version.rubric]:
+      fragment = copy(version)
+      fragment.body = field
+      test_document.versions = [fragment]
+      key = (test_document.build_header(), tuple(sorted(set(version.resources))))
+      batches.setdefault(key, []).append(
+          (i, test_document.build_body(False, False, metadata=False)))
+  results = [[] for _ in versions]
+  for (header, resources), fragments in batches.iteritems():
+    built = can_build_fragments(header, [body for i, body in fragments], 
+        list(resources))
+    for (i, body), compiles in zip(fragments, built):
+      results[i].append(compiles)
+  return map(tuple, results)
+    
+def validate_version(version, failed, renders=None):
+  """
+  Prints whether a version is valid, well-styled and compiles. renders can
+  be this version's result from check_renders, if it has already been run.
+  """
   result = ValidationResult(failed)
   
   if "unknown" in map(str.lower, version.authors):
@@ -291,15 +322,15 @@ def validate_version(version, failed):
     print_error("This problem has resources, but your system is not configured with a resource root.")
     result.failed = True
     result.render = 0
-  elif version.resources and not os.path.exists(get_resource_root()):
+  elif version.resources and resources.listing() is None:
     print_error("Resource root `{}' does not exist".format(get_resource_root()))
     result.failed = True
     result.render = 0
   elif version.resources:
     for resource in version.resources:
-      resource_path = os.path.join(get_resource_root(), resource)
-      if not os.path.exists(resource_path):
-        print_warning("Resource at `{}' could not be found.".format(resource_path))
+      if not resources.exists(resource):
+        print_warning("Resource at `{}' could not be found.".format(
+            os.path.join(get_resource_root(), resource)))
         result.failed = True
         result.render = 0
         
@@ -320,23 +351,16 @@ def validate_version(version, failed):
     print color("This version needs work", color_code(YELLOW))
     result.completeness = False
   
-  test_document = Document("Validation Render")
-  test_document.name = "Temp"
-  test_document.year = "1900"
-  test_document.due = "Never"
-  test_document.blurb = ""
-  test_document.versions.append(version)
+  if renders is None:
+    renders = check_renders([version])[0]
+  built_body, built_sol, built_rub = renders
   
-  if can_build(test_document.build(False, False, metadata=False),
-      version.resources):
+  if built_body:
     print color("Body LaTeX compiles", color_code(GREEN))
   else:
     print color("Body LaTeX does not compile", color_code(RED))
     result.render = result.render - 1
     
-  version.body = version.solution
-  built_sol = can_build(test_document.build(False, False, metadata=False),
-      version.resources)
   todo_sol = "TODO" in version.solution
   if built_sol and not todo_sol:
     print color("Solution LaTeX compiles", color_code(GREEN))
@@ -356,9 +380,6 @@ def validate_version(version, failed):
     result.completeness = False
     result.solutions = 0
   
-  version.body = version.rubric
-  built_rub = can_build(test_document.build(False, False, metadata=False),
-      version.resources)
   todo_rub = "TODO" in version.rubric
   if built_rub and not todo_rub:
     print color("Rubric LaTeX compiles", color_code(GREEN))
@@ -447,15 +468,13 @@ def validate(settings):
     print color("\nPlease rerun validation after fixing", color_code(CYAN))
     exit(1)
     
-  firstProblem = True
-  for version in problem.get_versions():
-    if not version.standalone and not firstProblem:
-      continue
-    firstProblem = False
-    
+  everyVersion = problem.get_versions()
+  currentVersions = everyVersion[:1] + [v for v in everyVersion[1:] if v.standalone]
+  renders = check_renders(currentVersions)
+  for version, rendered in zip(currentVersions, renders):
     print color("\n\nVERSION {}:\n".format(version.vid),
               color_code(BLUE))
-    validate_version(version, failed)
+    validate_version(version, failed, rendered)
     
 def validate_document(settings):
   """
@@ -520,10 +539,11 @@ def validate_document(settings):
     print color("\nPlease rerun validation after fixing", color_code(CYAN))
     exit(1)
     
+  renders = check_renders(document.versions)
   for i, version in enumerate(document.versions):
     print color("\n\nProblem {}: {}\n".format(i+1, version.filename),
               color_code(BLUE))
-    validate_version(version, failed)
+    validate_version(version, failed, renders[i])
       
 def report_card(settings):
   grading = settings.author
@@ -537,45 +557,33 @@ def report_card(settings):
   
   root = get_problem_root()
   if os.path.isdir(root):
-    for dirpath, dirnames, filenames in os.walk(root):
-      for filename in filenames:
-        if filename.endswith(".xml"):
-          filename = os.path.join(dirpath, filename)
-          try:
-            tree = ET.parse(filename)
-            problem = Problem(filename)
-            problem.parse_tree(tree, validate_versions=False)
-            
-            everyVersion = problem.get_versions()
-            currentVersions = [everyVersion[0]] + [v for v in everyVersion[1:] if v.standalone]
-            for version in currentVersions:
-              try:
-                if grading in version.authors:
-                  count = count + 1
-                  print color("\n\nProblem {}\n\t{} ver{}".format(count, filename, version.vid),
-                            color_code(BLUE))
-                  result = validate_version(version, False)
-                  if not result.failed:
-                    validates = validates + 1
-                  if result.completeness:
-                    complete = complete + 1
-                  solutions = solutions + result.solutions
-                  rubrics = rubrics + result.rubrics
-                  code_quality = code_quality + result.code_quality
-                  rendering = rendering + result.render
-              except ImproperXmlException:
-                pass 
-          except ImproperXmlException:
-            pass   
-          except ET.ParseError:
-            pass
-          except IOError as e:
-            # Permission errors can be safely skipped
-            if e.errno != errno.EACCES: 
-              print color("Error (IO): ", color_code(RED)), filename
-              raise # TODO
-          except Exception:
-            raise
+    index = ProblemIndex(root)
+    index.refresh(jobs=settings.jobs)
+    graded = []
+    for filename, status, problem in index.problems():
+      if status != OK:
+        continue
+      everyVersion = problem.get_versions()
+      currentVersions = [everyVersion[0]] + [v for v in everyVersion[1:] if v.standalone]
+      graded.extend((filename, version) for version in currentVersions 
+          if grading in version.authors)
+    renders = check_renders([version for filename, version in graded])
+    for (filename, version), rendered in zip(graded, renders):
+      try:
+        count = count + 1
+        print color("\n\nProblem {}\n\t{} ver{}".format(count, filename, version.vid),
+                  color_code(BLUE))
+        result = validate_version(version, False, rendered)
+        if not result.failed:
+          validates = validates + 1
+        if result.completeness:
+          complete = complete + 1
+        solutions = solutions + result.solutions
+        rubrics = rubrics + result.rubrics
+        code_quality = code_quality + result.code_quality
+        rendering = rendering + result.render
+      except ImproperXmlException:
+        pass 
             
     if count > 0:
       print color("\n\nREPORT CARD: {}\n--------------------\n".format(grading), 
@@ -602,6 +610,43 @@ def report_card(settings):
   
    
 
+def resource_report(settings):
+  """
+  Lists the resources which problems use but which don't exist, and those
+  which no problem uses
+  """
+  files = resources.listing()
+  if files is None:
+    print_error("Resource root `{}' does not exist".format(get_resource_root()))
+    return
+  root = get_problem_root()
+  if not os.path.isdir(root):
+    print_error("The directory '{}' does not exist".format(root))
+    return
+  index = ProblemIndex(root)
+  index.refresh(jobs=settings.jobs)
+  used_by = dict()
+  for filename, status, problem in index.problems():
+    if status != OK:
+      continue
+    for version in problem.versions.itervalues():
+      for resource in version.resources:
+        used_by.setdefault(os.path.normpath(resource), []).append(
+            (filename, version.vid))
+        
+  dangling = sorted(resource for resource in used_by 
+      if resource not in files and not resources.exists(resource))
+  unreferenced = sorted(resource for resource in files if resource not in used_by)
+  print color("Dangling resources ({}):".format(len(dangling)), color_code(RED))
+  for resource in dangling:
+    print "\t" + resource
+    for filename, vid in used_by[resource]:
+      print "\t\tused by {} ver{}".format(filename, vid)
+  print color("Unreferenced resources ({}):".format(len(unreferenced)), 
+      color_code(YELLOW))
+  for resource in unreferenced:
+    print "\t{} ({} bytes)".format(resource, files[resource][0])
+
 def add_branch_parser(parser):
   subparser = parser.add_parser('branch', help='Adds a new version to an XML file')
   subparser.add_argument('filename', metavar='F', help='The XML file to create, edit, or validate')
@@ -620,6 +665,8 @@ def add_grade_parser(parser):
   subparser = parser.add_parser('report_card', 
       help='Renders your report card')
   subparser.add_argument('author', nargs='?', default=get_default_author())
+  subparser.add_argument('-j', dest='jobs', type=int, default=1,
+      help='The number of processes used to read problem files')
   subparser.set_defaults(func=report_card)
   
 def add_new_parser(parser):
@@ -634,6 +681,13 @@ def add_edit_parser(parser):
   subparser.add_argument('filename', metavar='F', help='The XML file to create, edit, or validate')  
   subparser.add_argument('--remove-todo', dest='remove_todo', action='store_true', default=False, help='Removes the todo topic and type automatically, if present')
   
+def add_resources_parser(parser):
+  subparser = parser.add_parser('resources', 
+      help='Lists missing resources which problems use, and resources which no problem uses')
+  subparser.add_argument('-j', dest='jobs', type=int, default=1,
+      help='The number of processes used to read problem files')
+  subparser.set_defaults(func=resource_report)
+  
 def add_validate_parser(parser):
   subparser = parser.add_parser('validate', help='Validates the correctness of a problem XML file')
   subparser.add_argument('filename', metavar='F', help='The XML file to create, edit, or validate')
@@ -655,6 +709,7 @@ def build_args():
   add_finalize_parser(subparsers)
   add_grade_parser(subparsers)
   add_new_parser(subparsers)
+  add_resources_parser(subparsers)
   add_validate_parser(subparsers)
   add_validate_document_parser(subparsers)
   
@@ -0,0 +1,317 @@
+import errno
+import json
+import os
+import sqlite3
+from color import *
+from functools import partial
+from problem import TEXT_FIELDS, Problem, Version, UsedIn
+from scanner import scan, OK, INVALID, UNPARSEABLE, UNREADABLE, UNREAD, TOKEN
+from threading import Lock
+
+INDEX_FILENAME = ".22index.db"
+SCHEMA_VERSION = 2
+# How long to wait for someone else's refresh of a shared index, in seconds
+INDEX_TIMEOUT = 30
+# How many changed files are written to the index in each transaction
+BATCH_SIZE = 50
+
+def _text(raw):
+  """
+  Used as the sqlite text factory so that strings come back the same way
+  ElementTree gives them to us: str when ASCII, unicode otherwise.
+  """
+  return _ascii(raw.decode('UTF-8'))
+
+def _ascii(text):
+  try: return str(text)
+  except UnicodeEncodeError: return text
+
+def _split(raw):
+  return raw.split() if raw else []
+
+class ProblemIndex:
+  """
+  A persistent cache of every problem file beneath a directory, stored in an
+  sqlite database within that directory. Each file is only re-parsed if its
+  modification time or size has changed since it was last indexed.
+  The TEXT_FIELDS of the versions it gives out are only read from it when 
+  they are used (see Version.defer), from whichever thread uses them.
+  """
+  def __init__(self, directory):
+    self.directory = directory
+    self.filename = os.path.join(directory, INDEX_FILENAME)
+    self.paths = []
+    self.unreadable = set()
+    self.lock = Lock()
+    self.in_memory = False
+    self.connection = self.__connect()
+
+  def __connect(self):
+    created = not os.path.exists(self.filename)
+    try:
+      connection = sqlite3.connect(self.filename, timeout=INDEX_TIMEOUT,
+          check_same_thread=False)
+      connection.text_factory = _text
+      version = connection.execute("PRAGMA user_version").fetchone()[0]
+      if version != SCHEMA_VERSION:
+        self.__create_schema(connection)
+    except sqlite3.Error:
+      # Can't write next to the problems: keep a throwaway index instead
+      return self.__throwaway()
+    if created:
+      try: os.chmod(self.filename, 0660)
+      except OSError: pass
+    return connection
+
+  def __throwaway(self):
+    """An empty index in memory, for when the one on disk can't be written"""
+    self.in_memory = True
+    connection = sqlite3.connect(":memory:", check_same_thread=False)
+    connection.text_factory = _text
+    self.__create_schema(connection)
+    return connection
+
+  def __create_schema(self, connection):
+    with connection:
+      connection.executescript("""
+        DROP TABLE IF EXISTS problems;
+        DROP TABLE IF EXISTS versions;
+        DROP TABLE IF EXISTS usedin;
+        DROP TABLE IF EXISTS tokens;
+        DROP TABLE IF EXISTS postings;
+        CREATE TABLE problems (path TEXT PRIMARY KEY, mtime REAL,
+            size INTEGER, status TEXT);
+        CREATE TABLE versions (path TEXT, vid INTEGER, standalone INTEGER,
+            year TEXT, authors TEXT, topics TEXT, types TEXT, params TEXT,
+            deps TEXT, resources TEXT, body TEXT, solution TEXT, rubric TEXT,
+            PRIMARY KEY (path, vid));
+        CREATE TABLE usedin (path TEXT, position INTEGER, year TEXT,
+            name TEXT, private INTEGER);
+        CREATE INDEX usedin_path ON usedin (path);
+        CREATE TABLE tokens (id INTEGER PRIMARY KEY, token TEXT UNIQUE);
+        CREATE TABLE postings (token INTEGER, path TEXT, vid INTEGER,
+            field TEXT);
+        CREATE INDEX postings_token ON postings (token);
+        CREATE INDEX postings_path ON postings (path);
+        PRAGMA user_version = {};""".format(SCHEMA_VERSION))
+
+  def __walk(self):
+    """Lists every problem file beneath the directory, in os.walk order"""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(self.directory):
+      for filename in filenames:
+        if filename.endswith(".xml"):
+          paths.append(os.path.join(dirpath, filename))
+    return paths
+
+  def __forget(self, path):
+    self.connection.execute("DELETE FROM problems WHERE path = ?", (path,))
+    self.connection.execute("DELETE FROM versions WHERE path = ?", (path,))
+    self.connection.execute("DELETE FROM usedin WHERE path = ?", (path,))
+    self.connection.execute("DELETE FROM postings WHERE path = ?", (path,))
+
+  def __token_id(self, token):
+    row = self.connection.execute("SELECT id FROM tokens WHERE token = ?",
+        (token,)).fetchone()
+    if row is not None:
+      return row[0]
+    return self.connection.execute("INSERT INTO tokens (token) VALUES (?)",
+        (token,)).lastrowid
+
+  def __store(self, path, stat_info, status, problem=None, tokens=None):
+    self.__forget(path)
+    self.connection.execute("INSERT INTO problems VALUES (?, ?, ?, ?)",
+        (path, stat_info.st_mtime, stat_info.st_size, status))
+    if problem is None:
+      return
+    for version in problem.versions.itervalues():
+      self.connection.execute(
+          "INSERT INTO versions VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+          (path, version.vid, version.standalone, version.year,
+          " ".join(version.authors), " ".join(version.topics),
+          " ".join(version.types), json.dumps(version.params),
+          " ".join(version.deps), json.dumps(version.resources),
+          version.body, version.solution, version.rubric))
+    for position, usedin in enumerate(problem.used_in):
+      self.connection.execute("INSERT INTO usedin VALUES (?, ?, ?, ?, ?)",
+          (path, position, usedin.year, usedin.assignment_name,
+          usedin.private))
+    for (vid, field), found in (tokens or dict()).iteritems():
+      self.connection.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)",
+          [(self.__token_id(token), path, vid, field) for token in found])
+
+  def refresh(self, everything=False, jobs=1):
+    """
+    Brings the index up to date with the directory, re-parsing only the files
+    which have changed (or every file, if everything is set) across jobs
+    processes. Returns the number of files which were parsed. If the index
+    can't be written (it is read only, or someone else's refresh holds it for
+    too long), every file is parsed into a throwaway index instead.
+    """
+    try:
+      return self.__refresh(everything, jobs)
+    except sqlite3.OperationalError as e:
+      if self.in_memory:
+        raise
+      print_warning("Could not update {} ({}), so reading every problem "
+          "again".format(self.filename, e))
+      self.connection = self.__throwaway()
+      return self.__refresh(True, jobs)
+
+  def __refresh(self, everything, jobs):
+    known = dict()
+    if not everything:
+      for path, mtime, size in self.connection.execute(
+          "SELECT path, mtime, size FROM problems"):
+        known[path] = (mtime, size)
+
+    self.paths = self.__walk()
+    self.unreadable = set()
+    changed = []
+    stat_infos = dict()
+    for path in self.paths:
+      try:
+        stat_info = os.stat(path)
+      except OSError as e:
+        if e.errno != errno.EACCES:
+          print color("Error (IO): ", color_code(RED)), path
+          raise # TODO
+        self.unreadable.add(path)
+        continue
+      if known.get(path) != (stat_info.st_mtime, stat_info.st_size):
+        changed.append(path)
+        stat_infos[path] = stat_info
+    
+    with self.connection:
+      for path in (set(known) - set(self.paths)) | self.unreadable:
+        self.__forget(path)
+    # Committed a few files at a time, so that others sharing the index only
+    # ever wait for one batch
+    results = scan(changed, jobs=jobs)
+    for start in xrange(0, len(results), BATCH_SIZE):
+      with self.connection:
+        for result in results[start:start + BATCH_SIZE]:
+          if result.status == UNREAD:
+            print color("Error (IO): ", color_code(RED)), result.filename
+            raise result.error # TODO
+          elif result.status == UNREADABLE:
+            self.__forget(result.filename)
+            self.unreadable.add(result.filename)
+          else:
+            self.__store(result.filename, stat_infos[result.filename],
+                result.status, result.problem, result.tokens)
+    return len(changed) - len(self.unreadable.intersection(changed))
+
+  def rebuild(self, jobs=1):
+    """Discards everything in the index and re-parses every problem file"""
+    return self.refresh(everything=True, jobs=jobs)
+
+  def __postings(self, word, fields):
+    """
+    The (path, version id, field) of each field which might contain word,
+    or None if the word has no tokens to narrow the search with.
+    """
+    word = word.lower()
+    pieces = list(TOKEN.finditer(word))
+    if not pieces:
+      return None
+    field_list = ", ".join("?" * len(fields))
+    found = None
+    for piece in pieces:
+      # A piece touching either end of the word may be part of a longer token
+      pattern = piece.group(0)
+      if piece.start() == 0:
+        pattern = "%" + pattern
+      if piece.end() == len(word):
+        pattern = pattern + "%"
+      comparison = "LIKE" if "%" in pattern else "="
+      rows = set(self.connection.execute("SELECT p.path, p.vid, p.field "
+          "FROM postings p JOIN tokens t ON p.token = t.id "
+          "WHERE t.token {} ? AND p.field IN ({})".format(comparison, field_list),
+          [pattern] + list(fields)))
+      found = rows if found is None else found & rows
+      if not found:
+        break
+    return found
+
+  def text_candidates(self, todo=False, grep=None):
+    """
+    Uses the token index to find the (path, version id) of every version which
+    might satisfy the --todo and --grep predicates, which still need to be
+    checked against the full text. Returns None if the index can't narrow
+    the search at all.
+    """
+    searches = []
+    if todo:
+      searches.append(("todo", ('solution', 'rubric')))
+    for word in grep or []:
+      searches.append((word, TEXT_FIELDS))
+    candidates = None
+    for word, fields in searches:
+      postings = self.__postings(word, fields)
+      if postings is None:
+        continue
+      versions = set((path, vid) for path, vid, field in postings)
+      candidates = versions if candidates is None else candidates & versions
+    return candidates
+
+  def __load_text(self, path, vid):
+    with self.lock:
+      return self.connection.execute("SELECT body, solution, rubric "
+          "FROM versions WHERE path = ? AND vid = ?", 
+          (path, vid)).fetchone() or (None, None, None)
+
+  def __load_versions(self):
+    versions = dict()
+    for (path, vid, standalone, year, authors, topics, types, params, deps,
+        resources, body, solution, rubric) in self.connection.execute(
+        "SELECT path, vid, standalone, year, authors, topics, types, params, "
+        "deps, resources, length(body) > 0, length(solution) > 0, "
+        "length(rubric) > 0 FROM versions"):
+      version = Version(path, vid)
+      version.standalone = bool(standalone)
+      version.year = year
+      version.authors = _split(authors)
+      version.topics = _split(topics)
+      version.types = _split(types)
+      version.params = dict((_ascii(name), _ascii(value))
+          for name, value in json.loads(params).iteritems())
+      version.deps = _split(deps)
+      version.resources = map(_ascii, json.loads(resources))
+      version.defer(partial(self.__load_text, path, vid), set(field 
+          for field, present in zip(TEXT_FIELDS, (body, solution, rubric)) 
+          if present))
+      versions.setdefault(path, dict())[vid] = version
+    return versions
+
+  def __load_used_in(self):
+    used_in = dict()
+    for path, year, name, private in self.connection.execute(
+        "SELECT path, year, name, private FROM usedin ORDER BY path, position"):
+      used_in.setdefault(path, []).append(UsedIn(year, name, bool(private)))
+    return used_in
+
+  def problems(self):
+    """
+    Yields (filename, status, problem) for every problem file found by the
+    last refresh, in os.walk order. The problem is None unless the status is OK,
+    and its versions have not been validated.
+    """
+    statuses = dict(self.connection.execute("SELECT path, status FROM problems"))
+    versions = self.__load_versions()
+    used_in = self.__load_used_in()
+    for path in self.paths:
+      if path in self.unreadable:
+        yield path, UNREADABLE, None
+        continue
+      status = statuses[path]
+      if status != OK:
+        yield path, status, None
+        continue
+      problem = Problem(path)
+      problem.versions = versions.get(path, dict())
+      problem.used_in = used_in.get(path, [])
+      if problem.used_in:
+        for version in problem.versions.itervalues():
+          version.usedin = problem.used_in
+      yield path, status, problem
@@ -4,12 +4,14 @@ class ImproperXmlException(Exception):
 class ParseNotImplementedException(Exception):
   pass
   
-class XmlParseable:
+class XmlParseable(object):
   """
   An object which can be built or modified by providing it with a tree.
   It may also be returned back as a new tree, modified directly, or created without
   an initial tree.
   """
+  # So that subclasses can have slots
+  __slots__ = ()
   
   def xml_assert(self, predicate, str):
     """Used internally: check that something is true about the structure of an XML tree"""
@@ -1,126 +1,597 @@
-from color import print_error, print_warning
-from config import get_resource_root
-from os import chdir, devnull, getcwd, getpid, mkdir, rename, remove
+from cache import Cache, hasher
+import compileserver
+import pdfsplit
+import resources
+import scratch
+from color import *
+from os import devnull, getcwd, mkdir, remove, strerror
 from os.path import basename, exists, join
-from random import randint
-from re import sub
-from shutil import copy, move, rmtree
-from stringutil import strip_latex_comments
+from re import findall, sub
+from shutil import copy, move
+from stringutil import PREAMBLE_END, latex_comment_stripper, strip_latex_comments_stream
 from subprocess import CalledProcessError, check_call, check_output
+from threading import Lock
 import errno
+import re
 import string
 
-def prepare_resources(resource_list):
-  for resource in set(resource_list):
-    try:
-      copy(join(get_resource_root(), resource), getcwd())
-    except IOError as e:
-      if e.errno == errno.ENOENT:
+# Held while talking to the user or moving finished files into place, so that
+# builds running side by side don't interleave their prompts
+__output_lock = Lock()
+
+# The line of a pdflatex log which says where the error before it happened
+LINE_MARKER = re.compile(r"l\.(\d+)")
+
+def prepare_resources(resource_list, dir):
+  """
+  Puts resource_list into a scratch directory (see scratch.stage), returning
+  whether they could all be staged. If not, every problem is reported.
+  """
+  try:
+    scratch.stage(resource_list, dir)
+  except resources.ResourceError as e:
+    for resource, error in e.problems:
+      if error == errno.ENOENT:
         print_error("Could not find resource {}".format(resource))
-      elif e.errno == errno.EEXIST:
+      elif error == errno.EEXIST:
         print_error("Duplicate resource filename at {}".format(resource))
-      elif e.errno == errno.EACCES:
+      elif error == errno.EACCES:
         print_error("Resource at {} could not be accessed".format(resource))
       else:
-        raise
-      return False
+        print_error("Resource at {} could not be read ({})".format(resource,
+            strerror(error)))
+    return False
   return True
 
-def build(document_contents, resources, filename, keep=False):
-  document_contents = strip_latex_comments(document_contents)
-  assert document_contents
-  root = getcwd()
-  dir = ".22tmp.r" + str(getpid()) + str(randint(0,1000))
-  try: 
-    mkdir(dir)
-  except OSError as e:
-    if e.errno == errno.EEXIST:
-      print_error("Temporary directory could not be created, please try again")
-      return
-    raise
-  chdir(dir)
-  if prepare_resources(resources):
-    # Copied all resources successfully
-    with open("render.tex", "w") as f:
-      f.write(document_contents.encode('UTF-8'))
+def stage_resources(resource_list):
+  """
+  Stages resource_list in a new directory once, for several builds of 
+  documents which share them (see build), returning the directory or None if
+  a resource could not be staged. The caller gives it back with 
+  scratch.release when done.
+  """
+  staged = scratch.acquire()
+  if prepare_resources(resource_list, staged):
+    return staged
+  scratch.release(staged)
+  return None
+
+def copy_staged(staged, dir):
+  scratch.share(staged, dir)
+  return True
+
+__pdflatex_version = None
+
+def pdflatex_version():
+  """The version banner of the installed pdflatex, or '' if it can't be run"""
+  global __pdflatex_version
+  if __pdflatex_version is None:
     try:
       with open(devnull, 'wb') as DEVNULL:
-        check_output(["pdflatex", "-halt-on-error", "render.tex"],
-            stderr=DEVNULL)
-    except CalledProcessError as e:
-      print_error("The rendering failed due to a LaTeX error:")
-      lines = map(string.rstrip, e.output.split('\n'))
-      if len(lines) > 7:
-        for line in lines[-8:-2]:
-          print "\t", line
-      else:
-        for line in lines:
-          print "\t", line
-      print_warning("Rendered .tex file kept as {}.tex".format(filename))
-      safe_overwrite("render", root, filename, ".tex")
-    except OSError as e:
-      if e.errno == errno.ENOENT:
-        print_error("Could not run pdflatex, is it installed?")
-      else: raise
+        __pdflatex_version = check_output(["pdflatex", "--version"],
+            stderr=DEVNULL).split('\n')[0]
+    except (OSError, CalledProcessError):
+      __pdflatex_version = ""
+  return __pdflatex_version
+
+def render_key(document_hash, resource_list):
+  """
+  Hashes everything that goes into a render: the document (given by its hash
+  from write_stripped, and which already contains the text of the configured 
+  include files), the name and contents (see resources.content_hash) of every
+  resource, and the pdflatex version. Returns None if a resource could not be
+  read, since the build will fail anyway.
+  """
+  key = hasher()
+  key.update(pdflatex_version())
+  key.update(document_hash)
+  for resource in sorted(set(resource_list)):
+    key.update("\0" + resource + "\0")
+    try:
+      key.update(resources.content_hash(resource))
+    except (IOError, OSError, TypeError, AttributeError):
+      return None
+  return key.hexdigest()
+
+def dump_format(preamble, dir, name):
+  """
+  Precompiles preamble into dir/name.fmt with mylatexformat, returning whether
+  it succeeded
+  """
+  with open(join(dir, name + ".tex"), "w") as f:
+    f.write(preamble.encode('UTF-8'))
+    f.write(PREAMBLE_END + "\n\\begin{document}\n\\end{document}\n")
+  try:
+    with open(devnull, 'wb') as DEVNULL:
+      check_call(["pdflatex", "-ini", "-halt-on-error", "-jobname=" + name,
+          "&pdflatex", "mylatexformat.ltx", name + ".tex"],
+          stdout=DEVNULL, stderr=DEVNULL, cwd=dir)
+  except (OSError, CalledProcessError):
+    return False
+  return exists(join(dir, name + ".fmt"))
+
+def preamble_of(document_contents):
+  """Everything before PREAMBLE_END in a document, or None if it has none"""
+  end = document_contents.find(PREAMBLE_END)
+  if end < 0:
+    return None
+  return document_contents[:end]
+
+def precompiled_format(preamble, dir):
+  """
+  Makes a format with preamble (see preamble_of) already loaded available in
+  dir, returning the name to give to -fmt. The format is built once per 
+  distinct preamble and pdflatex version and cached; returns None if it could
+  not be built, in which case the document should just be compiled normally.
+  """
+  if preamble is None:
+    return None
+  key = hasher()
+  key.update(pdflatex_version())
+  key.update(preamble.encode('UTF-8'))
+  key = key.hexdigest()
+  name = "preamble-" + key
+  if exists(join(dir, name + ".fmt")):
+    # Left by an earlier render in the same scratch directory
+    return name
+  formats = Cache("fmt", ".fmt")
+  cached = formats.lookup(key)
+  if cached is not None:
+    try:
+      copy(cached, join(dir, name + ".fmt"))
+      return name
+    except IOError:
+      return None
+  # Remembers preambles which can't be dumped, so that each build doesn't try
+  failures = Cache("fmt", ".failed")
+  if failures.lookup(key) is not None:
+    return None
+  if not dump_format(preamble, dir, name):
+    failures.store_contents(key, "")
+    return None
+  formats.store(key, join(dir, name + ".fmt"))
+  return name
+
+def pdflatex_command(preamble, dir):
+  """The command which compiles dir/render.tex, from a format if possible"""
+  command = ["pdflatex", "-halt-on-error"]
+  format = precompiled_format(preamble, dir)
+  if format is not None:
+    command.append("-fmt=" + format)
+  return command + ["render.tex"]
+
+def run_pdflatex(command, dir):
+  """
+  Runs a pdflatex command in dir, on the compile server if one is running, 
+  returning its output and raising CalledProcessError like check_output
+  """
+  result = compileserver.submit(command, dir)
+  if result is None:
+    with open(devnull, 'wb') as DEVNULL:
+      return check_output(command, stderr=DEVNULL, cwd=dir)
+  returncode, output = result
+  if returncode != 0:
+    raise CalledProcessError(returncode, command, output)
+  return output
+
+def choose_output_name(root, filename):
+  """Asks the user what to do if the pdf would overwrite an existing file"""
+  while exists(root + "/" + filename + ".pdf"):
+    print_warning("'{}' already exists.".format(filename + ".pdf"))
+    response = raw_input("Type a new name or a blank line to replace file: ")
+    if not response: break
+    elif response.endswith(".pdf"):
+      filename = response[:-4]
+      assert filename
     else:
-      while exists(root + "/" + filename + ".pdf"):
-        print_warning("'{}' already exists.".format(filename + ".pdf"))
-        response = raw_input("Type a new name or a blank line to replace file: ")
-        if not response: break
-        elif response.endswith(".pdf"):
-          filename = response[:-4]
-          assert filename
-        else:
-          filename = response
-      safe_overwrite("render", root, filename, ".pdf")
-      if keep:
-        safe_overwrite("render", root, filename, ".tex")
-  chdir(root)
-  try: rmtree(dir)
-  except OSError:
-    print_warning("Could not delete temporary directory")
-
-def can_build(document_contents, resources):
-  assert document_contents
-  root = getcwd()
-  dir = ".22tmp.v" + str(getpid()) + str(randint(0,1000))
-  try: 
-    mkdir(dir)
+      filename = response
+  return filename
+
+def chunks_of(document_contents, size=1 << 16):
+  """Splits a document into pieces, unless it already is an iterable of them"""
+  if not isinstance(document_contents, basestring):
+    return document_contents
+  return (document_contents[i:i + size] 
+      for i in xrange(0, len(document_contents), size))
+
+class RenderFile:
+  """
+  A file which a document is written to, keeping a hash of everything 
+  written and picking out the document's preamble (see preamble_of)
+  """
+  def __init__(self, filename):
+    self.file = open(filename, "w")
+    self.key = hasher()
+    self.preamble = []
+    # The end of what has been written, in case the mark is split between writes
+    self.tail = ""
+    self.found = False
+
+  def write(self, data):
+    if isinstance(data, unicode):
+      data = data.encode('UTF-8')
+    self.key.update(data)
+    self.file.write(data)
+    if not self.found:
+      self.found = PREAMBLE_END in self.tail + data
+      self.tail = (self.tail + data)[-len(PREAMBLE_END):]
+      self.preamble.append(data)
+
+  def close(self):
+    self.file.close()
+
+  def result(self):
+    """The hash of what was written and its preamble"""
+    if not self.found:
+      return self.key.hexdigest(), None
+    return (self.key.hexdigest(), 
+        preamble_of("".join(self.preamble).decode('UTF-8')))
+
+class StrippingFile:
+  """A file-like object which strips the comments from what is written to it"""
+  def __init__(self, output):
+    self.output = output
+    self.stripper = latex_comment_stripper()
+
+  def write(self, data):
+    if not isinstance(data, unicode):
+      data = data.decode('UTF-8')
+    self.output.write(self.stripper.feed(data))
+
+  def close(self):
+    self.output.write(self.stripper.close())
+
+def write_stripped(document_contents, filename, strip=True):
+  """
+  Strips the comments from a document while writing it to filename, without
+  ever holding the whole stripped document; if not strip, they have already
+  been removed. The document can be a string, an iterable of pieces of one,
+  or a function which writes it to a file-like object (like a bound 
+  Document.write_to). Returns the hash of what was written and its preamble.
+  """
+  output = RenderFile(filename)
+  try:
+    if callable(document_contents):
+      stream = StrippingFile(output) if strip else output
+      document_contents(stream)
+      if strip:
+        stream.close()
+    else:
+      chunks = chunks_of(document_contents)
+      if strip:
+        chunks = strip_latex_comments_stream(chunks)
+      for chunk in chunks:
+        output.write(chunk)
+  finally:
+    output.close()
+  return output.result()
+
+def report_latex_error(output):
+  """Prints the end of pdflatex's output; hold __output_lock"""
+  print_error("The rendering failed due to a LaTeX error:")
+  lines = map(string.rstrip, output.split('\n'))
+  if len(lines) > 7:
+    for line in lines[-8:-2]:
+      print "\t", line
+  else:
+    for line in lines:
+      print "\t", line
+
+def latex_errors(log):
+  """
+  The (message, line) of every error in a pdflatex log, from its "! message"
+  and the "l.NNN" marking the line of render.tex it happened on
+  """
+  errors = []
+  message = None
+  for line in log.split('\n'):
+    if line.startswith("! "):
+      message = line[2:].rstrip()
+    elif message is not None:
+      match = LINE_MARKER.match(line)
+      if match:
+        errors.append((message, int(match.group(1))))
+        message = None
+  return errors
+
+def report_sources(source_map, dir, output):
+  """
+  Prints the problem fields which the errors in a failed render of dir came
+  from, using the SourceMap filled in as its document was written; hold 
+  __output_lock
+  """
+  try:
+    with open(join(dir, "render.log")) as f:
+      log = f.read()
+  except IOError:
+    log = output
+  errors = latex_errors(log)
+  if not errors:
+    return
+  with open(join(dir, "render.tex"), "rb") as f:
+    document = f.read().decode('UTF-8', 'replace')
+  for message, line in errors:
+    origins = source_map.locate(document, line)
+    where = (", ".join(map(source_map.describe, origins)) if origins 
+        else "the document around the problems")
+    print_error("{} (line {}) is in {}".format(message, line, where))
+
+def render_into(document_contents, resources, dir, cache=True, strip=True,
+    staged=None):
+  """
+  Renders document_contents into dir/render.pdf (see build), leaving the 
+  document itself in dir/render.tex. Returns whether it succeeded, and raises
+  CalledProcessError if the document has a LaTeX error.
+  """
+  render = join(dir, "render")
+  document_hash, preamble = write_stripped(document_contents, render + ".tex",
+      strip)
+  key = render_key(document_hash, resources) if cache else None
+  cached = Cache("pdf", ".pdf").lookup(key) if key is not None else None
+  if cached is not None:
+    with __output_lock:
+      print color("Cache hit: ", color_code(GREEN)) + "reusing an identical earlier render"
+    copy(cached, render + ".pdf")
+    return True
+  if not (copy_staged(staged, dir) if staged is not None 
+      else prepare_resources(resources, dir)):
+    return False
+  # Copied all resources successfully
+  if key is not None:
+    with __output_lock:
+      print color("Cache miss: ", color_code(CYAN)) + "rendering with pdflatex"
+  try:
+    run_pdflatex(pdflatex_command(preamble, dir), dir)
   except OSError as e:
-    if e.errno == errno.EEXIST:
-      print_error("Temporary directory could not be created, please try again")
+    if e.errno == errno.ENOENT:
+      with __output_lock:
+        print_error("Could not run pdflatex, is it installed?")
       return False
     raise
-  chdir(dir)
+  if key is not None:
+    Cache("pdf", ".pdf").store(key, render + ".pdf")
+  return True
+
+def build(document_contents, resources, filename, keep=False, cache=True, 
+    strip=True, staged=None, source_map=None):
+  """
+  Renders document_contents (anything write_stripped accepts) into 
+  filename.pdf in the current directory, returning whether it succeeded. Safe
+  to call from several threads at once. Pass strip=False if the comments have
+  already been stripped from the document (see Document.build), staged if
+  the resources were already copied with stage_resources, and the 
+  problem.SourceMap which writing the document fills in to have LaTeX errors
+  traced back to the problems they are in.
+  """
+  root = getcwd()
+  dir = scratch.acquire()
+  render = join(dir, "render")
   result = False
-  if prepare_resources(resources):
-    with open("render.tex", "w") as f:
-      f.write(document_contents.encode('UTF-8'))
-    try:
-      with open(devnull, 'wb') as DEVNULL:
-        check_call(["pdflatex", "-halt-on-error", "render.tex"],
-            stdout=DEVNULL, stderr=DEVNULL)
-      result = True
-    except CalledProcessError:
-      result = False
-    except OSError as e:
-      result = False
-      if e.errno == errno.ENOENT:
-        print_error("Could not run pdflatex, is it installed?")
-      else: raise
-  chdir(root)
-  try: rmtree(dir)
-  except OSError:
-    print_warning("Could not delete temporary directory")
+  try:
+    result = render_into(document_contents, resources, dir, cache, strip, 
+        staged)
+  except CalledProcessError as e:
+    with __output_lock:
+      report_latex_error(e.output)
+      if source_map is not None:
+        report_sources(source_map, dir, e.output)
+      print_warning("Rendered .tex file kept as {}.tex".format(filename))
+      safe_overwrite(render, root, filename, ".tex")
+  else:
+    if result:
+      with __output_lock:
+        filename = choose_output_name(root, filename)
+        safe_overwrite(render, root, filename, ".pdf")
+        if keep:
+          safe_overwrite(render, root, filename, ".tex")
+  finally:
+    # Writing the document can raise too, if its problems' text can't be read
+    scratch.release(dir)
+  return result
+
+def build_split(document_contents, resources, filename, filenames, key, 
+    keep=False, cache=True, strip=True):
+  """
+  Renders document_contents like build, then splits the PDF into 
+  filenames[i].pdf in the current directory, by the /key page attribute (from
+  1) of each page. Returns whether it succeeded; on a LaTeX error (or if the 
+  PDF can't be split) nothing is written except, if keep, filename.tex.
+  """
+  root = getcwd()
+  dir = scratch.acquire()
+  render = join(dir, "render")
+  result = False
+  try:
+    if render_into(document_contents, resources, dir, cache, strip):
+      pdf = pdfsplit.Pdf(render + ".pdf")
+      groups = pdf.pages_by(key)
+      if sorted(groups) == range(1, len(filenames) + 1):
+        for i in range(len(filenames)):
+          pdf.write(groups[i + 1], join(dir, "split" + str(i) + ".pdf"))
+        with __output_lock:
+          for i, name in enumerate(filenames):
+            safe_overwrite(join(dir, "split" + str(i)), root, 
+                choose_output_name(root, name), ".pdf")
+        result = True
+  except (CalledProcessError, pdfsplit.PdfError):
+    pass
+  finally:
+    if keep and exists(render + ".tex"):
+      safe_overwrite(render, root, filename, ".tex")
+    scratch.release(dir)
+  return result
+
+def stitched_part(header, body, first_page):
+  """A document of one part for build_stitched, starting at page first_page"""
+  # pdfsplit can only read PDFs without object streams
+  return (header + "\\begin{document}\n\\pdfobjcompresslevel=0\n" + 
+      "\\setcounter{page}{" + str(first_page) + "}\n" + body + 
+      "\n\\end{document}")
+
+def build_stitched(header, bodies, resources, filename, keep=False, 
+    cache=True, strip=True):
+  """
+  Renders header with each of bodies as a document of its own, each numbering
+  its pages on from the one before, and stitches the PDFs together into 
+  filename.pdf in the current directory. Each part is cached like any other
+  render, so once one body changes, only it (and any later ones whose page
+  numbers moved) is rendered again. If keep, the document of each part is 
+  kept as filename-partN.tex. Returns whether it succeeded, or None if
+  the parts could not be stitched together, in which case the document 
+  should be built as a whole instead.
+  """
+  root = getcwd()
+  dir = scratch.acquire()
+  result = False
+  staged = None
+  try:
+    staged = stage_resources(resources)
+    if staged is not None:
+      parts = []
+      first_page = 1
+      for i, body in enumerate(bodies):
+        part = join(dir, "part" + str(i))
+        mkdir(part)
+        try:
+          if not render_into(stitched_part(header, body, first_page), 
+              resources, part, cache, strip, staged):
+            break
+        except CalledProcessError as e:
+          with __output_lock:
+            report_latex_error(e.output)
+            print_warning("Rendered .tex file kept as {}.tex".format(filename))
+            safe_overwrite(join(part, "render"), root, filename, ".tex")
+          break
+        parts.append(join(part, "render.pdf"))
+        first_page = first_page + len(pdfsplit.Pdf(parts[-1]).pages())
+      else:
+        pdfsplit.merge(parts, join(dir, "render.pdf"))
+        with __output_lock:
+          filename = choose_output_name(root, filename)
+          safe_overwrite(join(dir, "render"), root, filename, ".pdf")
+          if keep:
+            for i in range(len(bodies)):
+              safe_overwrite(join(dir, "part" + str(i), "render"), root, 
+                  filename + "-part" + str(i), ".tex")
+        result = True
+  except pdfsplit.PdfError:
+    result = None
+  finally:
+    if staged is not None:
+      scratch.release(staged)
+    scratch.release(dir)
+  return result
+
+def can_build(document_contents, resources, staged=None):
+  assert document_contents
+  dir = scratch.acquire()
+  result = False
+  try:
+    if (copy_staged(staged, dir) if staged is not None 
+        else prepare_resources(resources, dir)):
+      with open(join(dir, "render.tex"), "w") as f:
+        f.write(document_contents.encode('UTF-8'))
+      try:
+        run_pdflatex(pdflatex_command(preamble_of(document_contents), dir), dir)
+        result = True
+      except CalledProcessError:
+        result = False
+      except OSError as e:
+        result = False
+        if e.errno == errno.ENOENT:
+          print_error("Could not run pdflatex, is it installed?")
+        else: raise
+  finally:
+    scratch.release(dir)
   return result   
   
+# Written to the terminal as each fragment of a batch starts, and at the end
+FRAGMENT_MARK = "22fragment"
+
+def fragment_batch(header, bodies):
+  """
+  A document which compiles each of bodies in turn, each in its own group and
+  on its own pages, announcing each one (by its index) as it starts
+  """
+  batch = [header, "\\newenvironment{fragment22}{}{}\n\\begin{document}\n"]
+  for i, body in enumerate(bodies):
+    batch.append("\\typeout{" + FRAGMENT_MARK + " " + str(i) + "}\n")
+    batch.append("\\begin{fragment22}\n" + body + "\n\\end{fragment22}\\clearpage\n")
+  batch.append("\\typeout{" + FRAGMENT_MARK + " done}\n\\end{document}")
+  return "".join(batch)
+
+def __run_fragments(header, bodies, dir):
+  """
+  Compiles bodies as one batch in dir, returning (succeeded, reached): the
+  index of the last fragment which started, or None if none did, and
+  len(bodies) if the whole batch finished
+  """
+  document_contents = fragment_batch(header, bodies)
+  with open(join(dir, "render.tex"), "w") as f:
+    f.write(document_contents.encode('UTF-8'))
+  # A failed run can leave a broken .aux file behind for the next one
+  temp_file_remove(join(dir, "render.aux"))
+  try:
+    output = run_pdflatex(
+        pdflatex_command(preamble_of(document_contents), dir), dir)
+    succeeded = True
+  except CalledProcessError as e:
+    output = e.output or ""
+    succeeded = False
+  marks = findall(FRAGMENT_MARK + r" (\d+|done)", output)
+  if not marks:
+    return succeeded, None
+  if marks[-1] == "done":
+    return succeeded, len(bodies)
+  return succeeded, int(marks[-1])
+
+def can_build_fragments(header, bodies, resources):
+  """
+  Checks whether header + each of bodies would compile as a document of its 
+  own (as can_build would), returning a list of the results. The bodies are 
+  compiled together in as few pdflatex runs as possible: when a batch fails,
+  every fragment before the failing one compiled, and a batch starting at the
+  failing fragment is run to see whether it fails on its own.
+  """
+  results = [False] * len(bodies)
+  if not bodies:
+    return results
+  dir = scratch.acquire()
+  try:
+    if prepare_resources(resources, dir):
+      start = 0
+      while start < len(bodies):
+        succeeded, reached = __run_fragments(header, bodies[start:], dir)
+        if reached is None:
+          # Every fragment shares the failing header
+          break
+        if reached == len(bodies) - start:
+          if succeeded:
+            results[start:] = [True] * reached
+            break
+          # Failed at \end{document}, most likely because of the last fragment
+          reached = reached - 1
+        results[start:start + reached] = [True] * reached
+        if reached == 0:
+          results[start] = succeeded
+          start = start + 1
+        else:
+          start = start + reached
+  except OSError as e:
+    if e.errno == errno.ENOENT:
+      print_error("Could not run pdflatex, is it installed?")
+    else: raise
+  finally:
+    scratch.release(dir)
+  return results
+
 def safe_overwrite(oldname, dir, newname, extension):
-  newname = basename(newname)
-  try: remove(join(dir, newname + extension))
+  """Moves oldname + extension to newname + extension within dir"""
+  newname = join(dir, basename(newname) + extension)
+  try: remove(newname)
   except OSError as e:
     if e.errno != errno.ENOENT: raise  
-  rename(oldname + extension, newname + extension)
-  move(newname + extension, dir)
+  move(oldname + extension, newname)
 
 def temp_file_remove(tempfilename):
   try: 
@@ -0,0 +1,356 @@
+import re
+
+# Reads PDFs written by pdflatex with \pdfobjcompresslevel=0 (that is, with a
+# plain cross-reference table and no object streams) and writes out some of
+# their pages as PDFs of their own. Only as much of the PDF syntax as that
+# needs is understood: objects are parsed, and streams are copied unchanged.
+
+class PdfError(Exception):
+  """Raised for PDFs which are damaged or use features not supported here"""
+
+class Ref:
+  """An indirect reference to object number num"""
+  def __init__(self, num, gen=0):
+    self.num = num
+    self.gen = gen
+
+class Name(str):
+  """A /Name, without its slash"""
+
+class Raw(str):
+  """A number, string, boolean or null, kept exactly as it was written"""
+
+class Stream:
+  def __init__(self, dictionary, data):
+    self.dictionary = dictionary
+    self.data = data
+
+# The attributes of a page which it can inherit from the page tree above it
+INHERITED = ("Resources", "MediaBox", "CropBox", "Rotate")
+
+WHITESPACE = "\0\t\n\f\r "
+TOKEN = re.compile(r"[^\0\t\n\f\r ()<>\[\]{}/%]*")
+OBJECT_HEADER = re.compile(r"\s*(\d+)\s+(\d+)\s+obj")
+XREF_SECTION = re.compile(r"\s*(\d+)\s+(\d+)")
+INTEGER = re.compile(r"[+-]?\d+$")
+
+def skip_whitespace(data, pos):
+  while pos < len(data):
+    if data[pos] in WHITESPACE:
+      pos = pos + 1
+    elif data[pos] == "%":
+      while pos < len(data) and data[pos] not in "\r\n":
+        pos = pos + 1
+    else:
+      break
+  return pos
+
+def literal_string_end(data, pos):
+  """The position after the literal string starting at data[pos] == '('"""
+  depth = 0
+  while pos < len(data):
+    c = data[pos]
+    if c == "\\":
+      pos = pos + 1
+    elif c == "(":
+      depth = depth + 1
+    elif c == ")":
+      depth = depth - 1
+      if depth == 0:
+        return pos + 1
+    pos = pos + 1
+  raise PdfError("Unterminated string")
+
+def parse(data, pos):
+  """Parses the object starting at (or after whitespace from) pos, returning it and its end"""
+  pos = skip_whitespace(data, pos)
+  if pos >= len(data):
+    raise PdfError("Unexpected end of file")
+  c = data[pos]
+  if data.startswith("<<", pos):
+    dictionary = dict()
+    pos = skip_whitespace(data, pos + 2)
+    while not data.startswith(">>", pos):
+      key, pos = parse(data, pos)
+      if not isinstance(key, Name):
+        raise PdfError("Dictionary key is not a name")
+      dictionary[key], pos = parse(data, pos)
+      pos = skip_whitespace(data, pos)
+    return dictionary, pos + 2
+  if c == "[":
+    array = []
+    pos = skip_whitespace(data, pos + 1)
+    while not data.startswith("]", pos):
+      value, pos = parse(data, pos)
+      array.append(value)
+      pos = skip_whitespace(data, pos)
+    return array, pos + 1
+  if c == "(":
+    end = literal_string_end(data, pos)
+    return Raw(data[pos:end]), end
+  if c == "<":
+    end = data.find(">", pos)
+    if end < 0:
+      raise PdfError("Unterminated hex string")
+    return Raw(data[pos:end + 1]), end + 1
+  if c == "/":
+    end = TOKEN.match(data, pos + 1).end()
+    return Name(data[pos + 1:end]), end
+  end = TOKEN.match(data, pos).end()
+  if end == pos:
+    raise PdfError("Unexpected '{}' at {}".format(c, pos))
+  token = data[pos:end]
+  if INTEGER.match(token):
+    # Looks ahead for the rest of "num gen R"
+    reference = re.compile(r"\s+(\d+)\s+R(?![^\0\t\n\f\r ()<>\[\]{}/%])").match(data, end)
+    if reference:
+      return Ref(int(token), int(reference.group(1))), reference.end()
+  return Raw(token), end
+
+def serialize(value, renumber):
+  """Writes value back out, replacing each Ref with renumber(ref)"""
+  if isinstance(value, Name):
+    return "/" + value
+  if isinstance(value, Raw):
+    return value
+  if isinstance(value, Ref):
+    return renumber(value)
+  if isinstance(value, list):
+    return "[" + " ".join(serialize(item, renumber) for item in value) + "]"
+  if isinstance(value, dict):
+    return "<<" + " ".join("/" + key + " " + serialize(value[key], renumber)
+        for key in sorted(value)) + ">>"
+  raise PdfError("Cannot write {!r}".format(value))
+
+class Pdf:
+  """A PDF read from a file, whose pages can be written out separately"""
+  def __init__(self, filename):
+    with open(filename, "rb") as f:
+      self.data = f.read()
+    header = re.match(r"%PDF-(\d\.\d)", self.data)
+    if not header:
+      raise PdfError("Not a PDF")
+    self.version = header.group(1)
+    self.offsets = dict()
+    self.objects = dict()
+    self.trailer = dict()
+    self.__read_xref()
+    self.__pages = None
+
+  def __read_xref(self):
+    start = self.data.rfind("startxref")
+    if start < 0:
+      raise PdfError("No startxref")
+    offset = int(self.data[start + len("startxref"):].split()[0])
+    seen = set()
+    while offset is not None and offset not in seen:
+      seen.add(offset)
+      pos = skip_whitespace(self.data, offset)
+      if not self.data.startswith("xref", pos):
+        raise PdfError("Cross-reference streams are not supported")
+      pos = pos + len("xref")
+      while True:
+        section = XREF_SECTION.match(self.data, pos)
+        if not section:
+          break
+        first, count = int(section.group(1)), int(section.group(2))
+        pos = skip_whitespace(self.data, section.end())
+        for num in xrange(first, first + count):
+          entry = self.data[pos:pos + 20].split()
+          if len(entry) != 3:
+            raise PdfError("Damaged cross-reference table")
+          # Newer sections (read first) take precedence
+          if entry[2] == "n" and num not in self.offsets:
+            self.offsets[num] = int(entry[0])
+          pos = skip_whitespace(self.data, pos + 18)
+      pos = skip_whitespace(self.data, pos)
+      if not self.data.startswith("trailer", pos):
+        raise PdfError("No trailer")
+      trailer, _ = parse(self.data, pos + len("trailer"))
+      if "XRefStm" in trailer:
+        raise PdfError("Object streams are not supported")
+      for key, value in trailer.iteritems():
+        self.trailer.setdefault(key, value)
+      previous = trailer.get("Prev")
+      offset = int(previous) if previous is not None else None
+
+  def get(self, value):
+    """Resolves value if it is a Ref, returning None for missing objects"""
+    if not isinstance(value, Ref):
+      return value
+    return self.object(value.num)
+
+  def object(self, num):
+    if num in self.objects:
+      return self.objects[num]
+    if num not in self.offsets:
+      return None
+    header = OBJECT_HEADER.match(self.data, self.offsets[num])
+    if not header or int(header.group(1)) != num:
+      raise PdfError("Object {} is not where the table says".format(num))
+    value, pos = parse(self.data, header.end())
+    pos = skip_whitespace(self.data, pos)
+    if isinstance(value, dict) and self.data.startswith("stream", pos):
+      pos = pos + len("stream")
+      if self.data.startswith("\r\n", pos):
+        pos = pos + 2
+      elif self.data.startswith("\n", pos):
+        pos = pos + 1
+      length = self.get(value.get("Length"))
+      if length is None:
+        raise PdfError("Stream {} has no length".format(num))
+      value = Stream(value, self.data[pos:pos + int(length)])
+    if isinstance(value, dict) and value.get("Type") == "ObjStm":
+      raise PdfError("Object streams are not supported")
+    self.objects[num] = value
+    return value
+
+  def pages(self):
+    """
+    The object numbers of the pages, in order, with each page's inherited
+    attributes copied into it
+    """
+    if self.__pages is None:
+      root = self.get(self.trailer.get("Root"))
+      if not isinstance(root, dict) or not isinstance(root.get("Pages"), Ref):
+        raise PdfError("No page tree")
+      self.__pages = []
+      # Every page and node of the page tree
+      self.tree = set()
+      self.__collect_pages(root["Pages"].num, dict(), self.tree)
+    return self.__pages
+
+  def __collect_pages(self, num, inherited, seen):
+    if num in seen:
+      raise PdfError("Page tree has a cycle")
+    seen.add(num)
+    node = self.object(num)
+    if not isinstance(node, dict):
+      raise PdfError("Page tree node {} is not a dictionary".format(num))
+    if node.get("Type") == "Pages":
+      inherited = dict(inherited)
+      for key in INHERITED:
+        if key in node:
+          inherited[key] = node[key]
+      for kid in self.get(node.get("Kids")) or []:
+        if not isinstance(kid, Ref):
+          raise PdfError("Page tree kid is not a reference")
+        self.__collect_pages(kid.num, inherited, seen)
+    else:
+      for key, value in inherited.iteritems():
+        node.setdefault(key, value)
+      self.__pages.append(num)
+
+  def pages_by(self, key):
+    """
+    Groups the pages by the integer value of their /key attribute, returning
+    a dictionary from each value to the pages which have it, in order; pages
+    without the attribute are left out
+    """
+    groups = dict()
+    for num in self.pages():
+      value = self.object(num).get(key)
+      if isinstance(value, Raw) and INTEGER.match(value):
+        groups.setdefault(int(value), []).append(num)
+    return groups
+
+  def write(self, pages, filename):
+    """Writes a PDF of the given pages (see pages) to filename"""
+    writer = PdfWriter()
+    writer.add_pages(self, pages)
+    writer.write(filename)
+
+def merge(filenames, filename):
+  """Writes every page of each of the PDFs filenames, in order, to filename"""
+  writer = PdfWriter()
+  for name in filenames:
+    pdf = Pdf(name)
+    writer.add_pages(pdf, pdf.pages())
+  writer.write(filename)
+
+class PdfWriter:
+  """
+  Collects pages from any number of Pdfs, with everything they refer to, and
+  writes them out as a new PDF
+  """
+  # The new page tree and catalog
+  PAGES = 1
+  CATALOG = 2
+
+  def __init__(self):
+    self.version = "1.4"
+    self.info = None
+    # Every object to write, as (pdf, object number) in the order they are
+    # numbered (from 3)
+    self.order = []
+    self.numbers = dict()
+    self.kids = []
+
+  def number(self, pdf, num):
+    key = (id(pdf), num)
+    if key not in self.numbers:
+      self.numbers[key] = len(self.order) + 3
+      self.order.append((pdf, num))
+    return self.numbers[key]
+
+  def add_pages(self, pdf, pages):
+    pdf.pages()
+    self.version = max(self.version, pdf.version)
+    if self.info is None and isinstance(pdf.trailer.get("Info"), Ref):
+      self.info = pdf, pdf.trailer["Info"]
+    for num in pages:
+      self.kids.append(self.number(pdf, num))
+
+  def write(self, filename):
+    output = ["%PDF-" + self.version + "\n%\xe2\xe3\xcf\xd3\n"]
+    offsets = dict()
+    size = [len(output[0])]
+    def append(num, text):
+      offsets[num] = size[0]
+      output.append("{} 0 obj\n{}\nendobj\n".format(num, text))
+      size[0] = size[0] + len(output[-1])
+
+    def renumberer(pdf):
+      def renumber(ref):
+        # Links to pages which aren't being written (or the old page tree) 
+        # go nowhere, rather than pulling the whole document in
+        if ref.num in pdf.tree and (id(pdf), ref.num) not in self.numbers:
+          return "null"
+        if pdf.object(ref.num) is None:
+          return "null"
+        return "{} 0 R".format(self.number(pdf, ref.num))
+      return renumber
+
+    info = "null"
+    if self.info is not None:
+      pdf, ref = self.info
+      info = renumberer(pdf)(ref)
+
+    i = 0
+    while i < len(self.order):
+      pdf, num = self.order[i]
+      i = i + 1
+      value = pdf.object(num)
+      if num in pdf.tree:
+        value = dict(value)
+        value["Parent"] = Raw("{} 0 R".format(PdfWriter.PAGES))
+      if isinstance(value, Stream):
+        dictionary = dict(value.dictionary)
+        dictionary["Length"] = Raw(str(len(value.data)))
+        append(i + 2, serialize(dictionary, renumberer(pdf)) + "\nstream\n" +
+            value.data + "\nendstream")
+      else:
+        append(i + 2, serialize(value, renumberer(pdf)))
+    append(PdfWriter.PAGES, "<</Type /Pages /Count {} /Kids [{}]>>".format(
+        len(self.kids), " ".join("{} 0 R".format(kid) for kid in self.kids)))
+    append(PdfWriter.CATALOG, "<</Type /Catalog /Pages {} 0 R>>".format(
+        PdfWriter.PAGES))
+
+    count = len(self.order) + 3
+    output.append("xref\n0 {}\n0000000000 65535 f \n".format(count))
+    for num in xrange(1, count):
+      output.append("{:010d} 00000 n \n".format(offsets[num]))
+    output.append("trailer\n<</Size {} /Root {} 0 R /Info {}>>\nstartxref\n{}\n%%EOF\n"
+        .format(count, PdfWriter.CATALOG, info, size[0]))
+    with open(filename, "wb") as f:
+      f.write("".join(output))
@@ -1,9 +1,24 @@
 import xml.etree.ElementTree as ET
+import os
+import re
 import string
+from functools import partial
 from os.path import exists, isabs, join
+from threading import Lock
+from xml.parsers import expat
 from datetime import date
 from parseable import XmlParseable, ImproperXmlException
-from config import get_topics, get_types, get_blurb, get_classname, get_inclusions, get_problem_root, get_professor, get_default_author, get_shortname
+from stringutil import PREAMBLE_END, strip_latex_pieces
+from corpus import members
+from config import get_topics, get_types, get_topic_set, get_type_set, get_blurb, get_classname, get_inclusions, get_problem_root, get_professor, get_default_author, get_shortname
+
+# The PDF page attribute which SplitDocument marks each page with the number
+# of the problem on it
+SPLIT_KEY = "Problem22"
+
+# The fields of a version which hold most of its text, and which are only read
+# when they are used if the problem file was parsed with Problem.parse_file
+TEXT_FIELDS = ('body', 'solution', 'rubric')
   
 def split_add(before, raw):
   """Used by any fields which can be whitespace separated"""
@@ -11,10 +26,91 @@ def split_add(before, raw):
     return before
   return before + map(lambda x: string.strip(x), string.split(raw))
       
+class Vocabulary(object):
+  """
+  Numbers every word (topic or type) which versions use, starting with the
+  configured ones, so that each version can keep its words as the bits of 
+  one int. Words are only ever added, so that masks stay valid.
+  """
+  def __init__(self, configured):
+    self.configured = configured
+    self.words = None
+    self.bits = None
+    self.lock = Lock()
+    # The last set of words passed to within, and their mask
+    self.allowed = (None, 0)
+
+  def __add(self, word):
+    # The word goes in before its bit, which is read without the lock
+    if word not in self.bits:
+      self.words.append(_intern(word))
+      self.bits[word] = len(self.words) - 1
+
+  def bit(self, word):
+    bit = self.bits.get(word) if self.bits is not None else None
+    if bit is None:
+      with self.lock:
+        if self.bits is None:
+          self.words = []
+          self.bits = dict()
+          for configured in self.configured():
+            self.__add(configured)
+        self.__add(word)
+      bit = self.bits[word]
+    return bit
+
+  def encode(self, words):
+    """
+    words as a mask, or as a tuple if the mask would lose their order (they
+    aren't in the order of their bits, or some are repeated)
+    """
+    mask = 0
+    last = -1
+    for word in words:
+      bit = self.bit(word)
+      if bit <= last:
+        return tuple(_intern(word) for word in words)
+      mask |= 1 << bit
+      last = bit
+    return mask
+
+  def within(self, stored, words):
+    """Whether every word in stored (from encode) is in the frozenset words"""
+    if isinstance(stored, tuple):
+      return words.issuperset(stored)
+    if self.allowed[0] is not words:
+      mask = 0
+      for word in words:
+        mask |= 1 << self.bit(word)
+      self.allowed = (words, mask)
+    return not stored & ~self.allowed[1]
+
+  def decode(self, stored):
+    if isinstance(stored, tuple):
+      return list(stored)
+    return [self.words[bit] for bit in members(stored)]
+
+TOPICS = Vocabulary(get_topics)
+TYPES = Vocabulary(get_types)
+
+def _intern(text):
+  """Interns text, which is shared by many versions (like an author or year)"""
+  return intern(text) if type(text) is str else text
+
 class Version(XmlParseable):
   """
   Internal representation of a problem Version.
+
+  A collection can hold many thousands of these, so they have slots, and 
+  keep their topics and types as masks (see Vocabulary) and their other lists
+  as tuples. Those are still read and assigned as lists, but the lists are
+  copies: change one by assigning it back.
   """
+  __slots__ = ('filename', 'vid', 'standalone', 'separateFromPrevious', 
+      '_authors', '_topics', '_types', '_year', '_params', '_deps', 
+      '_resources', 'body', 'solution', 'rubric', '_loader', '_present', 
+      'usedin')
+
   def xml_assert(self, predicate, str):
     """Overridden to show ID"""
     if not predicate:
@@ -32,17 +128,147 @@ class Version(XmlParseable):
     self.topics = []
     self.types = []
     self.year = None
-    self.params = dict()
+    self._params = None
     self.deps = []
     self.resources = []
     self.body = None
     self.solution = None
     self.rubric = None
+    self._loader = None
+    self._present = None
     
     # UsedIn objects are added to Versions for printing purposes only -
     #  the Problem contains the actual UsedIn list
-    self.usedin = []
+    self.usedin = ()
+
+  @property
+  def authors(self):
+    return list(self._authors)
+
+  @authors.setter
+  def authors(self, authors):
+    self._authors = tuple(_intern(author) for author in authors)
+
+  @property
+  def topics(self):
+    return TOPICS.decode(self._topics)
+
+  @topics.setter
+  def topics(self, topics):
+    self._topics = TOPICS.encode(topics)
+
+  @property
+  def types(self):
+    return TYPES.decode(self._types)
+
+  @types.setter
+  def types(self, types):
+    self._types = TYPES.encode(types)
+
+  @property
+  def year(self):
+    return self._year
+
+  @year.setter
+  def year(self, year):
+    self._year = _intern(year)
+
+  @property
+  def params(self):
+    """Unlike the lists, a dictionary which can be changed in place"""
+    if self._params is None:
+      self._params = dict()
+    return self._params
+
+  @params.setter
+  def params(self, params):
+    self._params = params
+
+  @property
+  def deps(self):
+    return list(self._deps)
+
+  @deps.setter
+  def deps(self, deps):
+    self._deps = tuple(deps)
+
+  @property
+  def resources(self):
+    return list(self._resources)
+
+  @resources.setter
+  def resources(self, resources):
+    self._resources = tuple(resources)
     
+  def __getstate__(self):
+    """
+    Pickled (as when scanning in several processes) with the topics and types
+    as words, since their masks only mean anything to this process's
+    vocabularies
+    """
+    state = dict((name, object.__getattribute__(self, name)) 
+        for name in self.__slots__ if self.__has(name))
+    state['_topics'] = self.topics
+    state['_types'] = self.types
+    return state
+
+  def __setstate__(self, state):
+    for name, value in state.iteritems():
+      setattr(self, name, value)
+    self.topics = state['_topics']
+    self.types = state['_types']
+
+  def defer(self, loader, present):
+    """
+    Leaves the body, solution and rubric unread until one of them is used, 
+    when loader() gives all three. present holds those which aren't empty, 
+    so that the version can be validated without reading them.
+    """
+    for field in TEXT_FIELDS:
+      if self.__has(field):
+        delattr(self, field)
+    self._loader = loader
+    self._present = sum(1 << i for i, field in enumerate(TEXT_FIELDS) 
+        if field in present)
+
+  def deferred(self):
+    """Whether the body, solution and rubric are still waiting to be read"""
+    return self._loader is not None
+
+  def load(self):
+    """
+    Reads the body, solution and rubric now if they were deferred, so that 
+    the errors reading them (ImproperXmlException if the file has changed or
+    can't be read) are raised here rather than wherever they are first used
+    """
+    for field in TEXT_FIELDS:
+      getattr(self, field)
+
+  def __has(self, name):
+    """Whether an attribute is set, without reading deferred fields"""
+    try:
+      object.__getattribute__(self, name)
+    except AttributeError:
+      return False
+    return True
+
+  def __getattr__(self, name):
+    # Only called for attributes which aren't set, like deferred fields
+    if name not in TEXT_FIELDS or self._loader is None:
+      raise AttributeError(name)
+    for field, text in zip(TEXT_FIELDS, self._loader()):
+      if not self.__has(field):
+        setattr(self, field, text)
+    self._loader = None
+    self._present = None
+    return getattr(self, name)
+
+  def has_text(self, field):
+    """Whether one of TEXT_FIELDS isn't empty, without reading it if deferred"""
+    if self.__has(field):
+      return bool(getattr(self, field))
+    return bool(self._present >> TEXT_FIELDS.index(field) & 1)
+
   def add_defaults(self):
     self.authors = [get_default_author()]
     self.year = str(date.today().year)
@@ -59,21 +285,41 @@ class Version(XmlParseable):
       usedins = "\\textbf{Never Before Used}"
     return "\\\\".join([filename + version, topics, types, authors, usedins])
     
-  def _solution(self):
-    return ("\\begin{mdframed}\n{\\subsubsection*{Solution}\\setcounter{enum22i}{0}\n\n" 
-              + self.solution + "}\\end{mdframed}\n")
-  def _rubric(self):
-    return ("\\begin{mdframed}\n{\\subsubsection*{Rubric}\\setcounter{enum22i}{0}\n\n" 
-              + self.rubric + "}\\end{mdframed}\n")
-    
   def pretty_print(self, solution=False, rubric=False, metadata=False):
     """Prints this version's contents as valid LaTeX, for building"""
-    return ("\n".join(["\\newcommand\\" + name + "{" + value + "}" 
-              for name, value in self.params.iteritems()]) +
-            (self._meta() if metadata else "")
-            + "\n\n{\\setcounter{enum22i}{0}\n" + self.body + "\n}" +
-             (self._solution() if solution else "") +
-             (self._rubric() if rubric else ""))
+    return "".join(text for text, fragment in self.pieces(solution, rubric, metadata))
+    
+  def pieces(self, solution=False, rubric=False, metadata=False):
+    """
+    Yields pretty_print in pieces, as (text, fragment) pairs: fragments are 
+    this version's own fields, whose stripped forms are remembered between 
+    builds (see stringutil.strip_latex_pieces)
+    """
+    for text, fragment, field in self.fields(solution, rubric, metadata):
+      yield text, fragment
+
+  def fields(self, solution=False, rubric=False, metadata=False):
+    """
+    Yields pieces as (text, fragment, field) triples, where field names the
+    field a fragment is (the body, solution, rubric or a parameter), and is 
+    None for the LaTeX around them
+    """
+    for i, (name, value) in enumerate(self.params.iteritems()):
+      yield ("\n" if i else "") + "\\newcommand\\" + name + "{", False, None
+      yield value, True, "parameter \\" + name
+      yield "}", False, None
+    yield ((self._meta() if metadata else "") + 
+        "\n\n{\\setcounter{enum22i}{0}\n"), False, None
+    yield self.body, True, "body"
+    yield "\n}", False, None
+    if solution:
+      yield "\\begin{mdframed}\n{\\subsubsection*{Solution}\\setcounter{enum22i}{0}\n\n", False, None
+      yield self.solution, True, "solution"
+      yield "}\\end{mdframed}\n", False, None
+    if rubric:
+      yield "\\begin{mdframed}\n{\\subsubsection*{Rubric}\\setcounter{enum22i}{0}\n\n", False, None
+      yield self.rubric, True, "rubric"
+      yield "}\\end{mdframed}\n", False, None
     
   def to_element(self):
     version = ET.Element('version')
@@ -118,15 +364,17 @@ class Version(XmlParseable):
   def validate(self):
     """Asserts that the Version satisfies the minimal requirements of being complete"""
     self.xml_assert(self.authors, "No authors")
-    self.xml_assert(self.body, "No body")
-    self.xml_assert(self.rubric, "No rubric")
-    self.xml_assert(self.solution, "No solution")
-    self.xml_assert(self.topics, "No topics")
-    for t in self.topics:
-      self.xml_assert(t in get_topics(), "Invalid topic: {}".format(t))
-    self.xml_assert(self.types, "No types")
-    for t in self.types:
-      self.xml_assert(t in get_types(), "Invalid type: {}".format(t))
+    self.xml_assert(self.has_text('body'), "No body")
+    self.xml_assert(self.has_text('rubric'), "No rubric")
+    self.xml_assert(self.has_text('solution'), "No solution")
+    self.xml_assert(self._topics, "No topics")
+    if not TOPICS.within(self._topics, get_topic_set()):
+      for t in self.topics:
+        self.xml_assert(t in get_topic_set(), "Invalid topic: {}".format(t))
+    self.xml_assert(self._types, "No types")
+    if not TYPES.within(self._types, get_type_set()):
+      for t in self.types:
+        self.xml_assert(t in get_type_set(), "Invalid type: {}".format(t))
     self.xml_assert(self.year, "No year")
     self.xml_assert(self.vid is not None, "No id")
       
@@ -150,7 +398,7 @@ class Version(XmlParseable):
     
   def __parse_resource(self, attributes, body):
     self.xml_assert(body, "empty resource body")
-    self.resources.append(body)
+    self.resources = self.resources + [body]
     
   def __parse_rubric(self, attributes, body):
     self.xml_assert(self.rubric is None, "duplicate rubric")
@@ -215,6 +463,8 @@ class Problem(XmlParseable):
   """
   Internal representation of a Problem, which contains many Versions 
   """
+  __slots__ = ('filename', 'versions', 'used_in')
+
   def __init__(self, filename):
     self.filename = filename
     self.versions = dict()
@@ -232,12 +482,16 @@ class Problem(XmlParseable):
   def next_id(self):
     return 1 + max(self.versions)
     
-  def parse_element(self, root, validate_versions=True):
+  def parse_element(self, root, validate_versions=True, deferred=None):
+    """
+    deferred, if given, has the (loader, present) to defer the text of the
+    version in each child of root with (see Version.defer), or None
+    """
     self.xml_assert(root.tag == 'problem', 
         "Invalid root tag '{}' (should be 'problem')".format(root.tag))
     self.xml_assert(len(root) > 0, "Empty file")
     
-    for child in root:
+    for i, child in enumerate(root):
       if child.tag == 'usedin':
         self.xml_assert('year' in child.attrib, "usedin tag must have year")
         self.xml_assert(child.text, "usedin tag must have text")
@@ -249,6 +503,8 @@ class Problem(XmlParseable):
       else:
         version = Version(self.filename)
         version.parse_element(child)
+        if deferred is not None and deferred[i] is not None:
+          version.defer(*deferred[i])
         if validate_versions:
           version.validate()
         self.xml_assert(version.vid not in self.versions, 
@@ -260,6 +516,15 @@ class Problem(XmlParseable):
       
   def parse_tree(self, tree, validate_versions=True):
     self.parse_element(tree.getroot(), validate_versions)
+
+  def parse_file(self, validate_versions=True):
+    """
+    Parses the file at self.filename, like parse_tree(ET.parse(filename)) 
+    but much faster when only the versions' metadata is needed: their 
+    TEXT_FIELDS are skipped, and read again from the file when they are used
+    """
+    root, deferred = skeleton(self.filename)
+    self.parse_element(root, validate_versions, deferred)
       
   def to_element(self):
     root = ET.Element('problem')
@@ -273,12 +538,204 @@ class Problem(XmlParseable):
       root.append(self.versions[key].to_element())
     return root
       
+def _ascii(text):
+  """Text as ElementTree gives it: str when ASCII, unicode otherwise"""
+  try: return str(text)
+  except UnicodeEncodeError: return text
+
+# The start of a tag which may open one of TEXT_FIELDS
+TEXT_FIELD_TAG = re.compile(r"<({})[\s/>]".format("|".join(TEXT_FIELDS)))
+
+class SkeletonReader:
+  """
+  Builds the skeleton of a problem file from expat's events (see skeleton),
+  which is the tree ElementTree would build, without anything nested below
+  the children of versions, or any text in their TEXT_FIELDS
+  """
+  def __init__(self, filename, signature):
+    self.filename = filename
+    self.signature = signature
+    self.parser = expat.ParserCreate()
+    self.parser.XmlDeclHandler = self.declaration
+    self.parser.StartElementHandler = self.start
+    self.parser.EndElementHandler = self.end
+    self.parser.CharacterDataHandler = self.data
+    self.parser.StartDoctypeDeclHandler = self.doctype_declaration
+    self.encoding = "UTF-8"
+    # Whether the file has a DOCTYPE, whose entities its text may use
+    self.doctype = False
+    self.path = []
+    # The open elements of the skeleton
+    self.elements = []
+    self.root = None
+    self.deferred = []
+    # The element whose text is being read, and its text so far (or None 
+    # for TEXT_FIELDS, whose text is skipped)
+    self.reading = None
+    self.text = None
+    self.present = None
+    # Where the open element in TEXT_FIELDS starts, if one is open
+    self.field = None
+
+  def read(self, contents):
+    """
+    Parses contents, checking the text of every version's TEXT_FIELDS 
+    without keeping it: expat is given it with no handler for its text, 
+    unless it has markup which needs the handlers
+    """
+    position = 0
+    while True:
+      match = TEXT_FIELD_TAG.search(contents, position)
+      if match is None:
+        break
+      opened = contents.find(">", match.end() - 1) + 1
+      if not opened:
+        break
+      self.parser.Parse(contents[position:opened], False)
+      position = opened
+      if self.field != match.start():
+        continue
+      name = match.group(1)
+      closed = contents.find("<", opened)
+      if not contents.startswith("</" + name, closed):
+        # Has markup, which is left to expat
+        continue
+      if closed > opened:
+        self.present.add(name)
+      self.parser.CharacterDataHandler = None
+      try:
+        self.parser.Parse(contents[opened:closed], False)
+      finally:
+        self.parser.CharacterDataHandler = self.data
+      position = closed
+    self.parser.Parse(contents[position:], True)
+
+  def position(self):
+    """The position in the file of the current event"""
+    return self.parser.CurrentByteIndex
+
+  def declaration(self, version, encoding, standalone):
+    if encoding:
+      self.encoding = encoding
+
+  def doctype_declaration(self, name, system_id, public_id, has_subset):
+    self.doctype = True
+
+  def finish_text(self):
+    if self.reading is None:
+      return
+    if self.text is None:
+      # Not None, so that a second one is still found to be a duplicate
+      self.reading.text = ""
+    elif self.text:
+      self.reading.text = _ascii(u"".join(self.text))
+    self.reading = None
+
+  def start(self, tag, attributes):
+    self.finish_text()
+    depth = len(self.path)
+    self.path.append(tag)
+    if depth > 2:
+      return
+    if attributes:
+      attributes = dict((_ascii(name), _ascii(value))
+          for name, value in attributes.iteritems())
+    element = ET.Element(_ascii(tag), attributes)
+    if depth == 0:
+      self.root = element
+    else:
+      self.elements[depth - 1].append(element)
+    del self.elements[depth:]
+    self.elements.append(element)
+    if depth == 1:
+      self.begin = self.position()
+      self.present = set()
+    self.reading = element
+    skipped = depth == 2 and self.path[1] == 'version' and tag in TEXT_FIELDS
+    self.text = None if skipped else []
+    if skipped:
+      self.field = self.position()
+
+  def data(self, text):
+    if self.reading is None:
+      return
+    if self.text is None:
+      self.present.add(self.reading.tag)
+    else:
+      self.text.append(text)
+
+  def end(self, tag):
+    self.finish_text()
+    self.field = None
+    depth = len(self.path) - 1
+    self.path.pop()
+    if depth != 1:
+      return
+    end = self.position()
+    if tag == 'version' and end > self.begin:
+      self.deferred.append((partial(load_text, self.filename, self.begin, 
+          end, self.encoding, self.signature), self.present))
+    else:
+      self.deferred.append(None)
+
+def skeleton(filename):
+  """
+  Reads a problem file without building its whole tree, returning the tree's
+  root with the text of every version's TEXT_FIELDS left out (see 
+  SkeletonReader), and a list with the (loader, present) to defer them with 
+  (see Version.defer) for each child of the root, or None. A file with a 
+  DOCTYPE is read whole instead, since its versions can't be read without it,
+  and None is returned in place of the list. Raises ET.ParseError like 
+  ET.parse.
+  """
+  with open(filename, 'rb') as f:
+    stat_info = os.fstat(f.fileno())
+    contents = f.read()
+  reader = SkeletonReader(filename, (stat_info.st_size, stat_info.st_mtime))
+  try:
+    reader.read(contents)
+  except expat.ExpatError as e:
+    error = ET.ParseError("{}: line {}, column {}".format(
+        expat.ErrorString(e.code), e.lineno, e.offset))
+    error.code = e.code
+    error.position = e.lineno, e.offset
+    raise error
+  if reader.doctype:
+    return ET.fromstring(contents), None
+  return reader.root, reader.deferred
+
+def load_text(filename, begin, end, encoding, signature):
+  """
+  Reads the TEXT_FIELDS of the version between bytes begin and end (the 
+  start of its closing tag) of a problem file
+  """
+  try:
+    with open(filename, 'rb') as f:
+      stat_info = os.fstat(f.fileno())
+      if (stat_info.st_size, stat_info.st_mtime) != signature:
+        raise ImproperXmlException(
+            "{} has changed since it was read".format(filename))
+      f.seek(begin)
+      contents = f.read(end - begin)
+  except IOError as e:
+    raise ImproperXmlException("Could not read {} again: {}".format(
+        filename, e.strerror))
+  try:
+    element = ET.fromstring('<?xml version="1.0" encoding="{}"?>\n'.format(
+        encoding) + contents + "</version>")
+  except ET.ParseError as e:
+    raise ImproperXmlException("Could not read {} again: {}".format(
+        filename, e))
+  texts = dict((child.tag, child.text) for child in element 
+      if child.tag in TEXT_FIELDS)
+  return tuple(texts.get(field) for field in TEXT_FIELDS)
+
 class Document(XmlParseable):
   """
   Internal representation of a Document, which contains an ordered list of Versions to print as well
   as metadata used to create headers or other LaTeX things.
   """
-  def __init__(self, filename=None, blurb=get_blurb()):
+  def __init__(self, filename=None, blurb=None):
     self.year = None
     self.due = None
     self.name = None
@@ -286,9 +743,109 @@ class Document(XmlParseable):
     self.versions = []
     self.blurb = blurb
     self.private = False
+
+  @property
+  def blurb(self):
+    """The configured blurb unless another was given, read when first used"""
+    if self._blurb is None:
+      self._blurb = get_blurb()
+    return self._blurb
+
+  @blurb.setter
+  def blurb(self, blurb):
+    self._blurb = blurb
+    
+  def build(self, solutions=False, rubrics=False, metadata=False, stripped=False):
+    """
+    The LaTeX of the document, with its comments already removed if stripped
+    (which is much faster than stripping the result, since the problems' 
+    fields are only stripped once)
+    """
+    if stripped:
+      return u"".join(self.stream(solutions, rubrics, metadata, stripped))
+    return "".join(self.stream(solutions, rubrics, metadata, stripped))
+    
+  def stream(self, solutions=False, rubrics=False, metadata=False, 
+      stripped=False, source_map=None):
+    """
+    Yields the text of build() a little at a time, filling in source_map (a
+    SourceMap) if one is given
+    """
+    if source_map is None:
+      pieces = self.pieces(solutions, rubrics, metadata)
+    else:
+      pieces = source_map.track(self.sources(solutions, rubrics, metadata), 
+          count=not stripped)
+    if stripped:
+      return strip_latex_pieces(pieces, 
+          source_map.lengths if source_map is not None else None)
+    return (text for text, fragment in pieces)
     
-  def build(self, solutions=False, rubrics=False, metadata=False):
-    return self._header() + self._document(self._problems(solutions, rubrics, metadata))
+  def write_to(self, stream, solutions=False, rubrics=False, metadata=False, 
+      stripped=False, source_map=None):
+    """
+    Writes build() to a file-like object as UTF-8, without ever holding the
+    whole document in memory
+    """
+    for text in self.stream(solutions, rubrics, metadata, stripped, 
+        source_map):
+      stream.write(text.encode('UTF-8'))
+    
+  def pieces(self, solutions=False, rubrics=False, metadata=False):
+    """
+    Yields the LaTeX of the document in pieces, like Version.pieces. The 
+    header (mostly the configured include files) is the same every time a 
+    document is built, so it is a fragment too.
+    """
+    for text, fragment, origin in self.sources(solutions, rubrics, metadata):
+      yield text, fragment
+
+  def sources(self, solutions=False, rubrics=False, metadata=False):
+    """
+    Yields pieces as (text, fragment, origin) triples, where origin is the
+    (version, field) a piece of a problem came from (see Version.fields), and
+    None for the rest of the document
+    """
+    yield self.build_header(), True, None
+    yield "\\begin{document}\n" + self._document(""), False, None
+    for piece in self._problem_pieces(solutions, rubrics, metadata):
+      yield piece
+    yield "\\end{document}", False, None
+    
+  def build_header(self, stripped=False):
+    """The LaTeX which comes before \\begin{document}"""
+    if stripped:
+      return u"".join(strip_latex_pieces([(self._header(), True)]))
+    return self._header()
+    
+  def build_body(self, solutions=False, rubrics=False, metadata=False):
+    """The LaTeX between \\begin{document} and \\end{document}"""
+    return self._document(self._problems(solutions, rubrics, metadata))
+
+  def parts(self, solutions=False, rubrics=False, metadata=False, 
+      stripped=False):
+    """
+    The LaTeX of the title and of each problem, numbered as in the whole 
+    document, for rendering separately (see pdfbuilder.build_stitched) 
+    between build_header() and \\end{document}
+    """
+    parts = [[(self._document(""), False)]]
+    parts.extend([(text, fragment) for text, fragment, origin 
+        in self._problem(i, solutions, rubrics, metadata)]
+        for i in range(len(self.versions)))
+    if stripped:
+      return [u"".join(strip_latex_pieces(part)) for part in parts]
+    return ["".join(text for text, fragment in part) for part in parts]
+
+  def problem_document(self, i):
+    """A document of only the ith (from 0) problem, as built for grading"""
+    problem_document = Document()
+    problem_document.name = self.name + " Problem " + str(i+1)
+    problem_document.year = "1901"
+    problem_document.due = "Grading"
+    problem_document.blurb = ""
+    problem_document.versions.append(self.versions[i])
+    return problem_document
     
   def to_element(self):
     assign = ET.Element('assignment')
@@ -329,18 +886,17 @@ class Document(XmlParseable):
     return "\n".join(["\\usepackage{" + x + "}" for x in deps]) if deps else ""
   
   def _document(self, body):
-    return """\\begin{document}
-  \\thispagestyle{firstpagestyle}
+    return """  \\thispagestyle{firstpagestyle}
   \\begin{center}
     {\\huge \\textbf{""" + self.name + """}}\n
     {\\large \\textit{Due: """ + self.due + """}}
-  \\end{center}\n\n""" + self.blurb + "\n\n" + body + "\\end{document}"
+  \\end{center}\n\n""" + self.blurb + "\n\n" + body
   
   def _header(self):
-    dependencies = self._additional_dependencies()
-    return ("\\documentclass[12pt,letterpaper]{article}\n\n" +
-      get_inclusions() +
-      """\\fancypagestyle{firstpagestyle} {
+    return self._preamble() + self._page_styles() + "\\pagestyle{fancyplain}\n\n"
+
+  def _page_styles(self):
+    return ("""\\fancypagestyle{firstpagestyle} {
   \\renewcommand{\\headrulewidth}{0pt}%
   \\lhead{\\textbf{""" + get_shortname() + """}}%
   \\chead{\\textbf{""" + get_classname() + """}}%
@@ -351,14 +907,35 @@ class Document(XmlParseable):
   \\lhead{\\textbf{""" + get_shortname() + """}}%
   \\chead{""" + self.name + """}%
   \\rhead{\\textit{""" + (self.due if len(self.due) < 30 else "") + """}}%
-}\n\\pagestyle{fancyplain}\n""" + dependencies + "\n\n")
+}\n""")
+      
+  def _preamble(self):
+    """
+    The part of the header which only loads packages, ending in the mark that
+    allows pdfbuilder to precompile it into a format
+    """
+    dependencies = self._additional_dependencies()
+    return ("\\documentclass[12pt,letterpaper]{article}\n\n" +
+      get_inclusions() + dependencies + "\n" + PREAMBLE_END + "\n")
 
   def _problems(self, solutions=False, rubrics=False, metadata=False):
-    return "\n\n".join(
-      [("\\noindent\\makebox[\\linewidth]{\\rule{\\paperwidth}{0.4pt}}\n\n" if v.separateFromPrevious else "") +
-      "\\subsection*{Problem " + str(i+1) + "}\n{\n\\nopagebreak " + 
-        v.pretty_print(solutions,rubrics,metadata) + "\n}\n\n" 
-        for i, v in enumerate(self.versions)])
+    return "".join(text for text, fragment, origin
+        in self._problem_pieces(solutions, rubrics, metadata))
+        
+  def _problem_pieces(self, solutions=False, rubrics=False, metadata=False):
+    for i in range(len(self.versions)):
+      for piece in self._problem(i, solutions, rubrics, metadata):
+        yield piece
+
+  def _problem(self, i, solutions=False, rubrics=False, metadata=False):
+    """The sources of the ith (from 0) problem"""
+    v = self.versions[i]
+    yield (("\n\n" if i else "") +
+      ("\\noindent\\makebox[\\linewidth]{\\rule{\\paperwidth}{0.4pt}}\n\n" if v.separateFromPrevious else "") +
+      "\\subsection*{Problem " + str(i+1) + "}\n{\n\\nopagebreak "), False, (v, None)
+    for text, fragment, field in v.fields(solutions, rubrics, metadata):
+      yield text, fragment, (v, field)
+    yield "\n}\n\n", False, (v, None)
         
   def __parse_blurb(self, attributes, body):
     self.xml_assert(not attributes, "blurb tag takes no attributes")
@@ -382,7 +959,7 @@ class Document(XmlParseable):
       body = tentative
          
     prob = Problem(body)
-    prob.parse_tree(ET.parse(body))
+    prob.parse_file()
     if 'version' in attributes:
       try: self.versions.append(prob.versions[int(attributes['version'])])
       except ValueError:
@@ -416,7 +993,93 @@ class Document(XmlParseable):
           "Invalid tag '{}'".format(tag.tag))
       Document.__parsers[tag.tag](self, tag.attrib, tag.text)
     
-class UsedIn:
+class SplitDocument(Document):
+  """
+  A document which renders each problem of another the way its 
+  problem_document would be rendered, one after another, marking every page 
+  with the number of its problem (see SPLIT_KEY) so that the PDF can be split
+  into one per problem afterwards
+  """
+  def __init__(self, document):
+    Document.__init__(self, document.filename, "")
+    self.name = document.name
+    self.year = document.year
+    self.due = document.due
+    self.versions = document.versions
+    self.problems = [document.problem_document(i) 
+        for i in range(len(document.versions))]
+
+  def sources(self, solutions=False, rubrics=False, metadata=False):
+    yield self.build_header(), True, None
+    # pdfsplit can only read PDFs without object streams
+    yield ("\\begin{document}\n\\pdfobjcompresslevel=0\n" +
+        "\\edef\\splitpageattrs{\\the\\pdfpageattr}\n"), False, None
+    for i, problem in enumerate(self.problems):
+      yield (("\\clearpage\n" if i else "") + "\\setcounter{page}{1}\n" +
+          "\\pdfpageattr\\expandafter{\\splitpageattrs /" + SPLIT_KEY + " " + 
+          str(i+1) + "}\n" + problem._page_styles() + 
+          "\\pagestyle{fancyplain}\n" + problem._document("")), False, None
+      for piece in problem._problem_pieces(solutions, rubrics, metadata):
+        yield piece
+    yield "\\end{document}", False, None
+
+class SourceMap:
+  """
+  Where each part of a built document came from, filled in by passing it to
+  Document.stream, so that LaTeX errors can be traced back to problem files
+  """
+  def __init__(self):
+    self.origins = []
+    # The length of each piece in the built document
+    self.lengths = []
+
+  def track(self, sources, count=True):
+    """
+    Yields the (text, fragment) of each of a document's sources, recording 
+    their origins (and lengths, if count; otherwise strip_latex_pieces must
+    be given lengths to fill in)
+    """
+    del self.origins[:]
+    del self.lengths[:]
+    for text, fragment, origin in sources:
+      self.origins.append(origin)
+      if count:
+        self.lengths.append(len(text))
+      yield text, fragment
+
+  def locate(self, document, line):
+    """
+    The (version, field) origins of the given line (from 1) of document, the
+    text that was built, preferring fields to the LaTeX around them
+    """
+    lines = document.split(u"\n")
+    if not 0 < line <= len(lines):
+      return []
+    start = sum(len(text) + 1 for text in lines[:line - 1])
+    end = start + len(lines[line - 1])
+    found = []
+    offset = 0
+    for origin, length in zip(self.origins, self.lengths):
+      if offset > end:
+        break
+      if (origin is not None and length and origin not in found and 
+          (offset <= start < offset + length or start <= offset < end)):
+        found.append(origin)
+      offset += length
+    fields = [origin for origin in found if origin[1] is not None]
+    return fields or found
+
+  @staticmethod
+  def describe(origin):
+    version, field = origin
+    where = "{} (version {})".format(version.filename, version.vid)
+    if field is None:
+      return where
+    return "the {} of {}".format(field, where)
+    
+class UsedIn(object):
+  __slots__ = ('year', 'assignment_name', 'private')
+
   def __init__(self, year, assignment_name, private=False):
     self.year = year
     self.assignment_name = assignment_name
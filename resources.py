@@ -0,0 +1,251 @@
+import atexit
+import errno
+import json
+import os
+from cache import hasher
+from config import get_cache_root, get_resource_root
+from os.path import abspath, basename, isdir, join, normpath, relpath
+from shutil import copy
+from threading import Lock
+
+# Resources are the files (mostly images) which problems include from the
+# resource root. Every build needs the hashes of their contents for its cache
+# key, so those are kept in a manifest in the cache, and only read again once
+# a file's size or modification time changes. Which resources exist (and how
+# big they are) is kept in a listing of the whole root, which is only walked
+# again once one of its directories changes.
+
+class ResourceError(Exception):
+  """Raised with every (resource, errno) which stopped resources being staged"""
+  def __init__(self, problems):
+    Exception.__init__(self, "Could not stage {}".format(
+        ", ".join(resource for resource, error in problems)))
+    self.problems = problems
+
+__lock = Lock()
+# The manifest: path -> [size, mtime, content hash]
+__hashes = None
+__changed = False
+
+def manifest_path():
+  return join(get_cache_root(), "resources.manifest")
+
+def __load():
+  global __hashes
+  if __hashes is None:
+    try:
+      with open(manifest_path()) as f:
+        __hashes = json.load(f)
+    except (IOError, ValueError):
+      __hashes = dict()
+
+def __store(path, value):
+  """Writes value to path in the cache as JSON, returning whether it could"""
+  try:
+    os.makedirs(get_cache_root())
+  except OSError as e:
+    if e.errno != errno.EEXIST: return False
+  temporary = path + ".{}.tmp".format(os.getpid())
+  try:
+    with open(temporary, "w") as f:
+      json.dump(value, f)
+    os.rename(temporary, path)
+  except (IOError, OSError):
+    return False
+  return True
+
+@atexit.register
+def save_manifest():
+  """Writes the manifest back to the cache, if any hashes were added"""
+  global __changed
+  with __lock:
+    if __changed and __store(manifest_path(), __hashes):
+      __changed = False
+
+def forget_manifest():
+  """Makes the next hash read the manifest again, dropping unsaved hashes"""
+  global __hashes, __changed
+  with __lock:
+    __hashes = None
+    __changed = False
+
+# The listing, once read or walked in this process
+__listing = None
+
+def listing_path():
+  return join(get_cache_root(), "resources.listing")
+
+def __walk(root):
+  """
+  Lists every file beneath root (following links, as resource paths do), 
+  returning the modification time of every directory and the (size, mtime)
+  of every file, by path relative to root
+  """
+  directories = dict()
+  files = dict()
+  # Directories already walked, so that a link to a parent isn't followed
+  walked = set()
+  for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+    relative = relpath(dirpath, root)
+    try:
+      stat_info = os.stat(dirpath)
+    except OSError:
+      continue
+    if (stat_info.st_dev, stat_info.st_ino) in walked:
+      del dirnames[:]
+      continue
+    walked.add((stat_info.st_dev, stat_info.st_ino))
+    directories[relative] = stat_info.st_mtime
+    for filename in filenames:
+      try:
+        stat_info = os.stat(join(dirpath, filename))
+      except OSError:
+        continue
+      files[normpath(join(relative, filename))] = (stat_info.st_size, 
+          stat_info.st_mtime)
+  return directories, files
+
+def __unchanged(root, directories):
+  for relative, mtime in directories.iteritems():
+    try:
+      if os.stat(join(root, relative)).st_mtime != mtime:
+        return False
+    except OSError:
+      return False
+  return True
+
+def listing():
+  """
+  Every file beneath the resource root, as a dictionary from its path 
+  relative to the root to its (size, mtime), or None if there is no resource
+  root. The walk which finds them is cached until the modification time of
+  some directory beneath the root changes (that is, until a file is added, 
+  removed or renamed), so the sizes of files which have been changed in place
+  may be out of date.
+  """
+  global __listing
+  with __lock:
+    if __listing is not None:
+      return __listing[1]
+    root = get_resource_root()
+    if root is None or not isdir(root):
+      return None
+    root = abspath(root)
+    try:
+      with open(listing_path()) as f:
+        cached = json.load(f)
+      if (cached["root"] == root and 
+          __unchanged(root, cached["directories"])):
+        __listing = root, dict((relative, tuple(signature)) 
+            for relative, signature in cached["files"].iteritems())
+        return __listing[1]
+    except (IOError, ValueError, KeyError, TypeError):
+      pass
+    directories, files = __walk(root)
+    __listing = root, files
+    __store(listing_path(), 
+        {"root": root, "directories": directories, "files": files})
+    return files
+
+def forget_listing():
+  """Makes the next listing() check whether the resource root has changed"""
+  global __listing
+  with __lock:
+    __listing = None
+
+def exists(resource):
+  """
+  Whether a resource exists: the listing answers for most, and the rest 
+  (like absolute paths, which aren't beneath the root) are looked for
+  """
+  files = listing()
+  if files is not None and normpath(resource) in files:
+    return True
+  return get_resource_root() is not None and os.path.exists(
+      resource_path(resource))
+
+def size(resource):
+  """The size of a resource (see exists), or None if it doesn't exist"""
+  files = listing()
+  if files is not None and normpath(resource) in files:
+    return files[normpath(resource)][0]
+  if get_resource_root() is None:
+    return None
+  try:
+    return os.path.getsize(resource_path(resource))
+  except OSError:
+    return None
+
+def resource_path(resource):
+  return join(get_resource_root(), resource)
+
+def content_hash(resource):
+  """
+  The hash of a resource's contents, from the manifest if the file hasn't
+  changed. Raises IOError or OSError if it can't be read.
+  """
+  global __changed
+  path = abspath(resource_path(resource))
+  try:
+    stat_info = os.stat(path)
+  except OSError:
+    with __lock:
+      __load()
+      if __hashes.pop(path, None) is not None:
+        __changed = True
+    raise
+  signature = [stat_info.st_size, stat_info.st_mtime]
+  with __lock:
+    __load()
+    known = __hashes.get(path)
+    if known is not None and known[:2] == signature:
+      return known[2]
+  key = hasher()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 16), ""):
+      key.update(block)
+  with __lock:
+    __hashes[path] = signature + [key.hexdigest()]
+    __changed = True
+  return key.hexdigest()
+
+def problems(resources):
+  """
+  Every reason resources couldn't all be staged together, as a list of
+  (resource, errno): EEXIST for two resources with the same file name, and
+  otherwise why a resource couldn't be read
+  """
+  found = []
+  names = set()
+  for resource in sorted(set(resources)):
+    if basename(resource) in names:
+      found.append((resource, errno.EEXIST))
+      continue
+    names.add(basename(resource))
+    try:
+      content_hash(resource)
+    except (IOError, OSError) as e:
+      found.append((resource, e.errno))
+  return found
+
+def link(resource, dir):
+  """
+  Puts a resource into dir without copying it if possible: as a hard link
+  when dir is on the same filesystem as the resource root, and otherwise as
+  a symbolic link
+  """
+  link_file(abspath(resource_path(resource)), dir)
+
+def link_file(path, dir):
+  """Puts the file at (absolute) path into dir, like link"""
+  staged = join(dir, basename(path))
+  try:
+    os.link(path, staged)
+    return
+  except OSError as e:
+    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+      raise
+  try:
+    os.symlink(path, staged)
+  except OSError:
+    copy(path, staged)
@@ -0,0 +1,70 @@
+import errno
+import re
+import xml.etree.ElementTree as ET
+from multiprocessing import Pool
+from parseable import ImproperXmlException
+from problem import TEXT_FIELDS, Problem
+
+# Status of a problem file after it has been scanned
+OK = "ok"
+INVALID = "invalid"
+UNPARSEABLE = "parse"
+UNREADABLE = "permissions"
+UNREAD = "io"
+TOKEN = re.compile(r"[a-z0-9]+")
+
+def tokenize(text):
+  """The set of lowercase alphanumeric tokens in some text"""
+  if not text:
+    return set()
+  return set(TOKEN.findall(text.lower()))
+
+class ScanResult:
+  """
+  The outcome of parsing a single problem file. The problem is only present if
+  the status is OK, along with the tokens found in each (version id, field);
+  error holds the IOError for UNREAD files.
+  """
+  def __init__(self, filename, status, problem=None, error=None):
+    self.filename = filename
+    self.status = status
+    self.problem = problem
+    self.error = error
+    self.tokens = dict()
+    if problem is not None:
+      for version in problem.versions.itervalues():
+        for field in TEXT_FIELDS:
+          self.tokens[(version.vid, field)] = tokenize(getattr(version, field))
+
+def parse_problem_file(filename):
+  """
+  Parses (but does not validate the versions of) a single problem file,
+  classifying any failure instead of raising it.
+  """
+  try:
+    problem = Problem(filename)
+    problem.parse_tree(ET.parse(filename), validate_versions=False)
+    return ScanResult(filename, OK, problem)
+  except ImproperXmlException:
+    return ScanResult(filename, INVALID)
+  except ET.ParseError:
+    return ScanResult(filename, UNPARSEABLE)
+  except IOError as e:
+    # Permission errors can be safely skipped
+    if e.errno == errno.EACCES:
+      return ScanResult(filename, UNREADABLE)
+    return ScanResult(filename, UNREAD, error=IOError(e.errno, e.strerror, filename))
+
+def scan(filenames, worker=parse_problem_file, jobs=1):
+  """
+  Applies worker to every filename, spread over jobs processes. The results
+  are always returned in the same order as the filenames.
+  """
+  if jobs <= 1 or len(filenames) < 2:
+    return map(worker, filenames)
+  pool = Pool(jobs)
+  try:
+    return pool.map(worker, filenames, len(filenames) / (4 * jobs) + 1)
+  finally:
+    pool.close()
+    pool.join()
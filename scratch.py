@@ -0,0 +1,174 @@
+import atexit
+import errno
+import os
+import resources
+import stat
+from color import print_warning
+from config import get_scratch_root
+from os.path import isdir, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock
+
+# Directories in which pdflatex is run. Rather than making and deleting one
+# for every render, each process keeps a few idle ones to reuse, along with
+# the resources and formats which were put into them.
+
+# The number of idle directories kept for reuse
+POOL_SIZE = 4
+
+__lock = Lock()
+# Idle directories, ready to be handed out again
+__idle = []
+# Every directory this process has made which still exists
+__owned = set()
+# The resources copied into each directory: name -> content hash
+__staged = dict()
+# The scratch root once it has been checked, as (configured root, the root
+# used)
+__root = None
+# The private roots made instead of configured ones, to delete at exit
+__fallbacks = []
+
+def __remove_leftovers(root):
+  """Removes the directories of processes which exited without cleaning up"""
+  try:
+    names = os.listdir(root)
+  except OSError:
+    return
+  for name in names:
+    try:
+      pid = int(name.split(".")[0])
+    except ValueError:
+      continue
+    if pid == os.getpid():
+      continue
+    try:
+      os.kill(pid, 0)
+    except OSError as e:
+      if e.errno == errno.ESRCH:
+        rmtree(join(root, name), ignore_errors=True)
+
+def __is_private(root):
+  """
+  Whether root is a directory (not a link to one) which only this user can 
+  use. The scratch root has a predictable name, so on a shared machine 
+  someone else could have made it first to tamper with the renders in it.
+  """
+  try:
+    stat_info = os.lstat(root)
+  except OSError:
+    return False
+  return (stat.S_ISDIR(stat_info.st_mode) and 
+      stat_info.st_uid == os.getuid() and stat_info.st_mode & 0077 == 0)
+
+def __scratch_root():
+  """The checked scratch root, or a private one if it can't be used"""
+  global __root
+  configured = get_scratch_root()
+  if __root is None or __root[0] != configured:
+    # Idle directories are in the old root
+    for dir in __idle:
+      __owned.discard(dir)
+      __staged.pop(dir, None)
+      rmtree(dir, ignore_errors=True)
+    del __idle[:]
+    try:
+      os.makedirs(configured, 0700)
+    except OSError as e:
+      if e.errno != errno.EEXIST: raise
+    if __is_private(configured):
+      __remove_leftovers(configured)
+      __root = configured, configured
+    else:
+      print_warning("Not rendering in {}, which is not a private directory "
+          "of yours".format(configured))
+      __root = configured, mkdtemp(prefix="22scratch-")
+      __fallbacks.append(__root[1])
+  return __root[1]
+
+def acquire():
+  """A directory to render in, which must be given back with release"""
+  with __lock:
+    root = __scratch_root()
+    if __idle:
+      return __idle.pop()
+    # Named for this process, so that leftovers can be found once it exits
+    dir = mkdtemp(prefix=str(os.getpid()) + ".", dir=root)
+    __owned.add(dir)
+    __staged[dir] = dict()
+    return dir
+
+def release(dir):
+  """
+  Gives back a directory from acquire, emptied of everything but its staged
+  resources and precompiled formats (which are named by their contents), or
+  deletes it if enough are already waiting
+  """
+  staged = __staged.get(dir, dict())
+  try:
+    for name in os.listdir(dir):
+      if name in staged or name.endswith(".fmt"):
+        continue
+      path = join(dir, name)
+      if isdir(path):
+        rmtree(path)
+      else:
+        os.remove(path)
+  except OSError:
+    discard(dir)
+    return
+  with __lock:
+    if len(__idle) < POOL_SIZE:
+      __idle.append(dir)
+      return
+  discard(dir)
+
+def discard(dir):
+  with __lock:
+    __owned.discard(dir)
+    __staged.pop(dir, None)
+  rmtree(dir, ignore_errors=True)
+
+@atexit.register
+def discard_all():
+  global __root
+  for dir in list(__owned):
+    discard(dir)
+  del __idle[:]
+  for root in __fallbacks:
+    rmtree(root, ignore_errors=True)
+  del __fallbacks[:]
+  __root = None
+
+def stage(resource_list, dir):
+  """
+  Makes dir contain exactly the given resources (besides files which aren't
+  resources), linking in only those which aren't already there with the same
+  contents. Raises resources.ResourceError, before staging any, if some can't
+  be staged.
+  """
+  found = resources.problems(resource_list)
+  if found:
+    raise resources.ResourceError(found)
+  __sync(dir, dict((os.path.basename(resource), 
+      (resources.resource_path(resource), resources.content_hash(resource)))
+    for resource in set(resource_list)))
+
+def share(staged, dir):
+  """Makes dir contain exactly the resources staged in another directory"""
+  __sync(dir, dict((name, (join(staged, name), content)) 
+    for name, content in __staged.get(staged, dict()).iteritems()))
+
+def __sync(dir, wanted):
+  """Makes the resources in dir those of wanted: name -> (path, content hash)"""
+  staged = __staged.setdefault(dir, dict())
+  for name in list(staged):
+    if name not in wanted or staged[name] != wanted[name][1]:
+      del staged[name]
+      try: os.remove(join(dir, name))
+      except OSError: pass
+  for name, (path, content) in wanted.iteritems():
+    if name not in staged:
+      resources.link_file(os.path.abspath(path), dir)
+      staged[name] = content
@@ -7,10 +7,69 @@
 #   return COMMENT_PATERN.sub(COMMENT_REPLACE, document_contents)
 
 import strip_comments
+from cache import Cache, hasher
+
+# Marks the end of the part of a document's preamble which can be precompiled 
+# into a format (see mylatexformat); it does nothing when compiled normally
+PREAMBLE_END = "\\csname endofdump\\endcsname"
 
 def strip_latex_comments(document_contents):
     return strip_comments.strip_comments(document_contents)
 
+def strip_latex_comments_stream(chunks):
+    return strip_comments.strip_comments_stream(chunks)
+
+def latex_comment_stripper():
+    """A CommentStripper, which strips a document given a piece at a time"""
+    return strip_comments.CommentStripper()
+
+# Changed whenever stripping does, so that old cached fragments aren't used
+STRIP_VERSION = "1"
+
+def strip_latex_fragment(text):
+    """
+    Strips a fragment of a document (like the body of a Version) on its own,
+    returning the stripped text and the state the lexer finished in. Results
+    are cached by the hash of the text, so each distinct fragment is only
+    ever lexed once.
+    """
+    key = hasher()
+    key.update(STRIP_VERSION)
+    key.update(text.encode('UTF-8'))
+    key = key.hexdigest()
+    fragments = Cache("strip", ".tex")
+    cached = fragments.lookup(key)
+    result = None
+    if cached is not None:
+        try:
+            with open(cached, "rb") as f:
+                state, stripped = f.read().split("\n", 1)
+            result = (stripped.decode('UTF-8'), state)
+        except (IOError, ValueError):
+            pass
+    if result is None:
+        result = strip_comments.strip_comments_with_state(text)
+        fragments.store_contents(key, 
+            result[1] + "\n" + result[0].encode('UTF-8'))
+    return result
+
+def strip_latex_pieces(pieces, lengths=None):
+    """
+    Yields the stripped text of a document given as (text, fragment) pairs, 
+    where fragment is True if text can be stripped on its own and reused with
+    strip_latex_fragment. Only the text between the fragments is lexed. If 
+    lengths is a list, the stripped length of each piece is added to it (see 
+    CommentStripper).
+    """
+    stripper = strip_comments.CommentStripper(lengths)
+    for text, fragment in pieces:
+        if fragment:
+            stripped, state = strip_latex_fragment(text)
+            yield stripper.feed_stripped(text, stripped, state)
+        else:
+            yield stripper.feed(text)
+    yield stripper.close()
+
 test1in = """% Some comment
 % Comment w/ escaped percent sign: \%
 %%% Comment starting w/ multiple percents
@@ -1,13 +1,17 @@
 # Stolen & adapted from gist.github.com/amerberg/a273ca1e579ab573b499
 # Retrieved 2017-03-24
 
-import ply.lex, argparse, io
+import io, re, sys
+from bisect import bisect_right
 
 #Usage
 # python stripcomments.py input.tex > output.tex
 # python stripcomments.py input.tex -e encoding > output.tex
 
-def strip_comments(source):
+def build_lexer():
+    # Imported here, since ply (and the inspect module it uses) are slow to
+    # import and only needed once a document is stripped
+    import ply.lex
     tokens = (
                 'PERCENT', 'BEGINCOMMENT', 'ENDCOMMENT', 'BACKSLASH',
                 'CHAR', 'BEGINVERBATIM', 'ENDVERBATIM', 'NEWLINE', 'ESCPCT',
@@ -52,9 +56,10 @@ def strip_comments(source):
         t.lexer.begin("verbatim")
         return t
     
-    #Any other character in initial state we leave alone    
+    #Any other character in initial state we leave alone (a whole run of
+    #characters at once, along with a backslash which starts no other token)
     def t_CHAR(t):
-        r"."
+        r"\\?[^\\%\n]+|."
         return t
         
     def t_NEWLINE(t):
@@ -70,7 +75,7 @@ def strip_comments(source):
     
     #Ignore comments of comment environment    
     def t_commentenv_CHAR(t):
-        r"."
+        r"\\?[^\\\n]+|."
         return t
         pass
         
@@ -87,7 +92,7 @@ def strip_comments(source):
         
     #Leave contents of verbatim environment alone
     def t_verbatim_CHAR(t):
-        r"."
+        r"\\?[^\\\n]+|."
         return t
         
     def t_verbatim_NEWLINE(t):
@@ -102,12 +107,12 @@ def strip_comments(source):
     
     #Ignore anything after a % on a line        
     def t_linecomment_CHAR(t):
-        r"."
+        r"\\?[^\\\n]+|."
         pass
 
     #Ignore anything after a % on a line        
     def t_linecommentonly_CHAR(t):
-        r"."
+        r"\\?[^\\\n]+|."
         pass
 
     #End a % comment when we get to a new line
@@ -137,13 +142,216 @@ def strip_comments(source):
     def t_verbatim_error(t):
         return generic_error(t)
         
-    lexer = ply.lex.lex()
+    return ply.lex.lex()
+
+#Building the lexer (reflecting over the rules above and compiling them) takes
+#far longer than lexing most documents, so it is only done once
+__lexer = None
 
+def new_lexer():
+    global __lexer
+    if __lexer is None:
+        __lexer = build_lexer()
+    #Each caller gets its own copy, so that threads don't share lexer state
+    lexer = __lexer.clone()
+    lexer.begin('INITIAL')
+    return lexer
+
+def strip_comments(source):
+    lexer = new_lexer()
     lexer.input(source)
     # print [tok for tok in lexer]
     return u"".join([tok.value for tok in lexer])
+
+def strip_comments_with_state(source):
+    """
+    Strips source, also returning the state the lexer finished in (so that 
+    the result can be spliced into a larger document, see CommentStripper)
+    """
+    lexer = new_lexer()
+    lexer.input(source)
+    return u"".join([tok.value for tok in lexer]), lexer.current_state()
+
+#The end of some text which a token (like \\begin{comment}) could continue past
+UNFINISHED_COMMAND = re.compile(r"\\[a-z]*\s*(\{\s*[a-z]*\s*)?$")
+UNFINISHED_ARGUMENT = re.compile(r"\s*([{a-z}]|$)")
+#The start of a line with only a comment on it (the lexer treats the start of
+#any text it's given as the start of a line), which can begin in the
+#whitespace at the end of the text before it
+COMMENT_ONLY = re.compile(r"\s*%")
+BLANK_END = re.compile(r"(^|\n)\s*$")
+
+def crosses(before, after):
+    """Whether a token could start in before and continue into after"""
+    #Only the end of before matters, and it can be long
+    before = before[-256:]
+    if COMMENT_ONLY.match(after):
+        return True
+    if BLANK_END.search(before) and after.isspace():
+        return True
+    if before.endswith(u"\\") and after[:1] in (u"\\", u"%"):
+        return True
+    return bool(UNFINISHED_COMMAND.search(before) and UNFINISHED_ARGUMENT.match(after))
+
+class CommentStripper:
+    """
+    Strips comments from a document given a piece at a time, keeping the
+    lexer's state between pieces. Text is only lexed up to the last newline
+    which no token can continue past (tokens like \\begin{comment} and
+    whitespace-only lines before a comment can span lines), so the output is
+    exactly what strip_comments would give for the whole document.
+
+    If lengths is a list, the length of the stripped text which came from each
+    piece fed is appended to it (and added to as the piece is lexed), which
+    is complete once the stripper is closed.
+    """
+    #Characters after a blank line which may continue a line with only a
+    #comment on it (which swallows the blank lines before it)
+    BLANK_CONTINUATIONS = frozenset(u" \t\r\n\f\v%")
+
+    def __init__(self, lengths=None):
+        self.lexer = new_lexer()
+        self.pending = u""
+        #Newlines in pending before this have been found to be crossed by a
+        #token (whether one is depends only on the character after it)
+        self.checked = 0
+        #Where each piece in pending starts, as (offset, piece)
+        self.starts = []
+        self.lengths = lengths
+        self.piece = -1
+        #The last character lexed, since whether text starts a line matters
+        self.last = u"\n"
+        #Text whose stripped form is already known, held until the text after
+        #it shows whether a token crosses out of it
+        self.spliced = None
+
+    def __begin(self):
+        self.piece += 1
+        if self.lengths is not None:
+            self.lengths.append(0)
+
+    def __crosses(self, end):
+        """Whether a token could continue past the newline at end of pending"""
+        #Only the end of the text before matters, and it can be long
+        if UNFINISHED_COMMAND.search(self.pending, max(0, end - 256), end + 1):
+            return True
+        if self.pending[end + 1] not in self.BLANK_CONTINUATIONS:
+            return False
+        start = self.pending.rfind(u"\n", 0, end) + 1
+        return start == end or self.pending[start:end].isspace()
+
+    def __cut(self):
+        """
+        The end of the longest part of pending which can be lexed, looking 
+        only at the newlines which haven't been checked, so that each is 
+        checked once however long pending gets
+        """
+        end = len(self.pending) - 1
+        checked, self.checked = self.checked, max(end, 0)
+        while True:
+            end = self.pending.rfind(u"\n", checked, end)
+            if end < 0:
+                return 0
+            if not self.__crosses(end):
+                return end + 1
+
+    def __take(self, cut):
+        """Removes and returns the first cut characters of pending, with their starts"""
+        text, self.pending = self.pending[:cut], self.pending[cut:]
+        self.checked = max(self.checked - cut, 0)
+        starts = [start for start in self.starts if start[0] < cut]
+        self.starts = [(offset - cut, piece) for offset, piece in self.starts
+            if offset >= cut]
+        if self.pending and (not self.starts or self.starts[0][0] > 0):
+            self.starts.insert(0, (0, starts[-1][1]))
+        return text, starts
+
+    def __lex(self, text, starts):
+        if not text:
+            return u""
+        self.lexer.input(self.last + text)
+        self.lexer.lexpos = 1
+        self.last = text[-1]
+        if self.lengths is None:
+            return u"".join([tok.value for tok in self.lexer])
+        offsets = [offset for offset, piece in starts]
+        values = []
+        for tok in self.lexer:
+            piece = starts[bisect_right(offsets, tok.lexpos - 1) - 1][1]
+            self.lengths[piece] += len(tok.value)
+            values.append(tok.value)
+        return u"".join(values)
+
+    def __settle(self, after):
+        """Uses or discards the stripped form of spliced text, given what follows it"""
+        if self.spliced is None:
+            return u""
+        text, stripped, state, piece = self.spliced
+        self.spliced = None
+        if crosses(text, after):
+            #Lex it after all; it was spliced in the INITIAL state with nothing pending
+            self.lexer.begin('INITIAL')
+            self.pending = text
+            self.checked = 0
+            self.starts = [(0, piece)]
+            return u""
+        self.lexer.begin(state)
+        self.last = text[-1:] or self.last
+        if self.lengths is not None:
+            self.lengths[piece] += len(stripped)
+        return stripped
+
+    def __feed(self, text):
+        if not text:
+            return u""
+        settled = self.__settle(text)
+        self.starts.append((len(self.pending), self.piece))
+        self.pending = self.pending + text
+        cut = self.__cut()
+        if not cut:
+            return settled
+        return settled + self.__lex(*self.__take(cut))
+
+    def feed(self, text):
+        """Adds text to the document, returning whatever can be stripped yet"""
+        self.__begin()
+        return self.__feed(text)
+
+    def feed_stripped(self, text, stripped, state):
+        """
+        Adds text to the document when its stripped form is already known (from
+        strip_comments_with_state, which finished in state). The stripped form
+        is only used if no token crosses into or out of text, and the text is 
+        lexed as usual otherwise.
+        """
+        self.__begin()
+        if not text:
+            return u""
+        settled = self.__settle(text)
+        if crosses(self.pending, text):
+            return settled + self.__feed(text)
+        before = self.__lex(*self.__take(len(self.pending)))
+        if self.lexer.current_state() != 'INITIAL':
+            return settled + before + self.__feed(text)
+        self.spliced = (text, stripped, state, self.piece)
+        return settled + before
+
+    def close(self):
+        """Ends the document, returning the rest of the stripped text"""
+        settled = self.__settle(u"")
+        return settled + self.__lex(*self.__take(len(self.pending)))
+
+def strip_comments_stream(chunks):
+    """Yields the stripped text of a document given as an iterable of chunks"""
+    stripper = CommentStripper()
+    for chunk in chunks:
+        stripped = stripper.feed(chunk)
+        if stripped:
+            yield stripped
+    yield stripper.close()
     
 def main():
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('filename', help = 'the file to strip comments from')
     parser.add_argument('--encoding', '-e', default='utf-8')
@@ -151,9 +359,9 @@ def main():
     args = parser.parse_args()
     
     with io.open(args.filename, encoding=args.encoding) as f:
-        source = f.read()
-    
-    print(strip_comments(source))
+        for stripped in strip_comments_stream(iter(lambda: f.read(1 << 16), u"")):
+            sys.stdout.write(stripped.encode(args.encoding))
+    sys.stdout.write("\n")
     
 if __name__ == '__main__':
     main()
\ No newline at end of file
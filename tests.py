@@ -1,15 +1,94 @@
 import xml.etree.ElementTree as ET
 import unittest
-from config import BuildConfiguration
+from copy import copy
+from StringIO import StringIO
+from cache import Cache
+from config import BuildConfiguration, cached_configuration, get_configuration, parse_configuration, get_private_types, get_private_type_set, get_topic_set
+from corpus import Corpus, members
 from parseable import ImproperXmlException
-from problem import Version, ImproperXmlException, Problem, Document, UsedIn
-from build import satisfies
-from stringutil import strip_latex_comments_test
+from problem import SPLIT_KEY, TEXT_FIELDS, TOPICS, Version, load_text, ImproperXmlException, Problem, Document, SourceMap, SplitDocument, UsedIn
+from build import VARIANTS, satisfies, variant_list
+from index import ProblemIndex, OK, UNPARSEABLE
+from scanner import scan
+from stringutil import latex_comment_stripper, strip_latex_comments, strip_latex_comments_stream, strip_latex_comments_test, test1in, test1out
+from subprocess import CalledProcessError, check_output
+import compileserver
+import errno
+import index as index_module
 import os
+import pdfbuilder
+import pdfsplit
+import random
+import resources
+import scratch
+import shutil
+import sqlite3
 import string
+import sys
+import tempfile
 
 test_filename = "test_filename"
 
+class TemporaryCacheTest(unittest.TestCase):
+  """
+  Keeps each test's cache and scratch directories (self.cache and 
+  self.scratch) in a temporary self.directory, rather than the user's
+  """
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = os.path.join(self.directory, "cache")
+    self.scratch = os.path.join(self.directory, "scratch")
+    self.old_cache = get_configuration().cache
+    self.old_size = get_configuration().cachesize
+    self.old_scratch = get_configuration().scratch
+    get_configuration().cache = self.cache
+    get_configuration().scratch = self.scratch
+    # Both are kept in the cache
+    resources.forget_listing()
+    resources.forget_manifest()
+    
+  def tearDown(self):
+    get_configuration().cache = self.old_cache
+    get_configuration().cachesize = self.old_size
+    get_configuration().scratch = self.old_scratch
+    scratch.discard_all()
+    resources.forget_listing()
+    resources.forget_manifest()
+    shutil.rmtree(self.directory)
+
+class CacheTest(TemporaryCacheTest):
+  def test_store(self):
+    cache = Cache("test", ".txt")
+    self.assertTrue(cache.lookup("abc") is None)
+    self.assertTrue(cache.store_contents("abc", "contents"))
+    with open(cache.lookup("abc")) as f:
+      self.assertEqual(f.read(), "contents")
+    self.assertTrue(cache.store("def", "test/valid1.xml"))
+    self.assertTrue(cache.lookup("def") is not None)
+    
+  def test_evict(self):
+    get_configuration().cachesize = 0
+    cache = Cache("test", ".txt")
+    cache.store_contents("abc", "contents")
+    self.assertTrue(cache.lookup("abc") is None)
+
+  def test_evict_limit(self):
+    # Each store is in a new process, as each build is in practice
+    script = ("import sys\n"
+        "from cache import Cache\n"
+        "from config import get_configuration\n"
+        "get_configuration().cache = sys.argv[1]\n"
+        "get_configuration().cachesize = 1\n"
+        "Cache('test', '.txt').store_contents(sys.argv[2], 'x' * 60 * 1024)")
+    cache = Cache("test", ".txt")
+    for i in range(22):
+      check_output([sys.executable, "-c", script, self.cache, str(i)])
+      os.utime(cache.path(str(i)), (1000 + i, 1000 + i))
+    stored = [i for i in range(22) if os.path.exists(cache.path(str(i)))]
+    # Eviction waits for a sixteenth of the cache size to be stored
+    self.assertLessEqual(len(stored) * 60, 1024 + 64)
+    self.assertEqual(stored, range(22 - len(stored), 22))
+
 class ConfigurationTest(unittest.TestCase):
   def test_invalid(self):
     for file in os.listdir("test/config_invalid"):
@@ -24,8 +103,49 @@ class ConfigurationTest(unittest.TestCase):
         with self.assertRaisesRegexp(ImproperXmlException, root[0].text):
           config.parse_element(root[1])
           config.validate()
+
+  def test_cache(self):
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, "config.xml")
+      include = os.path.join(directory, "include.sty")
+      with open(include, "w") as f:
+        f.write("\\newcommand\\one{1}\n")
+      with open(filename, "w") as f:
+        f.write("<configuration><topics>a b</topics><types>c</types>"
+            "<blurb>Blurb</blurb><problemroot>problems</problemroot>"
+            "<include>{}</include></configuration>".format(include))
+      self.assertIsNone(cached_configuration(filename))
+      parsed = parse_configuration(filename)
+      cached = cached_configuration(filename)
+      self.assertEqual(vars(cached), vars(parsed))
+      with open(include, "a") as f:
+        f.write("\\newcommand\\two{2}\n")
+      self.assertIsNone(cached_configuration(filename))
+      self.assertIn("two", "".join(parse_configuration(filename).include))
+      self.assertIn("two", "".join(cached_configuration(filename).include))
+    finally:
+      shutil.rmtree(directory)
+
+  def test_vocabulary_sets(self):
+    configuration = get_configuration()
+    topics = get_topic_set()
+    self.assertEqual(topics, frozenset(configuration.topics))
+    self.assertIs(get_topic_set(), topics)
+    old = configuration.private_types
+    try:
+      configuration.private_types = ['proof']
+      self.assertEqual(get_private_type_set(), frozenset(['proof']))
+    finally:
+      configuration.private_types = old
+    self.assertEqual(get_private_type_set(), frozenset(old))
+    version = Version("vocabulary.xml", 1)
+    version.topics = [configuration.topics[0], 'unknown_topic']
+    self.assertFalse(TOPICS.within(version._topics, topics))
+    version.topics = configuration.topics[:2]
+    self.assertTrue(TOPICS.within(version._topics, topics))
           
-class DocumentTest(unittest.TestCase):
+class DocumentTest(TemporaryCacheTest):
   def test_invalid(self):
     for file in os.listdir("test/document_invalid"):
       if file.endswith(".xml"):
@@ -64,8 +184,393 @@ class DocumentTest(unittest.TestCase):
     
     self.assertNotEqual(document1.versions[0].body, 
         document2.versions[0].body)
+    
+  def test_build_stripped(self):
+    problem = Problem("test/valid1.xml")
+    problem.parse_tree(ET.parse("test/valid1.xml"))
+    document = Document(test_filename)
+    document.name = "Stripped"
+    document.due = "Never"
+    fields = [test1in, "  % only a comment", "ends in a comment % here", 
+        "\n\\begin{verbatim}\n% kept", "\\begin{comment}", "no comments\n  ",
+        "trailing backslash \\", "50\\% % and a comment"]
+    for body in fields:
+      for solution in fields:
+        version = copy(problem.newest_version())
+        version.body = body
+        version.solution = solution
+        version.rubric = fields[(len(body) + len(solution)) % len(fields)]
+        version.params = {"value": solution}
+        document.versions.append(version)
+    for solutions in [False, True]:
+      built = document.build(solutions, True, True)
+      self.assertEqual(document.build(solutions, True, True, stripped=True), 
+          strip_latex_comments(built))
+      
+  def test_write_to(self):
+    document = Document(test_filename)
+    document.name = "Streamed"
+    document.due = "Never"
+    for filename in ["test/valid1.xml", "test/comments_test.xml"]:
+      problem = Problem(filename)
+      problem.parse_tree(ET.parse(filename))
+      document.versions.extend(problem.get_versions())
+    for stripped in [False, True]:
+      stream = StringIO()
+      document.write_to(stream, True, True, True, stripped)
+      self.assertEqual(stream.getvalue(), 
+          document.build(True, True, True, stripped).encode('UTF-8'))
+
+  def test_split(self):
+    document = Document(test_filename)
+    document.name = "Split"
+    document.due = "Never"
+    problem = Problem("test/valid1.xml")
+    problem.parse_tree(ET.parse("test/valid1.xml"))
+    document.versions.extend(problem.get_versions())
+    built = SplitDocument(document).build(True, False, False)
+    for i in range(len(document.versions)):
+      single = document.problem_document(i).build_body(True, False, False)
+      self.assertIn(single, built)
+      self.assertIn("/" + SPLIT_KEY + " " + str(i+1) + "}", built)
+
+  def test_parts(self):
+    document = Document(test_filename)
+    document.name = "Parts"
+    document.due = "Never"
+    problem = Problem("test/comments_test.xml")
+    problem.parse_tree(ET.parse("test/comments_test.xml"))
+    document.versions.extend(problem.get_versions())
+    parts = document.parts(True, True, False)
+    self.assertEqual(len(parts), len(document.versions) + 1)
+    self.assertEqual("".join(parts), document.build_body(True, True, False))
+    self.assertEqual(document.parts(True, True, False, stripped=True), 
+        map(strip_latex_comments, parts))
+
+  def test_source_map(self):
+    document = Document(test_filename)
+    document.name = "Sources"
+    document.due = "Never"
+    problem = Problem("test/comments_test.xml")
+    problem.parse_tree(ET.parse("test/comments_test.xml"))
+    document.versions.extend(problem.get_versions())
+    newest, oldest = document.versions
+    for stripped in (False, True):
+      source_map = SourceMap()
+      built = u"".join(document.stream(True, True, False, stripped, 
+          source_map))
+      self.assertEqual(sum(source_map.lengths), len(built))
+      lines = built.split(u"\n")
+      def locate(text):
+        return source_map.locate(built, 
+            1 + [i for i, line in enumerate(lines) if text in line][0])
+      self.assertEqual(locate("Rubric:"), [(newest, "rubric")])
+      self.assertEqual(locate("Here's some math"), [(newest, "body")])
+      self.assertEqual(locate("Body 0"), [(oldest, "body")])
+      self.assertEqual(locate("Solution 0"), [(oldest, "solution")])
+      self.assertEqual(locate("\\subsection*{Problem 2}"), [(oldest, None)])
+      self.assertEqual(locate("\\begin{document}"), [])
   
 
+class IndexTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    shutil.copy("test/valid1.xml", self.directory)
+    
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    
+  def test_refresh(self):
+    index = ProblemIndex(self.directory)
+    self.assertEqual(index.refresh(), 1)
+    self.assertEqual(index.refresh(), 0)
+    self.assertEqual(ProblemIndex(self.directory).refresh(), 0)
+    
+    with open(os.path.join(self.directory, "broken.xml"), "w") as f:
+      f.write("<problem>")
+    self.assertEqual(index.refresh(), 1)
+    statuses = dict((os.path.basename(filename), status) 
+        for filename, status, problem in index.problems())
+    self.assertEqual(statuses, {"valid1.xml": OK, "broken.xml": UNPARSEABLE})
+    
+  def test_locked(self):
+    index = ProblemIndex(self.directory)
+    index.refresh()
+    with open(os.path.join(self.directory, "text.xml"), "w") as f:
+      f.write("<problem><version id=\"0\"><body>b</body></version></problem>")
+    # Someone else is refreshing the same index
+    timeout = index_module.INDEX_TIMEOUT
+    index_module.INDEX_TIMEOUT = 0.1
+    other = sqlite3.connect(index.filename)
+    try:
+      other.execute("BEGIN IMMEDIATE")
+      index = ProblemIndex(self.directory)
+      self.assertEqual(index.refresh(), 2)
+      self.assertTrue(index.in_memory)
+      self.assertEqual(sorted(os.path.basename(filename) 
+          for filename, status, problem in index.problems()), 
+          ["text.xml", "valid1.xml"])
+    finally:
+      other.rollback()
+      other.close()
+      index_module.INDEX_TIMEOUT = timeout
+    index = ProblemIndex(self.directory)
+    self.assertEqual(index.refresh(), 1)
+    self.assertFalse(index.in_memory)
+    
+  def test_problems(self):
+    index = ProblemIndex(self.directory)
+    index.refresh()
+    filename = os.path.join(self.directory, "valid1.xml")
+    expected = Problem(filename)
+    expected.parse_tree(ET.parse(filename))
+    
+    problems = list(index.problems())
+    self.assertEqual(len(problems), 1)
+    problem = problems[0][2]
+    self.assertEqual(sorted(problem.versions), sorted(expected.versions))
+    for vid, version in expected.versions.iteritems():
+      self.assertEqual(version.year, problem.versions[vid].year)
+      self.assertEqual(version.body, problem.versions[vid].body)
+      self.assertEqual(version.authors, problem.versions[vid].authors)
+      self.assertEqual(version.topics, problem.versions[vid].topics)
+      self.assertEqual(version.types, problem.versions[vid].types)
+
+  def test_text_candidates(self):
+    with open(os.path.join(self.directory, "text.xml"), "w") as f:
+      f.write("""<problem><version id="1"><body>Alpha \\pmod{3}</body>
+          <solution>TODO: a beta</solution><rubric>Gamma</rubric>
+          </version></problem>""")
+    index = ProblemIndex(self.directory)
+    index.refresh()
+    settings = DummyObject()
+    
+    for todo, grep in [(True, None), (False, ["alph"]), (False, ["a beta"]),
+        (False, ["\\pmod{"]), (False, ["BODY", "1"]), (False, ["$$"]),
+        (True, ["rubric"]), (False, ["lpha \\pm"]), (False, ["delta"])]:
+      settings.todo = todo
+      settings.grep = grep
+      candidates = index.text_candidates(todo, grep)
+      for filename, status, problem in index.problems():
+        for version in problem.versions.itervalues():
+          if satisfies(version, settings, []):
+            self.assertTrue(candidates is None or 
+                (filename, version.vid) in candidates)
+    
+    self.assertEqual(index.text_candidates(False, ["delta"]), set())
+    self.assertEqual(len(index.text_candidates(True, None)), 1)
+    self.assertEqual(len(index.text_candidates(False, ["body", "1"])), 1)
+    self.assertTrue(index.text_candidates(False, ["$$"]) is None)
+
+class ResourcesTest(TemporaryCacheTest):
+  def setUp(self):
+    TemporaryCacheTest.setUp(self)
+    self.resources = tempfile.mkdtemp()
+    self.get_resource_root = resources.get_resource_root
+    resources.get_resource_root = lambda: self.resources
+    os.mkdir(os.path.join(self.resources, "images"))
+    with open(os.path.join(self.resources, "images", "a.png"), "w") as f:
+      f.write("a")
+        
+  def tearDown(self):
+    resources.get_resource_root = self.get_resource_root
+    shutil.rmtree(self.resources)
+    TemporaryCacheTest.tearDown(self)
+    
+  def test_listing(self):
+    self.assertTrue(resources.exists("images/a.png"))
+    self.assertTrue(resources.exists("images/../images/a.png"))
+    self.assertFalse(resources.exists("a.png"))
+    self.assertEqual(resources.size("images/a.png"), 1)
+    
+    with open(os.path.join(self.resources, "images", "b.png"), "w") as f:
+      f.write("bb")
+    # Noticed through the changed directory, even from the cached listing
+    os.utime(os.path.join(self.resources, "images"), (0, 0))
+    resources.forget_listing()
+    self.assertEqual(resources.listing()["images/b.png"][0], 2)
+    
+    resources.get_resource_root = lambda: os.path.join(self.resources, "none")
+    resources.forget_listing()
+    self.assertTrue(resources.listing() is None)
+    self.assertFalse(resources.exists("images/a.png"))
+
+  def test_links(self):
+    elsewhere = tempfile.mkdtemp()
+    try:
+      with open(os.path.join(elsewhere, "c.png"), "w") as f:
+        f.write("ccc")
+      os.symlink(elsewhere, os.path.join(self.resources, "linked"))
+      # A link back up the tree is only walked once
+      os.symlink(self.resources, os.path.join(self.resources, "images", "up"))
+      self.assertEqual(resources.listing()["linked/c.png"][0], 3)
+      self.assertTrue(resources.exists("linked/c.png"))
+      # Missed by the listing, but still found
+      self.assertTrue(resources.exists(os.path.join(elsewhere, "c.png")))
+      self.assertEqual(resources.size(os.path.join(elsewhere, "c.png")), 3)
+      self.assertFalse(resources.exists(os.path.join(elsewhere, "d.png")))
+    finally:
+      shutil.rmtree(elsewhere)
+
+class ScannerTest(unittest.TestCase):
+  def test_order(self):
+    filenames = ["test/valid1.xml", "test/comments_test.xml"]
+    for directory in ["test/problem_invalid", "test/version_valid"]:
+      filenames = filenames + sorted(os.path.join(directory, f) 
+          for f in os.listdir(directory))
+    serial = scan(filenames)
+    parallel = scan(filenames, jobs=3)
+    self.assertEqual([r.filename for r in serial], filenames)
+    self.assertEqual([r.filename for r in parallel], filenames)
+    self.assertEqual([r.status for r in serial], [r.status for r in parallel])
+    for s, p in zip(serial, parallel):
+      if s.problem is not None:
+        for vid, version in s.problem.versions.iteritems():
+          self.assertEqual(p.problem.versions[vid].topics, version.topics)
+          self.assertEqual(p.problem.versions[vid].types, version.types)
+
+  def test_vocabulary(self):
+    # Each worker numbers the words it hasn't seen differently
+    directory = tempfile.mkdtemp()
+    try:
+      filenames = []
+      for i in range(12):
+        filenames.append(os.path.join(directory, "{}.xml".format(i)))
+        with open(filenames[-1], "w") as f:
+          f.write("<problem><version id=\"0\"><authors>a</authors>"
+              "<year>2016</year><topics>probability unlisted_{0}</topics>"
+              "<types>proof unlisted_{0}</types><body>b</body></version>"
+              "</problem>".format(i))
+      # In parallel first, so that the workers don't inherit the words
+      parallel = scan(filenames, jobs=3)
+      serial = scan(filenames)
+      for s, p in zip(serial, parallel):
+        self.assertEqual(p.problem.versions[0].topics, 
+            s.problem.versions[0].topics)
+        self.assertEqual(p.problem.versions[0].types, 
+            s.problem.versions[0].types)
+    finally:
+      shutil.rmtree(directory)
+
+class PdfBuilderTest(TemporaryCacheTest):
+  def setUp(self):
+    TemporaryCacheTest.setUp(self)
+    self.run_pdflatex = pdfbuilder.run_pdflatex
+    self.pdflatex_command = pdfbuilder.pdflatex_command
+    pdfbuilder.run_pdflatex = self.fake_pdflatex
+    pdfbuilder.pdflatex_command = lambda document_contents, dir: ["pdflatex"]
+    self.runs = 0
+    
+  def tearDown(self):
+    pdfbuilder.run_pdflatex = self.run_pdflatex
+    pdfbuilder.pdflatex_command = self.pdflatex_command
+    TemporaryCacheTest.tearDown(self)
+    
+  def fake_pdflatex(self, command, dir):
+    """
+    Fails at \\broken, and anywhere after \\poison (like a fragment which 
+    compiles on its own but breaks everything after it)
+    """
+    self.runs = self.runs + 1
+    with open(os.path.join(dir, "render.tex")) as f:
+      document = f.read()
+    output = ""
+    for line in document.split("\n"):
+      if line.startswith("\\typeout{"):
+        output = output + line[len("\\typeout{"):-1] + "\n"
+      if "\\broken" in line or ("\\poison" in document[:document.find(line)]
+          and "\\typeout{22fragment" in line):
+        raise CalledProcessError(1, command, output)
+    return output
+    
+  def test_fragments(self):
+    bodies = ["fine", "\\broken", "fine", "\\poison", "fine", "fine\n\\broken"]
+    expected = [True, False, True, True, True, False]
+    self.assertEqual(pdfbuilder.can_build_fragments("header", bodies, []), 
+        expected)
+    self.assertEqual(pdfbuilder.can_build_fragments("header", bodies[:1], []), 
+        [True])
+    self.runs = 0
+    self.assertEqual(pdfbuilder.can_build_fragments("header", ["fine"] * 10, []), 
+        [True] * 10)
+    self.assertEqual(self.runs, 1)
+
+  def test_release_on_error(self):
+    def fail(command, dir):
+      raise RuntimeError("pdflatex went wrong")
+    pdfbuilder.run_pdflatex = fail
+    for build in [lambda: pdfbuilder.build_stitched("header", ["body"], [], 
+        "stitched", cache=False), lambda: pdfbuilder.can_build("body", [])]:
+      dir = scratch.acquire()
+      scratch.release(dir)
+      with self.assertRaises(RuntimeError):
+        build()
+      # Given back, so it is the first to be reused
+      again = scratch.acquire()
+      scratch.release(again)
+      self.assertEqual(again, dir)
+
+  def test_latex_errors(self):
+    log = "\n".join(["This is pdfTeX", "! Undefined control sequence.", 
+        "l.12 \\broken", "", "! Emergency stop.", "<*> render.tex", 
+        "! Missing $ inserted.", "<inserted text>", "l.40 x^", "           2"])
+    self.assertEqual(pdfbuilder.latex_errors(log), 
+        [("Undefined control sequence.", 12), ("Missing $ inserted.", 40)])
+
+  def test_compile_server_allowed(self):
+    dir = tempfile.mkdtemp()
+    try:
+      self.assertTrue(compileserver.allowed(
+          ["pdflatex", "-halt-on-error", "render.tex"], dir))
+      self.assertTrue(compileserver.allowed(
+          [u"pdflatex", u"-halt-on-error", u"-fmt=preamble-0af", u"render.tex"], dir))
+      for command in [["sh", "-c", "render.tex"], ["pdflatex", "render.tex"],
+          ["pdflatex", "-halt-on-error", "-shell-escape", "render.tex"],
+          ["pdflatex", "-halt-on-error", "-fmt=../x", "render.tex"],
+          ["pdflatex", "-halt-on-error", "other.tex"], "pdflatex", None]:
+        self.assertFalse(compileserver.allowed(command, dir))
+      command = ["pdflatex", "-halt-on-error", "render.tex"]
+      self.assertFalse(compileserver.allowed(command, "relative"))
+      self.assertFalse(compileserver.allowed(command, os.path.join(dir, "no")))
+      self.assertFalse(compileserver.allowed(command, None))
+    finally:
+      shutil.rmtree(dir)
+
+class PdfSplitTest(unittest.TestCase):
+  def test_split(self):
+    pdf = pdfsplit.Pdf("test/split_test.pdf")
+    groups = pdf.pages_by(SPLIT_KEY)
+    self.assertEqual(sorted(groups), [1, 2])
+    self.assertEqual(len(groups[1]), 2)
+    
+    dir = tempfile.mkdtemp()
+    try:
+      for key, pages in groups.iteritems():
+        filename = os.path.join(dir, str(key) + ".pdf")
+        pdf.write(pages, filename)
+        split = pdfsplit.Pdf(filename)
+        self.assertEqual(split.pages_by(SPLIT_KEY).keys(), [key])
+        self.assertEqual(len(split.pages()), len(pages))
+        for page, original in zip(split.pages(), pages):
+          self.assertEqual(split.get(split.object(page)["Contents"]).data,
+              pdf.get(pdf.object(original)["Contents"]).data)
+          # Inherited from the original page tree
+          self.assertEqual(split.object(page)["MediaBox"], 
+              ["0", "0", "612", "792"])
+    finally:
+      shutil.rmtree(dir)
+
+  def test_merge(self):
+    dir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(dir, "merged.pdf")
+      pdfsplit.merge(["test/split_test.pdf"] * 2, filename)
+      merged = pdfsplit.Pdf(filename)
+      self.assertEqual(len(merged.pages()), 6)
+      self.assertEqual(map(len, merged.pages_by(SPLIT_KEY).values()), [4, 2])
+    finally:
+      shutil.rmtree(dir)
+    
 class ProblemTest(unittest.TestCase):
   def test_invalid(self):
     for file in os.listdir("test/problem_invalid"):
@@ -95,6 +600,95 @@ class ProblemTest(unittest.TestCase):
           root.append(version_root[1])
           problem.parse_element(root, validate_versions=True)
         
+  def test_parse_file(self):
+    directory = tempfile.mkdtemp()
+    try:
+      markup = os.path.join(directory, "markup.xml")
+      with open(markup, "w") as f:
+        f.write("<problem><!-- <body> --><version id='1'><body>A<![CDATA["
+            "</body>]]></body><solution/><rubric>\n<b/>R</rubric>"
+            "</version></problem>")
+      for filename in ["test/valid1.xml", "test/comments_test.xml", markup]:
+        expected = Problem(filename)
+        expected.parse_tree(ET.parse(filename), validate_versions=False)
+        problem = Problem(filename)
+        problem.parse_file(validate_versions=False)
+        self.assertEqual(sorted(problem.versions), sorted(expected.versions))
+        for vid, version in problem.versions.iteritems():
+          other = expected.versions[vid]
+          self.assertEqual((version.authors, version.topics, version.year), 
+              (other.authors, other.topics, other.year))
+          self.assertTrue(version.deferred())
+          for field in TEXT_FIELDS:
+            self.assertEqual(version.has_text(field), bool(getattr(other, field)))
+          for field in TEXT_FIELDS:
+            self.assertEqual(getattr(version, field), getattr(other, field))
+    finally:
+      shutil.rmtree(directory)
+
+  def test_parse_file_errors(self):
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, "errors.xml")
+      with open(filename, "w") as f:
+        f.write("<problem><version id='1'><body>\n$a & b$</body>"
+            "</version></problem>")
+      with self.assertRaises(ET.ParseError) as parsed:
+        ET.parse(filename)
+      with self.assertRaises(ET.ParseError) as skipped:
+        Problem(filename).parse_file(validate_versions=False)
+      self.assertEqual(skipped.exception.position, parsed.exception.position)
+
+      with open(filename, "w") as f:
+        f.write("<problem><version id='1'><body>B</body></version></problem>")
+      problem = Problem(filename)
+      problem.parse_file(validate_versions=False)
+      with open(filename, "a") as f:
+        f.write("\n")
+      with self.assertRaisesRegexp(ImproperXmlException, "changed"):
+        problem.newest_version().load()
+    finally:
+      shutil.rmtree(directory)
+
+  def test_parse_file_entities(self):
+    directory = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(directory, "entities.xml")
+      with open(filename, "w") as f:
+        f.write("<?xml version='1.0'?>\n<!DOCTYPE problem [\n"
+            "<!ENTITY course 'CS22'>\n]>\n<problem><version id='1'>"
+            "<body>Welcome to &course;</body></version></problem>")
+      problem = Problem(filename)
+      problem.parse_file(validate_versions=False)
+      self.assertEqual(problem.newest_version().body, "Welcome to CS22")
+      # The text of a version can't be read again without the DOCTYPE
+      with self.assertRaises(ImproperXmlException):
+        load_text(filename, len("<?xml version='1.0'?>\n<!DOCTYPE problem "
+            "[\n<!ENTITY course 'CS22'>\n]>\n<problem>"), 
+            os.path.getsize(filename) - len("</version></problem>"), "UTF-8",
+            (os.path.getsize(filename), os.path.getmtime(filename)))
+    finally:
+      shutil.rmtree(directory)
+
+  def test_compact_fields(self):
+    version = Version("compact.xml", 1)
+    for topics in [[], ['sets'], ['sets', 'counting'], ['counting', 'unknown_topic'],
+        ['counting', 'counting']]:
+      version.topics = topics
+      self.assertEqual(version.topics, topics)
+    version.types = ['proof']
+    version.authors = ['a', 'b']
+    version.authors.append('c')
+    version.types.remove('proof')
+    self.assertEqual((version.authors, version.types), (['a', 'b'], ['proof']))
+    version.params['x'] = 'y'
+    other = copy(version)
+    other.topics = ['sets']
+    self.assertEqual((version.topics, other.topics, other.params),
+        (['counting', 'counting'], ['sets'], {'x': 'y'}))
+    with self.assertRaises(AttributeError):
+      version.private = True
+
   def test_get_versions(self):
     problem = Problem(test_filename)
     
@@ -141,10 +735,105 @@ class ProblemTest(unittest.TestCase):
     self.assertEqual(problem.next_id(), 3)
 
 
+class ScratchTest(TemporaryCacheTest):
+  def setUp(self):
+    TemporaryCacheTest.setUp(self)
+    self.resources = tempfile.mkdtemp()
+    self.get_resource_root = resources.get_resource_root
+    resources.get_resource_root = lambda: self.resources
+    for name in ["a.png", "b.png"]:
+      with open(os.path.join(self.resources, name), "w") as f:
+        f.write(name)
+        
+  def tearDown(self):
+    resources.get_resource_root = self.get_resource_root
+    shutil.rmtree(self.resources)
+    TemporaryCacheTest.tearDown(self)
+    
+  def test_reuse(self):
+    dir = scratch.acquire()
+    scratch.stage(["a.png", "b.png"], dir)
+    with open(os.path.join(dir, "render.tex"), "w") as f:
+      f.write("render")
+    scratch.release(dir)
+    self.assertEqual(sorted(os.listdir(dir)), ["a.png", "b.png"])
+    
+    # Changed and unwanted resources are replaced
+    with open(os.path.join(self.resources, "a.png"), "w") as f:
+      f.write("changed")
+    os.utime(os.path.join(self.resources, "a.png"), (0, 0))
+    again = scratch.acquire()
+    self.assertEqual(again, dir)
+    scratch.stage(["a.png"], again)
+    self.assertEqual(os.listdir(again), ["a.png"])
+    with open(os.path.join(again, "a.png")) as f:
+      self.assertEqual(f.read(), "changed")
+    
+    other = scratch.acquire()
+    self.assertNotEqual(other, again)
+    with self.assertRaises(resources.ResourceError) as caught:
+      scratch.stage(["a.png", "missing.png", "other/a.png"], other)
+    self.assertEqual(sorted(caught.exception.problems), 
+        [("missing.png", errno.ENOENT), ("other/a.png", errno.EEXIST)])
+    self.assertEqual(os.listdir(other), [])
+    scratch.release(other)
+    scratch.release(again)
+
+  def test_shared_root(self):
+    fallback_roots = lambda: set(root for root in 
+        os.listdir(tempfile.gettempdir()) if root.startswith("22scratch-"))
+    before = fallback_roots()
+    for root, mode in [("open", 0755), ("private", 0700)]:
+      get_configuration().scratch = os.path.join(self.directory, root)
+      os.mkdir(get_configuration().scratch, mode)
+      dir = scratch.acquire()
+      self.assertEqual(os.path.dirname(dir) == get_configuration().scratch, 
+          mode == 0700)
+      scratch.release(dir)
+    get_configuration().scratch = os.path.join(self.directory, "link")
+    os.symlink(os.path.join(self.directory, "private"), 
+        get_configuration().scratch)
+    dir = scratch.acquire()
+    self.assertNotEqual(os.path.dirname(dir), get_configuration().scratch)
+    scratch.release(dir)
+    # Both roots made instead, not just the last, are deleted
+    scratch.discard_all()
+    self.assertEqual(fallback_roots(), before)
+    
+class StartupTest(unittest.TestCase):
+  def test_lazy_imports(self):
+    # Commands like `build list' and `edit validate' shouldn't pay to read the
+    # configuration or load the builder before they need them
+    script = ("import sys, build, edit, config\n"
+        "print getattr(config, '__configuration') is None\n"
+        "print ' '.join(sorted(sys.modules))")
+    built, modules = check_output([sys.executable, "-c", script]).splitlines()
+    self.assertEqual(built, "True")
+    for module in ["pdfbuilder", "compileserver", "pdfsplit", "ply.lex"]:
+      self.assertNotIn(module, modules.split())
+
 class StringUtilTest(unittest.TestCase):
     def test_strip_comments(self):
         self.assertTrue(strip_latex_comments_test())
 
+    def test_strip_comments_stream(self):
+        for i in range(0, len(test1in), 5):
+            for j in range(i, len(test1in), 13):
+                chunks = [test1in[:i], test1in[i:j], test1in[j:]]
+                self.assertEqual(u"".join(strip_latex_comments_stream(chunks)),
+                    test1out)
+
+    def test_strip_comments_stream_indented(self):
+        # Every line starts with whitespace, which mustn't hold back the stream
+        line = u"  \\item some text % comment\n"
+        stripper = latex_comment_stripper()
+        stripped = []
+        for i in range(2000):
+            stripped.append(stripper.feed(line))
+            self.assertLess(len(stripper.pending), 2 * len(line))
+        stripped.append(stripper.close())
+        self.assertEqual(u"".join(stripped), strip_latex_comments(line * 2000))
+
 class VersionTest(unittest.TestCase):
   def versions_equal(self, version1, version2):
     self.assertEqual(version1.filename, version2.filename)
@@ -494,6 +1183,46 @@ class BuildPredicateTest(unittest.TestCase):
     
     version.authors = ["a", "b"]
     self.assertTrue(satisfies(version, settings, []))
-    
+
+  def test_variant_list(self):
+    self.assertEqual(variant_list("student,rubrics,student"), 
+        ["student", "rubrics"])
+    self.assertEqual(VARIANTS["rubrics"], (True, True, False))
+    self.assertRaises(Exception, variant_list, "student,answers")
+    
+class CorpusTest(unittest.TestCase):
+  def test_select(self):
+    rng = random.Random(22)
+    topics = ["set_theory", "graph_theory", "number_theory", "logic"]
+    types = ["proof", "piece"] + get_private_types()
+    years = ["1994", "1995", "1996"]
+    authors = ["a", "b", "c"]
+    
+    corpus = Corpus()
+    entries = []
+    for i in range(60):
+      version = DummyObject()
+      version.topics = rng.sample(topics, rng.randint(0, 2))
+      version.types = rng.sample(types, rng.randint(0, 2))
+      version.authors = rng.sample(authors, rng.randint(1, 2))
+      version.year = rng.choice(years)
+      used_ins = [UsedIn(year, "Homework", rng.random() < 0.3) 
+          for year in rng.sample(years, rng.randint(0, 2))]
+      corpus.add(version, used_ins)
+      entries.append((version, used_ins))
+      
+    choices = {
+      'allowed_topics': topics[:2], 'required_topics': topics[1:3],
+      'required_types': types[:2], 'written': years[1:], 
+      'used_in': [years[0], "none"], 'not_used_in': [years[1], "none"],
+      'authors': authors[:1]}
+    for i in range(200):
+      settings = DummyObject()
+      for name in rng.sample(sorted(choices), rng.randint(1, 3)):
+        setattr(settings, name, choices[name])
+      expected = [position for position, (version, used_ins) 
+          in enumerate(entries) if satisfies(version, settings, used_ins)]
+      self.assertEqual(list(members(corpus.select(settings))), expected)
+      
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file